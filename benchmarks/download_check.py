@@ -0,0 +1,265 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Check of the download functions of inprotfind (download_file, stream_install
+and published_checksum) against a local stand-in of the database server. The
+server (StandInServer, built on http.server) serves files from memory, answers
+HEAD and GET requests with or without ranges, and can be set to ignore the
+Range header (answering 200 with the whole file, as some servers do) or to
+cut the connection after some bytes. The checks cover a whole download, the
+resume of an interrupted one, the download by N ranges in parallel, a server
+that ignores ranges, a checksum mismatch and the streamed installation. It
+fails (exit code 1) if any of them fails.
+
+  python benchmarks/download_check.py
+  python benchmarks/download_check.py --size 4 --connections 8
+'''
+
+import argparse
+import hashlib
+import http.server
+import io
+import os
+import random
+import re
+import sys
+import tarfile
+import tempfile
+import threading
+import traceback
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCHMARKS_DIR))
+
+from inprotfind import inprotfind as ipf
+
+
+class StandInServer:
+    # files is {path: bytes}, served at http://127.0.0.1:<port>/<path>
+    def __init__(self, files):
+        self.files = files
+        self.accept_ranges = True
+        self.cut_after = None  # bytes sent before cutting the next GET
+        self.requests = []  # (method, path, Range header) of every request
+        self.lock = threading.Lock()
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def url(self, path):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{path}"
+
+    def reset(self, accept_ranges=True, cut_after=None):
+        self.accept_ranges = accept_ranges
+        self.cut_after = cut_after
+        self.requests = []
+
+    def gets(self):
+        return [request for request in self.requests if request[0] == "GET"]
+
+    def _handler(self):
+        stand_in = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def do_HEAD(self):
+                self._send(body=False)
+
+            def do_GET(self):
+                self._send(body=True)
+
+            def _send(self, body):
+                with stand_in.lock:
+                    stand_in.requests.append((self.command, self.path, self.headers.get("Range")))
+                    cut_after = stand_in.cut_after if body else None
+                    if cut_after is not None:
+                        stand_in.cut_after = None
+                data = stand_in.files.get(self.path.lstrip("/"))
+                if data is None:
+                    self.send_error(404)
+                    return
+                start, end, status = 0, len(data) - 1, 200
+                requested = re.fullmatch(r"bytes=(\d+)-(\d*)", self.headers.get("Range", ""))
+                if stand_in.accept_ranges and requested:
+                    start = int(requested.group(1))
+                    end = min(int(requested.group(2)), end) if requested.group(2) else end
+                    status = 206
+                self.send_response(status)
+                self.send_header("Content-Length", str(end - start + 1))
+                if stand_in.accept_ranges:
+                    self.send_header("Accept-Ranges", "bytes")
+                if status == 206:
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(data)}")
+                self.end_headers()
+                if body:
+                    sent = data[start:end + 1] if cut_after is None else data[start:start + cut_after]
+                    self.wfile.write(sent)
+                    if cut_after is not None:
+                        self.wfile.flush()
+                        self.close_connection = True
+                        self.connection.shutdown(2)
+
+        return Handler
+
+
+def md5(data):
+    return "md5:" + hashlib.md5(data).hexdigest()
+
+
+# It returns a .tar.gz (bytes) with a root folder, as the one of the database
+def make_tarball(files, root="arthropodsDB"):
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        folder = tarfile.TarInfo(root)
+        folder.type = tarfile.DIRTYPE
+        folder.mode = 0o755
+        tar.addfile(folder)
+        for name, data in files.items():
+            member = tarfile.TarInfo(f"{root}/{name}")
+            member.size = len(data)
+            tar.addfile(member, io.BytesIO(data))
+    return buffer.getvalue()
+
+
+def read(path):
+    with open(path, "rb") as file:
+        return file.read()
+
+
+def check_whole(server, data, workdir, block_size, connections):
+    server.reset()
+    path = ipf.download_file(server.url("db.bin"), os.path.join(workdir, "whole.bin"), block_size=block_size, checksum=md5(data))
+    assert read(path) == data, "the downloaded file differs from the served one"
+    assert len(server.gets()) == 1, f"{len(server.gets())} GET requests, 1 expected"
+
+
+def check_resume(server, data, workdir, block_size, connections):
+    save_path = os.path.join(workdir, "resumed.bin")
+    # the first download is cut after a third of the file
+    server.reset(cut_after=len(data) // 3)
+    try:
+        ipf.download_file(server.url("db.bin"), save_path, block_size=block_size)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("the interrupted download did not fail")
+    done = os.path.getsize(save_path + ".part")
+    assert 0 < done < len(data), f"{done} bytes kept from the interrupted download"
+
+    server.reset()
+    ipf.download_file(server.url("db.bin"), save_path, block_size=block_size, checksum=md5(data))
+    assert read(save_path) == data, "the resumed file differs from the served one"
+    assert server.gets()[0][2] == f"bytes={done}-{len(data) - 1}", f"resumed with Range {server.gets()[0][2]}, bytes={done}-{len(data) - 1} expected"
+    assert not os.path.exists(save_path + ".part"), "the partial file was not removed"
+
+
+def check_parallel(server, data, workdir, block_size, connections):
+    save_path = os.path.join(workdir, "parallel.bin")
+    server.reset()
+    ipf.download_file(server.url("db.bin"), save_path, block_size=block_size, connections=connections, checksum=md5(data))
+    assert read(save_path) == data, "the file joined from the ranges differs from the served one"
+    ranges = sorted(request[2] for request in server.gets())
+    assert len(set(ranges)) == connections, f"{len(set(ranges))} ranges requested, {connections} expected"
+    os.remove(save_path)
+
+    # one of the parts is cut, and only that one is resumed by the next download
+    server.reset(cut_after=len(data) // (3 * connections))
+    try:
+        ipf.download_file(server.url("db.bin"), save_path, block_size=block_size, connections=connections)
+    except Exception:
+        pass
+    else:
+        raise AssertionError("the interrupted download did not fail")
+    server.reset()
+    ipf.download_file(server.url("db.bin"), save_path, block_size=block_size, connections=connections, checksum=md5(data))
+    assert read(save_path) == data, "the file joined from the resumed ranges differs from the served one"
+    assert len(server.gets()) == 1 and server.gets()[0][2] not in ranges, f"resumed with {[request[2] for request in server.gets()]}"
+    assert not [name for name in os.listdir(workdir) if name.startswith("parallel.bin.part")], "partial files left"
+
+
+def check_no_ranges(server, data, workdir, block_size, connections):
+    save_path = os.path.join(workdir, "no_ranges.bin")
+    # a partial file from before must be discarded, as the server sends the whole file
+    with open(save_path + ".part", "wb") as part:
+        part.write(data[:len(data) // 2])
+    server.reset(accept_ranges=False)
+    ipf.download_file(server.url("db.bin"), save_path, block_size=block_size, connections=connections, checksum=md5(data))
+    assert read(save_path) == data, "the file downloaded without ranges differs from the served one"
+    assert len(server.gets()) == 1, f"{len(server.gets())} GET requests, 1 expected without ranges"
+
+
+def check_bad_checksum(server, data, workdir, block_size, connections):
+    save_path = os.path.join(workdir, "bad.bin")
+    server.reset()
+    try:
+        ipf.download_file(server.url("db.bin"), save_path, block_size=block_size, connections=connections, checksum=md5(data + b"x"))
+    except IOError as error:
+        assert "checksum mismatch" in str(error), f"unexpected error: {error}"
+    else:
+        raise AssertionError("the checksum mismatch was not detected")
+    assert not os.path.exists(save_path), "the file with a wrong checksum was kept"
+
+
+def check_stream_install(server, data, workdir, block_size, connections):
+    tarball = server.files["db.tar.gz"]
+    extract_path = os.path.join(workdir, "installed")
+    server.reset()
+    try:
+        ipf.stream_install(server.url("db.tar.gz"), extract_path, block_size=block_size, checksum=md5(tarball + b"x"))
+    except IOError as error:
+        assert "checksum mismatch" in str(error), f"unexpected error: {error}"
+    else:
+        raise AssertionError("the checksum mismatch was not detected")
+    assert os.listdir(extract_path) == [], "files left from the installation with a wrong checksum"
+
+    ipf.stream_install(server.url("db.tar.gz"), extract_path, block_size=block_size, checksum=md5(tarball))
+    assert sorted(os.listdir(extract_path)) == ["arthropodsDB", "arthropodsDB.index"], f"installed {sorted(os.listdir(extract_path))}"
+    assert read(os.path.join(extract_path, "arthropodsDB")) == data, "the extracted file differs from the archived one"
+
+
+def check_published_checksum(server, data, workdir, block_size, connections):
+    server.reset()
+    assert ipf.published_checksum(server.url("record.json"), "db.bin") == md5(data), "wrong published checksum"
+    assert ipf.published_checksum(server.url("record.json"), "other.bin") is None, "checksum of a file not in the record"
+    assert ipf.published_checksum(server.url("missing.json"), "db.bin") is None, "checksum of a missing record"
+
+
+CHECKS = [check_whole, check_resume, check_parallel, check_no_ranges, check_bad_checksum, check_stream_install, check_published_checksum]
+
+
+def check_downloads(size_mb=2.0, connections=4, block_size=16384):
+    data = random.Random(0).randbytes(int(size_mb * 1048576))
+    files = {"db.bin": data, "db.tar.gz": make_tarball({"arthropodsDB": data, "arthropodsDB.index": b"0\t0\t10\n"})}
+    files["record.json"] = ('{"files": [{"key": "db.bin", "checksum": "%s"}]}' % md5(data)).encode()
+    failed = False
+    with StandInServer(files) as server, tempfile.TemporaryDirectory() as workdir:
+        for check in CHECKS:
+            try:
+                check(server, data, workdir, block_size, connections)
+                print(f"{check.__name__:<28} ok")
+            except Exception:
+                failed = True
+                print(f"{check.__name__:<28} FAILED")
+                traceback.print_exc()
+    print(("FAILED" if failed else "OK") + f" ({size_mb:g} MB, {connections} connections)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Check of the download functions of inprotfind against a local stand-in server")
+    parser.add_argument("--size", type=float, default=2.0, help="Size (MB) of the file served")
+    parser.add_argument("--connections", type=int, default=4, help="Number of ranges downloaded in parallel")
+    args = parser.parse_args()
+    sys.exit(check_downloads(args.size, args.connections))
@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Synthetic data for the benchmarks: a target database in the format read by the
+mmseqs stub (benchmarks/stubs/mmseqs), its metadata parquet (same columns as
+the one of arthropods_OrthoDB) and query fasta files. Everything is generated
+from a fixed seed, so the same data is obtained in every machine.
+
+  python benchmarks/make_data.py --out bench_data --targets 2000 --queries 10 100
+'''
+
+import argparse
+import os
+import random
+
+import pandas as pd
+
+AMINO_ACIDS = "ACDEFGHIKLMNPQRSTVWY"
+DB_NAME = "arthropods_OrthoDB"
+
+
+def random_sequence(generator, min_length=80, max_length=400):
+    return "".join(generator.choice(AMINO_ACIDS) for _ in range(generator.randint(min_length, max_length)))
+
+
+# It writes the target database (databases folder with <db>/<db>DB) and its metadata
+def make_database(databases_dir, n_targets=2000, seed=0):
+    generator = random.Random(seed)
+    db_dir = os.path.join(databases_dir, DB_NAME)
+    os.makedirs(db_dir, exist_ok=True)
+
+    # index with the key, offset and length of every entry, as the one of mmseqs2
+    offset = 0
+    with open(f"{db_dir}/{DB_NAME}DB", "w") as db, open(f"{db_dir}/{DB_NAME}DB.index", "w") as index:
+        for i in range(n_targets):
+            sequence = random_sequence(generator)
+            db.write(f">t{i}\n{sequence}\n")
+            index.write(f"{i}\t{offset}\t{len(sequence) + 2}\n")
+            offset += len(f">t{i}\n{sequence}\n")
+    with open(f"{db_dir}/{DB_NAME}DB.dbtype", "w") as dbtype:
+        dbtype.write("0")
+    # precomputed search index (see inprotfind.create_index)
+    open(f"{db_dir}/{DB_NAME}DB.idx", "w").close()
+
+    metadata = pd.DataFrame({
+        "ID": [f"t{i}" for i in range(n_targets)],
+        "Organism": [f"Organism {i % 50}" for i in range(n_targets)],
+        "GenomeID": [f"GCA_{i % 50:09d}.1" for i in range(n_targets)],
+        # some proteins have no public ID, as in OrthoDB
+        "PubProtID": [None if i % 7 == 0 else f"XP_{i:09d}.1" for i in range(n_targets)],
+        "PubGeneID": [f"LOC{i}" for i in range(n_targets)],
+        "Description": [f"synthetic protein {i}" for i in range(n_targets)]})
+    metadata.to_parquet(os.path.join(databases_dir, f"{DB_NAME}_metadata.parquet"), index=False)
+
+
+# It writes a fasta file with n_queries random sequences
+def make_queries(path, n_queries, seed=1):
+    generator = random.Random(seed)
+    with open(path, "w") as fasta:
+        for i in range(n_queries):
+            fasta.write(f">query{i:05d} synthetic query\n{random_sequence(generator)}\n")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Synthetic data for the inprotfind benchmarks")
+    parser.add_argument("--out", type=str, default="bench_data", help="Folder where the data is written")
+    parser.add_argument("--targets", type=int, default=2000, help="Number of sequences in the target database")
+    parser.add_argument("--queries", type=int, nargs="+", default=[10, 100, 1000, 10000], help="Sizes of the query files")
+    args = parser.parse_args()
+
+    make_database(os.path.join(args.out, "databases"), args.targets)
+    for n_queries in args.queries:
+        make_queries(os.path.join(args.out, f"queries_{n_queries}.fa"), n_queries)
+    print(f"Synthetic data written in {args.out}")
@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Benchmarks of inprotfind with synthetic data and stand-in executables of
+mmseqs, mafft and FastTree (benchmarks/stubs), so they run the same in any
+offline Linux box. For every number of queries, the stages (find_matches,
+align_sequences, build_tree and run_pipeline) are run one after another, each
+one in its own process, and the wall time, the CPU time (of inprotfind and of
+the tools it runs) and the peak RSS of each stage are saved in a JSON file.
+The inprotfind code benchmarked is the one of this repository.
+
+  python benchmarks/run_benchmarks.py run --queries 10 100 1000 10000 --output results.json
+  python benchmarks/run_benchmarks.py compare before.json after.json
+
+The latency of the stubs (INPROTFIND_BENCH_LATENCY, in seconds per call, and
+INPROTFIND_BENCH_LATENCY_PER_SEQ, in seconds per sequence) sets how much of
+the time is spent in the tools. Both are 0 by default, which measures just the
+overhead of inprotfind. The hit cache is not used, and every number of 
+queries gets its own cache folder (INPROTFIND_CACHE_DIR in its folder), so the 
+results do not depend on the runs done before or on the cache of the user.
+'''
+
+import argparse
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARKS_DIR)
+STAGES = ["find_matches", "align_sequences", "build_tree", "run_pipeline"]
+
+sys.path.insert(0, BENCHMARKS_DIR)
+from make_data import make_database, make_queries, DB_NAME
+
+
+# It returns the environment of the stages: stubs first in the PATH and this repository in the PYTHONPATH
+def stage_environment(data_dir, threads=None, latency=0.0, latency_per_seq=0.0):
+    env = dict(os.environ)
+    env["PATH"] = os.path.join(BENCHMARKS_DIR, "stubs") + os.pathsep + env.get("PATH", "")
+    env["PYTHONPATH"] = REPOSITORY_DIR + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+    env["INPROTFIND_DB_DIR"] = os.path.join(data_dir, "databases")
+    env["INPROTFIND_BENCH_LATENCY"] = str(latency)
+    env["INPROTFIND_BENCH_LATENCY_PER_SEQ"] = str(latency_per_seq)
+    env["MPLBACKEND"] = "Agg"
+    if threads:
+        env["INPROTFIND_THREADS"] = str(threads)
+    return env
+
+
+# It runs a stage in a new process and measures it (wait4 returns the resources of the process and of the tools it ran)
+def measure_stage(stage, job_name, query_path, jobs, workdir, env):
+    report_path = os.path.join(workdir, f".{stage}_usage.json")
+    command = [sys.executable, os.path.abspath(__file__), "stage", stage, job_name, query_path, "--jobs", str(jobs), "--report", report_path]
+    with open(os.path.join(workdir, f"{stage}.log"), "w") as log:
+        start = time.perf_counter()
+        process = subprocess.Popen(command, cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        _, status, usage = os.wait4(process.pid, 0)
+        wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+
+    result = {"stage": stage, "returncode": process.returncode, "wall_seconds": round(wall, 4),
+              "cpu_user_seconds": round(usage.ru_utime, 4), "cpu_system_seconds": round(usage.ru_stime, 4),
+              "peak_rss_mb": round(usage.ru_maxrss / 1024, 2)}
+    # split between inprotfind (python) and the tools
+    if os.path.exists(report_path):
+        with open(report_path) as report:
+            result.update(json.load(report))
+        os.remove(report_path)
+    return result
+
+
+# Code run in the process of a stage
+def run_stage(stage, job_name, query_path, jobs, report_path):
+    import inprotfind as ipf
+
+    if stage == "find_matches":
+        ipf.find_matches(job_name, query_path)
+    elif stage == "align_sequences":
+        ipf.align_sequences(job_name, jobs=jobs)
+    elif stage == "build_tree":
+        ipf.build_tree(job_name, jobs=jobs)
+    elif stage == "run_pipeline":
+        ipf.run_pipeline(job_name + "_pipeline", query_path, align_jobs=jobs, tree_jobs=jobs)
+
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    tools = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with open(report_path, "w") as report:
+        json.dump({"python_cpu_seconds": round(own.ru_utime + own.ru_stime, 4), "python_peak_rss_mb": round(own.ru_maxrss / 1024, 2),
+                   "tools_cpu_seconds": round(tools.ru_utime + tools.ru_stime, 4), "tools_peak_rss_mb": round(tools.ru_maxrss / 1024, 2)}, report)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPOSITORY_DIR, capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(sizes, stages, output, data_dir, targets=2000, jobs=1, threads=None, latency=0.0, latency_per_seq=0.0):
+    data_dir = os.path.abspath(data_dir)
+    env = stage_environment(data_dir, threads, latency, latency_per_seq)
+    if not os.path.exists(os.path.join(data_dir, "databases", f"{DB_NAME}_metadata.parquet")):
+        make_database(os.path.join(data_dir, "databases"), targets)
+    # the metadata index is built once, out of the measures
+    subprocess.run([sys.executable, "-c", f"import inprotfind; inprotfind.build_metadata_index('{DB_NAME}')"], env=env, check=True, stdout=subprocess.DEVNULL)
+
+    results = []
+    for n_queries in sizes:
+        workdir = os.path.join(data_dir, f"run_{n_queries}")
+        if os.path.exists(workdir):
+            shutil.rmtree(workdir)
+        os.makedirs(workdir)
+        query_path = os.path.join(data_dir, f"queries_{n_queries}.fa")
+        if not os.path.exists(query_path):
+            make_queries(query_path, n_queries)
+
+        # a new cache for each run, not shared with other runs or with the user
+        run_env = dict(env, INPROTFIND_CACHE_DIR=os.path.join(workdir, "cache"))
+        for stage in stages:
+            result = measure_stage(stage, f"bench{n_queries}", query_path, jobs, workdir, run_env)
+            result["queries"] = n_queries
+            results.append(result)
+            print(f"{n_queries:>6} queries  {stage:<16} {result['wall_seconds']:>9.2f} s wall  {result['cpu_user_seconds'] + result['cpu_system_seconds']:>9.2f} s CPU  {result['peak_rss_mb']:>8.1f} MB" + ("" if result["returncode"] == 0 else f"  (exit code {result['returncode']}, see {workdir}/{stage}.log)"))
+
+    summary = {"revision": git_revision(), "date": time.strftime("%Y-%m-%d %H:%M:%S"), "python": platform.python_version(),
+               "platform": platform.platform(), "cpus": os.cpu_count(), "targets": targets, "jobs": jobs, "threads": threads,
+               "latency": latency, "latency_per_seq": latency_per_seq, "results": results}
+    with open(output, "w") as output_file:
+        json.dump(summary, output_file, indent=1)
+    print(f"Results saved in {output}")
+
+
+# It prints the ratio (after / before) of the wall time, CPU time and peak RSS of every stage
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before, after = json.load(before_file), json.load(after_file)
+    previous = {(result["queries"], result["stage"]): result for result in before["results"]}
+    print(f"{before.get('revision')} -> {after.get('revision')} (ratio after/before, > 1 is slower or bigger)")
+    for result in after["results"]:
+        old = previous.get((result["queries"], result["stage"]))
+        if old is None:
+            continue
+        ratios = []
+        for name, key in [("wall", "wall_seconds"), ("CPU", "cpu_seconds"), ("RSS", "peak_rss_mb")]:
+            if key == "cpu_seconds":
+                new_value, old_value = result["cpu_user_seconds"] + result["cpu_system_seconds"], old["cpu_user_seconds"] + old["cpu_system_seconds"]
+            else:
+                new_value, old_value = result[key], old[key]
+            ratios.append(f"{name} {new_value / old_value:.2f}x" if old_value else f"{name} -")
+        print(f"{result['queries']:>6} queries  {result['stage']:<16} " + "  ".join(ratios))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of inprotfind with stand-in tools")
+    subparsers = parser.add_subparsers(dest="command")
+
+    parser_run = subparsers.add_parser("run", help="To run the benchmarks")
+    parser_run.add_argument("--queries", type=int, nargs="+", default=[10, 100, 1000, 10000], help="Numbers of queries benchmarked")
+    parser_run.add_argument("--stages", nargs="+", default=STAGES, choices=STAGES, help="Stages benchmarked")
+    parser_run.add_argument("--output", type=str, default="benchmark_results.json", help="JSON file with the results")
+    parser_run.add_argument("--data_dir", type=str, default="bench_data", help="Folder for the synthetic data and the jobs")
+    parser_run.add_argument("--targets", type=int, default=2000, help="Number of sequences in the synthetic database")
+    parser_run.add_argument("--jobs", type=int, default=1, help="Parallel workers of align_sequences, build_tree and run_pipeline")
+    parser_run.add_argument("--threads", type=int, default=None, help="Thread budget (INPROTFIND_THREADS)")
+    parser_run.add_argument("--latency", type=float, default=0.0, help="Seconds added to every call of the stubs")
+    parser_run.add_argument("--latency_per_seq", type=float, default=0.0, help="Seconds added per sequence processed by the stubs")
+
+    parser_compare = subparsers.add_parser("compare", help="To compare two result files")
+    parser_compare.add_argument("before", type=str)
+    parser_compare.add_argument("after", type=str)
+
+    # used internally to run each stage in its own process
+    parser_stage = subparsers.add_parser("stage")
+    parser_stage.add_argument("stage", choices=STAGES)
+    parser_stage.add_argument("job_name")
+    parser_stage.add_argument("query_path")
+    parser_stage.add_argument("--jobs", type=int, default=1)
+    parser_stage.add_argument("--report", type=str, required=True)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        run_benchmarks(args.queries, args.stages, args.output, args.data_dir, args.targets, args.jobs, args.threads, args.latency, args.latency_per_seq)
+    elif args.command == "compare":
+        compare(args.before, args.after)
+    elif args.command == "stage":
+        run_stage(args.stage, args.job_name, args.query_path, args.jobs, args.report)
+    else:
+        parser.print_help()
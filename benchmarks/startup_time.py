@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Start-up time check of the inprotfind command line. It runs 'inprotfind --help'
+(and the --help of every subcommand) several times in new processes and fails
+(exit code 1) if the median time of any of them is over the limit (1 second
+by default). It also fails if importing inprotfind loads any of the heavy
+libraries, which must be imported only by the functions that use them.
+
+  python benchmarks/startup_time.py
+  python benchmarks/startup_time.py --limit 0.5 --repeat 10
+'''
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPOSITORY_DIR = os.path.dirname(BENCHMARKS_DIR)
+HEAVY_MODULES = ["pandas", "pyarrow", "matplotlib", "Bio", "requests", "tqdm", "ete3", "streamlit"]
+COMMANDS = ["get_database", "find_matches", "create_index", "warm_database", "create_targetDB", "split_database", "align_sequences", "build_tree",
+            "serve", "run_pipeline", "show_results", "show_example_result"]
+
+
+def environment():
+    env = dict(os.environ)
+    env["PYTHONPATH"] = REPOSITORY_DIR + (os.pathsep + env["PYTHONPATH"] if env.get("PYTHONPATH") else "")
+    return env
+
+
+# It returns the median time (seconds) of running the command line with args
+def time_command(args, repeat, env):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "from inprotfind.inprotfind import main_function; main_function()"] + args,
+                       env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+# It returns the heavy libraries loaded by 'import inprotfind'
+def heavy_imports(env):
+    code = f"import sys, inprotfind; print(' '.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], env=env, capture_output=True, text=True, check=True)
+    return result.stdout.split()
+
+
+def check_startup(limit=1.0, repeat=5):
+    env = environment()
+    failed = False
+
+    loaded = heavy_imports(env)
+    if loaded:
+        failed = True
+        print(f"'import inprotfind' loads {', '.join(loaded)}")
+
+    for args in [["--help"]] + [[command, "--help"] for command in COMMANDS]:
+        seconds = time_command(args, repeat, env)
+        slow = seconds > limit
+        failed = failed or slow
+        print(f"inprotfind {' '.join(args):<32} {seconds:>7.3f} s" + ("  (over the limit)" if slow else ""))
+
+    print(("FAILED" if failed else "OK") + f" (limit {limit:.2f} s, median of {repeat} runs)")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start-up time check of the inprotfind command line")
+    parser.add_argument("--limit", type=float, default=1.0, help="Maximum median time (seconds) of each command")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of runs of each command")
+    args = parser.parse_args()
+    sys.exit(check_startup(args.limit, args.repeat))
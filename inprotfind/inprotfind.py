@@ -10,14 +10,10 @@
 This script manage all the functions available in the library. 
 '''
 
-# external libraries
-import pandas as pd
-import matplotlib.pyplot as plt
+# external libraries (pandas, pyarrow, Bio, matplotlib, requests, tqdm and 
+# ete3 are imported inside the functions that use them, so the command line 
+# starts fast and ete3/Qt is only loaded to draw interactive trees)
 from colorama import Fore, Back, Style, init
-from Bio import SeqIO, Phylo
-import requests
-from tqdm import tqdm
-from ete3 import Tree, TreeStyle
 
 # interanal libraries
 import os
@@ -27,6 +23,24 @@ import time
 import importlib.resources as pkg_resources
 import argparse
 import tarfile
+import tempfile
+import functools
+import heapq
+import re
+import bisect
+import hashlib
+import json
+import asyncio
+import threading
+import sqlite3
+import cProfile
+import pstats
+import shlex
+import gzip
+import io
+import random
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
 
 # resetting colorama
 init(autoreset=True)
@@ -43,32 +57,50 @@ init(autoreset=True)
 This function download and install the database arthropods_OrthoDB in the 
 location of the library inprotfind in the current environment. In case an
 installed database is corrupted or malfunction, it is possible to reinstall
-it using this function. The argument fm_calling is just for communication
-between functions and does not need to be changed by the user.
+it using this function. Once installed, it also builds the index used to read
+the metadata of the database (see build_metadata_index) and the precomputed
+index of mmseqs2 (see create_index). The argument 
+fm_calling is just for communication between functions and does not need to 
+be changed by the user. 
+
+The download (see download_file) is resumed if a previous one was interrupted,
+can be split in several parallel connections, and is verified against the 
+checksum published in zenodo.org (or the one passed as "md5:..."/"sha256:...")
+before installing it. The url can be changed to install the database from a 
+mirror, and the environment variable INPROTFIND_DB_DIR sets a different folder
+for the databases. With streaming=True the database is extracted while it is
+downloaded, without saving the tarball (see stream_install); this mode can not
+resume an interrupted download.
 '''
 
-def get_database(fm_calling = False):
+DATABASE_URL = "https://zenodo.org/records/13622813/files/arthropodsDB.tar.gz?download=1"
+DATABASE_RECORD = "https://zenodo.org/api/records/13622813"
+
+def get_database(fm_calling = False, connections = 1, block_size = 1048576, checksum = None, url = DATABASE_URL, streaming = False):
     
     # setting directories
-    mmseqs_targetdir = pkg_resources.files("inprotfind").joinpath("databases/arthropods_OrthoDB")
-    mmseqs_target_metadata = pkg_resources.files("inprotfind").joinpath("databases/arthropods_OrthoDB_metadata.parquet")
+    mmseqs_targetdir = database_path("arthropods_OrthoDB")
+    mmseqs_target_metadata = database_path("arthropods_OrthoDB_metadata.parquet")
+    mmseqs_target_index = database_path("arthropods_OrthoDB_metadata.arrow")
 
     # checking the status of the database in the environment
     if fm_calling == False:
         if not os.path.exists(mmseqs_targetdir) and not os.path.exists(mmseqs_target_metadata):
             install = True
-            if not os.path.exists(pkg_resources.files("inprotfind").joinpath("databases")):
-                os.mkdir(str(pkg_resources.files("inprotfind").joinpath("databases")))
+            if not os.path.exists(database_path()):
+                os.makedirs(database_path())
         else:
             value = input(Fore.RED + Style.BRIGHT + f"A version of the database is already installed in your computer in {mmseqs_targetdir}. Do you want to reinstall it? (yes/no): ")
                 
             if value == "yes" or value == "y" or value == "YES" or value == "Y":
-                mmseqs_target_metadata = pkg_resources.files("inprotfind").joinpath("databases/arthropods_OrthoDB_metadata.parquet")
+                mmseqs_target_metadata = database_path("arthropods_OrthoDB_metadata.parquet")
                 try:
                     if os.path.exists(mmseqs_targetdir):
                         shutil.rmtree(mmseqs_targetdir)
                     if os.path.exists(mmseqs_target_metadata):
                         os.remove(mmseqs_target_metadata)
+                    if os.path.exists(mmseqs_target_index):
+                        os.remove(mmseqs_target_index)
                     print(Fore.GREEN + Style.BRIGHT + "Previous database removed")
                     install = True
                 except:
@@ -85,6 +117,8 @@ def get_database(fm_calling = False):
                 shutil.rmtree(mmseqs_targetdir)
             if os.path.exists(mmseqs_target_metadata):
                 os.remove(mmseqs_target_metadata)
+            if os.path.exists(mmseqs_target_index):
+                os.remove(mmseqs_target_index)
             print(Fore.GREEN + Style.BRIGHT + "Previous database removed")
             install = True
         except:
@@ -95,89 +129,671 @@ def get_database(fm_calling = False):
         
     # Installing the database
     if install == True:
-        if not os.path.exists(pkg_resources.files("inprotfind").joinpath("databases")):
-            os.mkdir(str(pkg_resources.files("inprotfind").joinpath("databases")))
+        if not os.path.exists(database_path()):
+            os.makedirs(database_path())
 
         # finding the database in zenodo.org
-        save_path = pkg_resources.files("inprotfind").joinpath("databases/arthropods_OrthoDB.tar.gz")
-        extract_path = pkg_resources.files("inprotfind").joinpath("databases")
-        doi = "https://zenodo.org/records/13622813/files/arthropodsDB.tar.gz?download=1"
-        
-        response = requests.get(doi, stream=True)
-        total_size = int(response.headers.get('content-length', 0))  # Tamaño total del archivo
-        block_size = 8192  # Tamaño del bloque a leer cada vez
-    
-        # downloading
-        print(Fore.GREEN + Style.BRIGHT + "Downloading database...")
-        with tqdm(total=total_size, unit='iB', unit_scale=True, leave=False) as progress_bar:
-            with open(save_path, 'wb') as file:
-                for data in response.iter_content(block_size):
-                    file.write(data)
-                    progress_bar.update(len(data))
-
-        progress_bar.close()
-    
-        if total_size != 0 and progress_bar.n != total_size:
-            print(Fore.RED + Style.BRIGHT + "Error downloading the database")
-            print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
-            return
+        save_path = database_path("arthropods_OrthoDB.tar.gz")
+        extract_path = database_path()
+        
+        # the checksum published with the database, unless other was passed
+        if checksum is None and url == DATABASE_URL:
+            checksum = published_checksum(DATABASE_RECORD, "arthropodsDB.tar.gz")
+            if checksum is None:
+                print(Fore.RED + Style.BRIGHT + "The published checksum could not be retrieved. The download will not be verified.")
+    
+        if streaming:
+            # downloading and extracting at the same time, without saving the tarball
+            print(Fore.GREEN + Style.BRIGHT + "Downloading and installing database...")
+            try:
+                stream_install(url, extract_path, block_size=block_size, checksum=checksum)
+            except Exception as e:
+                print(Fore.RED + Style.BRIGHT + f"Error installing the database: {e}")
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                return
         else:
+            # downloading
+            print(Fore.GREEN + Style.BRIGHT + "Downloading database...")
+            try:
+                download_file(url, save_path, block_size=block_size, connections=connections, checksum=checksum)
+            except Exception as e:
+                print(Fore.RED + Style.BRIGHT + f"Error downloading the database: {e}")
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                return
             print(Fore.GREEN + Style.BRIGHT + "The database was downloaded successfuly")
-             
-        # installing
-        if not os.path.exists(extract_path):
-            os.makedirs(extract_path)  # Crear el directorio si no existe
-        try:
-            print(Fore.GREEN + Style.BRIGHT + "Installing database...")
-            with tarfile.open(save_path, "r:gz") as tar:
-                root_dir = os.path.commonpath([member.name for member in tar.getmembers()])
+                 
+            # installing
+            if not os.path.exists(extract_path):
+                os.makedirs(extract_path)  # Crear el directorio si no existe
+            try:
+                print(Fore.GREEN + Style.BRIGHT + "Installing database...")
+                with tarfile.open(save_path, "r:gz") as tar:
+                    root_dir = os.path.commonpath([member.name for member in tar.getmembers()])
+                    
+                    for member in tar.getmembers():
+                        member.name = os.path.relpath(member.name, root_dir)
+                        tar.extract(member, path=extract_path)
                 
-                for member in tar.getmembers():
-                    member.name = os.path.relpath(member.name, root_dir)
-                    tar.extract(member, path=extract_path)
-            
-            # removing downloaded file to save disk space
-            os.remove(save_path)
-            save_path = pkg_resources.files("inprotfind").joinpath("databases")
-            print(Fore.GREEN + Style.BRIGHT + f"Database have been installed in the inprotfind library (Path: {save_path})")
+                # removing downloaded file to save disk space
+                os.remove(save_path)
+    
+            except Exception as e:
+                print(Fore.RED + Style.BRIGHT + f"Error extracting the files: {e}")
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                return
+        
+        # building the lookup index of the metadata and the search index
+        print(Fore.GREEN + Style.BRIGHT + "Building the metadata index...")
+        build_metadata_index("arthropods_OrthoDB")
+        print(Fore.GREEN + Style.BRIGHT + "Building the search index (this may take a while)...")
+        create_index("arthropods_OrthoDB")
+        print(Fore.GREEN + Style.BRIGHT + f"Database have been installed in the inprotfind library (Path: {extract_path})")
+
 
-        except Exception as e:
-            print(Fore.RED + Style.BRIGHT + f"Error extracting the files: {e}")
+'''
+# create_targetDB
+#################
+
+This function creates a custom database (db_name) from a fasta file 
+(fasta_path, which may be compressed with gzip), so it can be searched with 
+find_matches(..., db_name=db_name) instead of arthropods_OrthoDB. It builds 
+the mmseqs2 database, its search index (unless index=False) and the metadata 
+of its sequences (<db_name>_metadata.parquet and its index). The metadata is 
+taken from the annotation table metadata_path (parquet, csv or tab separated,
+with an 'ID' column with the first word of the fasta headers and any of the 
+columns Organism, GenomeID, PubProtID, PubGeneID and Description), or, if it 
+is not given, from the fasta headers (see _header_metadata). Both are read as
+streams and the metadata is written by row groups of 'chunksize' rows, so the
+memory used does not depend on the number of sequences. The metadata and the 
+mmseqs2 database are built in a temporal folder and replace the previous 
+database (if any) only when both are complete, so a failed run leaves nothing
+behind.
+'''
+
+def create_targetDB(db_name, fasta_path, metadata_path=None, threads=None, index=True, chunksize=100000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    verifying_mmseqs2()
+    if db_name == "arthropods_OrthoDB":
+        print(Fore.RED + Style.BRIGHT + "The name arthropods_OrthoDB is used by the default database. Please, choose another name.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return False
+    if not os.path.exists(fasta_path) or (metadata_path is not None and not os.path.exists(metadata_path)):
+        print(Fore.RED + Style.BRIGHT + f"The file {fasta_path if not os.path.exists(fasta_path) else metadata_path} does not exist.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return False
+    
+    start_time = time.time()
+    mmseqs_targetdir = database_path(db_name)
+    metadata_targetdir = database_path(f"{db_name}_metadata.parquet")
+    
+    # both the metadata and the mmseqs2 database are written to temporal files, and they replace the 
+    # previous database only when both are complete
+    os.makedirs(database_path(), exist_ok=True)
+    building_dir = tempfile.mkdtemp(prefix=f"{db_name}_building_", dir=database_path())
+    try:
+        # writing the metadata by row groups
+        print(Fore.GREEN + Style.BRIGHT + "Writing the metadata of the sequences...")
+        schema = pa.schema([(column, pa.string()) for column in METADATA_COLUMNS])
+        batches = _annotation_batches(metadata_path, chunksize) if metadata_path is not None else _header_batches(fasta_path, chunksize)
+        n_sequences = 0
+        try:
+            with pq.ParquetWriter(f"{building_dir}/metadata.parquet", schema) as writer:
+                for batch in batches:
+                    writer.write_table(pa.Table.from_pydict(batch, schema=schema))
+                    n_sequences += len(batch["ID"])
+        except (KeyError, ValueError, OSError, EOFError, pa.ArrowException) as error:
+            print(Fore.RED + Style.BRIGHT + f"The metadata of {db_name} could not be read: {error}")
             print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
-            return
+            return False
+        
+        # building the mmseqs2 database
+        print(Fore.GREEN + Style.BRIGHT + "Converting the sequences to mmseqs2 format...")
+        os.makedirs(f"{building_dir}/{db_name}")
+        try:
+            _run_tool(["mmseqs", "createdb", str(fasta_path), f"{building_dir}/{db_name}/{db_name}DB"], show_output=True)
+        except RuntimeError as error:
+            print(Fore.RED + Style.BRIGHT + str(error))
+            print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+            return False
+        
+        # replacing the previous database
+        if os.path.exists(mmseqs_targetdir):
+            print(Fore.GREEN + Style.BRIGHT + f"The database {db_name} already exists. It will be replaced.")
+            shutil.rmtree(mmseqs_targetdir)
+        os.replace(f"{building_dir}/{db_name}", mmseqs_targetdir)
+        os.replace(f"{building_dir}/metadata.parquet", metadata_targetdir)
+    finally:
+        shutil.rmtree(building_dir, ignore_errors=True)
+    
+    print(Fore.GREEN + Style.BRIGHT + "Building the metadata index...")
+    build_metadata_index(db_name)
+    if index:
+        print(Fore.GREEN + Style.BRIGHT + "Building the search index (this may take a while)...")
+        create_index(db_name, threads)
+    print(Fore.GREEN + Style.BRIGHT + f"Database {db_name} created with the metadata of {n_sequences} sequences in {time.time() - start_time:.2f} seconds (Path: {mmseqs_targetdir})")
+    return True
+
+# metadata from the headers of the fasta file, in batches of chunksize rows
+def _header_batches(fasta_path, chunksize):
+    batch = {column: [] for column in METADATA_COLUMNS}
+    with (gzip.open(fasta_path, "rt") if str(fasta_path).endswith(".gz") else open(fasta_path)) as fasta:
+        for line in fasta:
+            if not line.startswith(">"):
+                continue
+            for column, value in zip(METADATA_COLUMNS, _header_metadata(line[1:].strip())):
+                batch[column].append(value)
+            if len(batch["ID"]) == chunksize:
+                yield batch
+                batch = {column: [] for column in METADATA_COLUMNS}
+    if batch["ID"]:
+        yield batch
+
+# ID (first word) and description of a header, with the organism (OS= or [organism]) and gene (GN=) if present
+def _header_metadata(header):
+    parts = header.split(None, 1)
+    description = parts[1] if len(parts) > 1 else None
+    organism = gene = None
+    if description:
+        match = re.search(r"\bOS=(.+?)(?= [A-Z]{2}=|$)", description)
+        if match:
+            organism = match.group(1)
+            gene = re.search(r"\bGN=(\S+)", description)
+            gene = gene.group(1) if gene else None
+            description = description[:match.start()].strip() or None
+        else:
+            match = re.search(r"\[([^\[\]]+)\]$", description)
+            if match:
+                organism = match.group(1)
+                description = description[:match.start()].strip() or None
+    return parts[0], organism, None, None, gene, description
+
+# metadata from the annotation table, in batches of chunksize rows
+def _annotation_batches(metadata_path, chunksize):
+    import pandas as pd
+    import pyarrow.parquet as pq
+    if str(metadata_path).endswith(".parquet"):
+        parquet_file = pq.ParquetFile(metadata_path)
+        columns = [column for column in METADATA_COLUMNS if column in parquet_file.schema_arrow.names]
+        chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=chunksize, columns=columns))
+    else:
+        separator = "," if str(metadata_path).endswith(".csv") else "\t"
+        chunks = pd.read_csv(metadata_path, sep=separator, dtype=str, chunksize=chunksize, usecols=lambda column: column in METADATA_COLUMNS)
+    for chunk in chunks:
+        if "ID" not in chunk.columns:
+            raise KeyError(f"{metadata_path} has no 'ID' column")
+        chunk = chunk.astype(object).where(chunk.notna(), None)
+        yield {column: [None if value is None else str(value) for value in chunk[column]] if column in chunk.columns else [None] * len(chunk) for column in METADATA_COLUMNS}
+
+
+'''
+# search index functions
+########################
+
+create_index precomputes the k-mer index of a target database (mmseqs2 
+createindex), so the searches do not have to build it in every run. 
+warm_database loads the database and its index in the page cache (mmseqs2 
+touchdb), and searches run with warm=True read them with --db-load-mode 2 
+(memory mapped), so the database stays in memory between searches and repeated
+small searches only pay for the alignment work. The database is loaded only 
+once per process (WARMED_DATABASES keeps the databases loaded, with the 
+version installed), so the next warm searches do not read it again. 
+search_options returns the options passed to mmseqs search (with the number 
+of threads, if given).
+'''
+
+# (db_name, database_stamp) of the databases loaded in memory by this process
+WARMED_DATABASES = set()
+
+def create_index(db_name="arthropods_OrthoDB", threads=None):
+    verifying_mmseqs2()
+    mmseqs_targetdir = database_path(db_name)
+    index_tmp = f"{mmseqs_targetdir}/tmp_index"
+    
+    start_time = time.time()
+    try:
+        _run_tool(["mmseqs", "createindex", f"{mmseqs_targetdir}/{db_name}DB", index_tmp, "--threads", str(resolve_threads(threads))], show_output=True)
+    except RuntimeError as error:
+        print(Fore.RED + Style.BRIGHT + str(error))
+        return False
+    finally:
+        shutil.rmtree(index_tmp, ignore_errors=True)
+    print(Fore.GREEN + Style.BRIGHT + f"Index of {db_name} built in {time.time() - start_time:.2f} seconds")
+    return True
+
+def warm_database(db_name="arthropods_OrthoDB"):
+    verifying_mmseqs2()
+    mmseqs_targetdir = database_path(db_name)
+    warmed_key = (db_name, database_stamp(db_name))
+    if warmed_key in WARMED_DATABASES:
+        print(Fore.GREEN + Style.BRIGHT + f"Database {db_name} already loaded in memory, skipping...")
+        return True
+    
+    start_time = time.time()
+    try:
+        _run_tool(["mmseqs", "touchdb", f"{mmseqs_targetdir}/{db_name}DB"])
+    except RuntimeError as error:
+        print(Fore.RED + Style.BRIGHT + str(error))
+        return False
+    WARMED_DATABASES.add(warmed_key)
+    print(Fore.GREEN + Style.BRIGHT + f"Database {db_name} loaded in memory in {time.time() - start_time:.2f} seconds")
+    return True
+
+def search_options(evalue, min_seq_id, warm=False, threads=None):
+    options = f"--max-seqs 100 -e {evalue} --min-seq-id {min_seq_id}"
+    if warm:
+        options += " --db-load-mode 2"
+    if threads:
+        options += f" --threads {threads}"
+    return options
+
+
+'''
+# sharded search functions
+##########################
+
+split_database splits a target database in n_shards shards of about the same
+number of residues (database folder <db_name>_shards, one mmseqs2 database per 
+shard, with its own search index), so a large search can be spread over the
+cores or the nodes of a cluster that share the filesystem. The shards are 
+built reading the index of the database line by line (mmseqs createsubdb), 
+and shards.json keeps the number of residues of each shard and the version of
+the database they were made from. run_on_shards runs one command per shard at
+the same time, through a launcher: a callable launcher(args, shard) that runs
+the command args and raises RuntimeError if it fails, or a command prefix set 
+in the environment variable INPROTFIND_LAUNCHER (e.g. "srun -N1 -n1", where 
+{shard} is replaced by the number of the shard). Without launcher the shards 
+are searched in this machine, sharing the threads. merge_shard_hits merges 
+the results of the shards (convertalis tables) into the table of a search of
+the whole database: the e-values, computed by mmseqs2 for the size of each 
+shard, are scaled to the size of the whole database (E * total residues / 
+shard residues), the hits over the e-value threshold are removed, and the 
+'max_seqs' best hits of each query (lowest e-value, then highest bitscore) 
+are kept. The tables of the shards are read as streams, so the memory used 
+does not depend on the number of hits.
+'''
+
+def split_database(db_name="arthropods_OrthoDB", n_shards=4, threads=None, index=True):
+    verifying_mmseqs2()
+    threads = resolve_threads(threads)
+    target_db = f"{database_path(db_name)}/{db_name}DB"
+    shards_dir = database_path(f"{db_name}_shards")
+    if not os.path.exists(target_db + ".index"):
+        print(Fore.RED + Style.BRIGHT + f"The database {db_name} is not installed.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return False
+    
+    start_time = time.time()
+    shutil.rmtree(shards_dir, ignore_errors=True)
+    os.makedirs(shards_dir)
+    
+    # first pass: size of the database (the length of each entry includes its line break and null byte)
+    with open(target_db + ".index") as db_index:
+        total_size = sum(int(line.split("\t")[2]) for line in db_index)
+    
+    # second pass: consecutive entries to each shard, until it has its share of the database
+    key_files = [open(f"{shards_dir}/shard{shard}.keys", "w") for shard in range(n_shards)]
+    residues = [0] * n_shards
+    shard = 0
+    done_size = 0
+    try:
+        with open(target_db + ".index") as db_index:
+            for line in db_index:
+                key, _, length = line.rstrip("\n").split("\t")
+                if shard < n_shards - 1 and done_size >= total_size * (shard + 1) / n_shards:
+                    shard += 1
+                key_files[shard].write(key + "\n")
+                residues[shard] += max(int(length) - 2, 0)
+                done_size += int(length)
+    finally:
+        for key_file in key_files:
+            key_file.close()
+    
+    try:
+        for shard in range(n_shards):
+            shard_db = shard_database(db_name, shard)
+            _run_tool(["mmseqs", "createsubdb", f"{shards_dir}/shard{shard}.keys", target_db, shard_db])
+            if os.path.exists(target_db + "_h"):
+                _run_tool(["mmseqs", "createsubdb", f"{shards_dir}/shard{shard}.keys", target_db + "_h", shard_db + "_h"])
+            if index:
+                _run_tool(["mmseqs", "createindex", shard_db, f"{shards_dir}/tmp_index", "--threads", str(threads)])
+            os.remove(f"{shards_dir}/shard{shard}.keys")
+            print(Fore.GREEN + Style.BRIGHT + f"Shard {shard + 1}/{n_shards} built ({residues[shard]} residues)")
+    except RuntimeError as error:
+        print(Fore.RED + Style.BRIGHT + str(error))
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return False
+    finally:
+        shutil.rmtree(f"{shards_dir}/tmp_index", ignore_errors=True)
+    
+    with open(f"{shards_dir}/shards.json", "w") as shards_file:
+        json.dump({"n_shards": n_shards, "residues": residues, "database": database_stamp(db_name)}, shards_file)
+    print(Fore.GREEN + Style.BRIGHT + f"Database {db_name} split in {n_shards} shards in {time.time() - start_time:.2f} seconds")
+    return True
+
+def shard_database(db_name, shard):
+    return database_path(f"{db_name}_shards/shard{shard}DB")
+
+# it returns the description of the shards (shards.json), or None if they are missing or outdated
+def load_shards(db_name):
+    shards_json = database_path(f"{db_name}_shards/shards.json")
+    if not os.path.exists(shards_json):
+        return None
+    with open(shards_json) as shards_file:
+        shards = json.load(shards_file)
+    if shards["database"] != database_stamp(db_name):
+        return None
+    return shards
+
+# commands is a list with the arguments of the command of each shard
+def run_on_shards(commands, launcher=None, metrics=None, stage=None):
+    if launcher is None and os.environ.get("INPROTFIND_LAUNCHER"):
+        prefix = os.environ["INPROTFIND_LAUNCHER"]
+        launcher = lambda args, shard: _run_tool(shlex.split(prefix.replace("{shard}", str(shard))) + args, metrics=metrics, stage=stage)
+    elif launcher is None:
+        launcher = lambda args, shard: _run_tool(args, metrics=metrics, stage=stage)
+    
+    with ThreadPoolExecutor(max_workers=len(commands)) as executor:
+        futures = [executor.submit(launcher, args, shard) for shard, args in enumerate(commands)]
+        errors = [str(future.exception()) for future in futures if future.exception() is not None]
+    if errors:
+        raise RuntimeError("; ".join(errors))
+
+# the hits of one table, grouped by query, with the e-value scaled (the queries are in the order of query_positions)
+def _shard_hits(m8_path, shard, factor, query_positions):
+    last_position = -1
+    with open(m8_path) as m8:
+        for line in m8:
+            fields = line.rstrip("\n").split("\t")
+            position = query_positions[fields[0]]
+            if position < last_position:
+                raise RuntimeError(f"the hits of {m8_path} are not in the order of the queries")
+            last_position = position
+            evalue = float(fields[10]) * factor
+            yield position, evalue, -float(fields[11]), shard, fields
+
+def merge_shard_hits(m8_paths, residues, output_path, query_ids, evalue, max_seqs=100):
+    query_positions = {query_id: position for position, query_id in enumerate(query_ids)}
+    total_residues = sum(residues)
+    streams = [_shard_hits(m8_path, shard, total_residues / max(residues[shard], 1), query_positions) for shard, m8_path in enumerate(m8_paths)]
+    
+    n_hits = 0
+    kept = 0
+    last_position = None
+    with open(output_path + ".tmp", "w") as output:
+        for position, hit_evalue, _, _, fields in heapq.merge(*streams):
+            if position != last_position:
+                last_position = position
+                kept = 0
+            if hit_evalue > evalue or kept >= max_seqs:
+                continue
+            fields[10] = f"{hit_evalue:.3E}"
+            output.write("\t".join(fields) + "\n")
+            kept += 1
+            n_hits += 1
+    os.replace(output_path + ".tmp", output_path)
+    return n_hits
+
 
+'''
+# download functions
+####################
+
+download_file downloads 'url' to 'save_path' reading blocks of 'block_size' 
+bytes. The data is written to partial files (save_path.part, or 
+save_path.part<N> when using several connections), so an interrupted download
+is resumed from where it stopped using HTTP range requests. If the server 
+accepts ranges and 'connections' is higher than 1, the file is split in that
+number of ranges downloaded in parallel. When 'checksum' is given (as 
+"md5:<hex>" or "sha256:<hex>"), the file is verified once downloaded and 
+removed if it does not match. published_checksum returns the checksum of a 
+file of a zenodo.org record (None if it can not be retrieved).
+'''
+
+def download_file(url, save_path, block_size=1048576, connections=1, checksum=None):
+    import requests
+    from tqdm import tqdm
+    save_path = str(save_path)
+    
+    head = requests.head(url, allow_redirects=True, timeout=60)
+    head.raise_for_status()
+    total_size = int(head.headers.get("content-length", 0))
+    accepts_ranges = head.headers.get("accept-ranges", "").lower() == "bytes" and total_size > 0
+    
+    if accepts_ranges and connections > 1:
+        # splitting the file in one range per connection
+        part_size = -(-total_size // connections)
+        ranges = [(start, min(start + part_size, total_size) - 1) for start in range(0, total_size, part_size)]
+        parts = [f"{save_path}.part{n}" for n in range(len(ranges))]
+    else:
+        ranges = [(0, total_size - 1 if total_size else None)]
+        parts = [f"{save_path}.part"]
+    
+    with tqdm(total=total_size, unit='iB', unit_scale=True, leave=False) as progress_bar:
+        with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            futures = [executor.submit(_download_range, url, part, start, end, block_size, progress_bar, accepts_ranges) for part, (start, end) in zip(parts, ranges)]
+            for future in futures:
+                future.result()
+    
+    # joining the parts
+    if len(parts) == 1:
+        os.replace(parts[0], save_path)
+    else:
+        with open(save_path, "wb") as output:
+            for part in parts:
+                with open(part, "rb") as input_part:
+                    shutil.copyfileobj(input_part, output, block_size)
+        for part in parts:
+            os.remove(part)
+    
+    downloaded_size = os.path.getsize(save_path)
+    if total_size != 0 and downloaded_size != total_size:
+        os.remove(save_path)
+        raise IOError(f"downloaded {downloaded_size} bytes, {total_size} expected")
+    
+    if checksum:
+        algorithm, expected = checksum.split(":", 1)
+        print(Fore.GREEN + Style.BRIGHT + f"Verifying the {algorithm} checksum...")
+        file_hash = hashlib.new(algorithm)
+        with open(save_path, "rb") as downloaded:
+            for data in iter(lambda: downloaded.read(block_size), b""):
+                file_hash.update(data)
+        if file_hash.hexdigest() != expected.lower():
+            os.remove(save_path)
+            raise IOError(f"{algorithm} checksum mismatch (expected {expected}, got {file_hash.hexdigest()})")
+    
+    return save_path
+
+def _download_range(url, part_path, start, end, block_size, progress_bar, accepts_ranges):
+    import requests
+    # resuming from the bytes already in the partial file
+    done = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if end is not None and done >= end - start + 1:
+        progress_bar.update(end - start + 1)
+        return
+    
+    headers = {}
+    if accepts_ranges or done:
+        headers["Range"] = f"bytes={start + done}-{'' if end is None else end}"
+    
+    with requests.get(url, headers=headers, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        if response.status_code != 206:
+            if start != 0:
+                raise IOError("the server does not accept range requests")
+            done = 0  # the whole file is sent again
+        progress_bar.update(done)
+        with open(part_path, "ab" if done else "wb") as part:
+            for data in response.iter_content(block_size):
+                part.write(data)
+                progress_bar.update(len(data))
+
+def published_checksum(record_url, file_name):
+    import requests
+    try:
+        record = requests.get(record_url, timeout=60).json()
+        for entry in record.get("files", []):
+            if entry.get("key") == file_name:
+                return entry.get("checksum")
+    except Exception:
+        pass
+    return None
+
+
+'''
+stream_install pipes the download straight through the gzip decompression and
+the tar extraction, so the tarball is never written to disk and it is 
+decompressed only once. The root folder of the tarball is stripped on the fly,
+the free space is checked before starting, and the files are extracted in a 
+staging folder that is renamed into place only when the whole archive was 
+extracted (and its checksum verified).
+'''
+
+# expected size of the extracted database relative to the compressed download
+EXTRACTED_SIZE_RATIO = 3
+
+def stream_install(url, extract_path, block_size=1048576, checksum=None):
+    import requests
+    from tqdm import tqdm
+    extract_path = str(extract_path)
+    os.makedirs(extract_path, exist_ok=True)
+    
+    with requests.get(url, stream=True, timeout=60) as response:
+        response.raise_for_status()
+        total_size = int(response.headers.get("content-length", 0))
+        
+        # checking the free space before starting
+        free_space = shutil.disk_usage(extract_path).free
+        if total_size and free_space < total_size * EXTRACTED_SIZE_RATIO:
+            raise IOError(f"not enough free space in {extract_path} ({free_space / 1e9:.1f} GB free, about {total_size * EXTRACTED_SIZE_RATIO / 1e9:.1f} GB needed)")
+        
+        file_hash = None
+        if checksum:
+            algorithm, expected = checksum.split(":", 1)
+            file_hash = hashlib.new(algorithm)
+        
+        staging = tempfile.mkdtemp(prefix=".staging_", dir=extract_path)
+        try:
+            with tqdm(total=total_size, unit='iB', unit_scale=True, leave=False) as progress_bar:
+                stream = _HashingReader(response.raw, file_hash, progress_bar)
+                with tarfile.open(fileobj=stream, mode="r|gz", bufsize=block_size) as tar:
+                    root_dir = None
+                    for member in tar:
+                        name = os.path.normpath(member.name)
+                        if name == ".":
+                            continue
+                        if root_dir is None:
+                            # the first member is the root folder of the tarball
+                            root_dir = name if member.isdir() else ""
+                            if root_dir:
+                                continue
+                        if root_dir:
+                            if not name.startswith(root_dir + os.sep):
+                                raise IOError(f"unexpected file outside of {root_dir} in the tarball: {member.name}")
+                            member.name = os.path.relpath(name, root_dir)
+                        tar.extract(member, path=staging)
+                
+                # reading the rest of the stream (padding), so the checksum covers the whole file
+                while stream.read(block_size):
+                    pass
+            
+            if file_hash is not None and file_hash.hexdigest() != expected.lower():
+                raise IOError(f"{algorithm} checksum mismatch (expected {expected}, got {file_hash.hexdigest()})")
+            
+            # moving the extracted files into place
+            for entry in os.listdir(staging):
+                target = os.path.join(extract_path, entry)
+                if os.path.isdir(target) and not os.path.islink(target):
+                    shutil.rmtree(target)
+                elif os.path.exists(target):
+                    os.remove(target)
+                os.replace(os.path.join(staging, entry), target)
+        finally:
+            shutil.rmtree(staging, ignore_errors=True)
+
+# file-like wrapper that hashes and counts the bytes read through it
+class _HashingReader:
+    def __init__(self, raw, file_hash, progress_bar):
+        self.raw = raw
+        self.file_hash = file_hash
+        self.progress_bar = progress_bar
+    
+    def read(self, size=-1):
+        data = self.raw.read(size)
+        if self.file_hash is not None:
+            self.file_hash.update(data)
+        self.progress_bar.update(len(data))
+        return data
 
 '''
 # find_matches
 ##############
 
-This function queries the database (arthropods_OrthoDB) to search for sequences 
-similar to the query sequence (query_path). Once found, it creates a file named
+This function queries the database (arthropods_OrthoDB, or the custom database 
+db_name made with create_targetDB) to search for sequences similar to the query sequence (query_path). Once found, it creates a file named
 best_matches.m8 containing similarity statistics with the query sequence, and
 it also adds metadata about the sequences in the table (in addition to the 
 protein ID, it adds species, genome ID, gene ID, and protein description). All 
 created files will be saved in a folder with a chosen name (job_name). If this 
 function is executed and the database is not installed yet, it will download it
-and install it.
+and install it. The stages completed are recorded in the manifest of the job 
+(manifest.json), so running it again with the same query file resumes an 
+interrupted job, skipping the stages that are up to date. With streaming=True the results are processed by chunks of 
+'chunksize' rows (see stream_best_matches), which keeps the memory used flat 
+for searches returning a very large number of hits. With warm=True, the 
+database is kept in memory between searches (see warm_database), so repeated
+small searches skip reading it from disk. With incremental=True, 
+if the job folder already exists, only the sequences that are not yet in the
+job are searched and their hits are added to the results (see 
+find_new_matches). mmseqs2 uses 'threads' threads (see resolve_threads). 
+Queries with the same sequence are searched only once, and their hits are 
+copied to all of them (see deduplicate_queries). With use_cache=True (False 
+by default), the hits of the sequences already searched by any job with the 
+same database and parameters are taken from the hit cache, and only the rest 
+are searched (see HitCache). With sharded=True, the shards of the database (see split_database) 
+are searched at the same time, in this machine or through a launcher (see 
+run_on_shards), and their results are merged before adding the metadata.
 '''
 
-def find_matches(job_name, query_path, evalue = 0.0000000001, min_seq_id = 0.7):
+def find_matches(job_name, query_path, evalue = 0.0000000001, min_seq_id = 0.7, streaming = False, chunksize = 500000, incremental = False, warm = False, threads = None, use_cache = False, sharded = False, launcher = None, db_name = "arthropods_OrthoDB"):
+    import pandas as pd
+    from Bio import SeqIO
         
     start_time = time.time()
+    timings = {}  # seconds spent in each stage
     verifying_mmseqs2() # verifies if mmseqs2 is installed
+    threads = resolve_threads(threads)
     
     # managing the database
-    db_name = "arthropods_OrthoDB"
-    
-    mmseqs_targetdir = pkg_resources.files("inprotfind").joinpath(f"databases/{db_name}")
-    metadata_targetdir = pkg_resources.files("inprotfind").joinpath(f"databases/{db_name}_metadata.parquet")
+    mmseqs_targetdir = database_path(db_name)
+    metadata_targetdir = database_path(f"{db_name}_metadata.parquet")
+    metadata_indexdir = database_path(f"{db_name}_metadata.arrow")
 
-    if not os.path.exists(mmseqs_targetdir):
+    if db_name != "arthropods_OrthoDB" and (not os.path.exists(f"{mmseqs_targetdir}/{db_name}DB") or not os.path.exists(metadata_targetdir)):
+        print(Fore.RED + Style.BRIGHT + f"The database '{db_name}' does not exist or it is corrupted. You may use the 'create_targetDB' function to create it.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    elif not os.path.exists(mmseqs_targetdir):
         print("The default database (arthropods_OrthoDB) is not yet installed or is corrupted. The database will be downloaded and installed now.")
         get_database(True)
     elif not os.path.exists(metadata_targetdir):
         print("The metadata file for the default database (arthropods_OrthoDB) is not yet installed or is corrupted. The database will be downloaded and installed now.")
         get_database(True)
+    elif not os.path.exists(metadata_indexdir):
+        # databases installed before the metadata index existed
+        print(Fore.GREEN + Style.BRIGHT + "Building the metadata index...")
+        build_metadata_index(db_name)
+    if not os.path.exists(f"{mmseqs_targetdir}/{db_name}DB.idx"):
+        print(Fore.RED + Style.BRIGHT + f"The database {db_name} has no precomputed index, so every search has to build it. Run 'create_index' once to build it.")
+    shards = load_shards(db_name) if sharded else None
+    if sharded and shards is None:
+        print(Fore.RED + Style.BRIGHT + f"The database {db_name} has not been split in shards, or it has changed since it was split. Run 'split_database' to split it.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    if sharded:
+        # each shard uses its share of the threads, unless the shards run in other nodes
+        shard_threads = threads if launcher or os.environ.get("INPROTFIND_LAUNCHER") else max(1, threads // shards["n_shards"])
           
     # setting directory's names for file storage
     mmseqs_workdir = job_name
@@ -207,12 +823,26 @@ def find_matches(job_name, query_path, evalue = 0.0000000001, min_seq_id = 0.7):
     elif(query_path == "example10"):
         query_path = pkg_resources.files("inprotfind").joinpath("query_examples/query_example10.fa")
     
+    # adding the new sequences to an existing job
+    if incremental and os.path.isdir(mmseqs_workdir):
+        find_new_matches(job_name, query_path, db_name, evalue, min_seq_id, warm, threads, streaming, chunksize, use_cache, sharded, launcher)
+        end_time = time.time()
+        print(Fore.GREEN + Style.BRIGHT + f"Searching for {job_name} complete in {end_time - start_time:.2f} seconds")
+        return
+    
+    stage_keys = find_matches_keys(query_path, db_name, evalue, min_seq_id, use_cache, shards)
+    manifest = load_manifest(mmseqs_workdir)
+    
     # checks if the directory with the job_name exists or not to create it
-    if os.path.isdir(mmseqs_workdir):
+    if os.path.isdir(mmseqs_workdir) and stage_is_current(manifest, "createdb", stage_keys["createdb"]):
+        # same query file: the job is resumed, redoing just the missing or outdated stages
+        print(Fore.GREEN + Style.BRIGHT + f"Resuming the job '{mmseqs_workdir}'. The stages already completed will be skipped.")
+    elif os.path.isdir(mmseqs_workdir):
         answer = input(Fore.RED + Style.BRIGHT + f"There is already a job folder named '{mmseqs_workdir}' in this directory. Do you want to replace it? ALL THE CURRENT FILES in the job folder will be ERASED (yes/no): ")
         if answer == "yes" or answer == "y":
             shutil.rmtree(mmseqs_workdir)
             os.mkdir(mmseqs_workdir)     
+            manifest = load_manifest(mmseqs_workdir)
             print(Fore.GREEN + Style.BRIGHT + "Previous job erased.")
         else:
             print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
@@ -230,79 +860,784 @@ def find_matches(job_name, query_path, evalue = 0.0000000001, min_seq_id = 0.7):
     if not os.path.isdir(mmseqs_tmp):
         os.mkdir(mmseqs_tmp)
     
+    metrics = JobMetrics(mmseqs_workdir, "find_matches")
+    
     # building the mmseqs2 query database
-    print(Fore.GREEN + Style.BRIGHT + "Converting query to mmseqs2 format...")
-    # Crear la base de datos MMseqs2
-    subprocess.run(f"mmseqs createdb {query_path} {mmseqs_querydir}/queryDB", shell=True)
+    stage_start = time.time()
+    metrics.begin("createdb")
+    if stage_is_current(manifest, "createdb", stage_keys["createdb"], [f"{mmseqs_querydir}/queryDB.index", f"{mmseqs_workdir}/query.fasta"]):
+        print(Fore.GREEN + Style.BRIGHT + "Query already converted to mmseqs2 format, skipping...")
+    else:
+        print(Fore.GREEN + Style.BRIGHT + "Converting query to mmseqs2 format...")
+        # removing the files of an interrupted run
+        previous_files = [f"{mmseqs_querydir}/{name}" for name in os.listdir(mmseqs_querydir)] + [f"{mmseqs_workdir}/query.fasta", f"{mmseqs_workdir}/query.idx", f"{mmseqs_workdir}/query_dedup.tsv"]
+        for path in previous_files:
+            if os.path.isfile(path):
+                os.remove(path)
+        
+        # the queries with the same sequence are searched just once (query_dedup.tsv)
+        query_records = list(SeqIO.parse(str(query_path), "fasta"))
+        unique_records, dedup_df = deduplicate_queries(query_records)
+        SeqIO.write(query_records, f"{mmseqs_workdir}/query.fasta", "fasta")
+        SeqIO.write(unique_records, f"{mmseqs_tmp}/unique_queries.fasta", "fasta")
+        dedup_df.to_csv(f"{mmseqs_workdir}/query_dedup.tsv", sep="\t", index=False)
+        if len(unique_records) < len(query_records):
+            print(Fore.GREEN + Style.BRIGHT + f"{len(query_records)} queries, {len(unique_records)} distinct sequences to search.")
+        
+        # Crear la base de datos MMseqs2
+        try:
+            _run_tool(["mmseqs", "createdb", f"{mmseqs_tmp}/unique_queries.fasta", f"{mmseqs_querydir}/queryDB"], metrics=metrics, stage="createdb", show_output=True)
+        except RuntimeError as error:
+            print(Fore.RED + Style.BRIGHT + str(error))
+            print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+            return
+        
+        # indexing the query sequences once for the rest of the stages
+        get_query_index(mmseqs_workdir).close()
+        record_stage(mmseqs_workdir, manifest, "createdb", stage_keys["createdb"], inputs={"query_path": str(query_path)}, seconds=time.time() - stage_start)
+    dedup_df = load_query_dedup(mmseqs_workdir)
+    n_unique = count_queries(mmseqs_querydir)
+    n_queries = n_unique if dedup_df is None else len(dedup_df)
+    timings["createdb"] = metrics.end("createdb", queries=n_queries, unique_queries=n_unique)
+    
+    # the results are up to date (the key of the last stage depends on all the previous ones)
+    if stage_is_current(manifest, "annotate", stage_keys["annotate"], [f"{mmseqs_workdir}/best_matches_all.m8", f"{mmseqs_workdir}/best_matches.parquet"]):
+        print(Fore.GREEN + Style.BRIGHT + f"Results already in {mmseqs_workdir}/best_matches_all.m8, skipping...")
+        return
 
     # executing mmseqs2 search in the database
-    subprocess.run(f"mmseqs search {mmseqs_querydir}/queryDB {mmseqs_targetdir}/{db_name}DB {mmseqs_resultdir}/resultDB {mmseqs_tmp} --max-seqs 100 -e {evalue} --min-seq-id {min_seq_id}", shell=True)
+    stage_start = time.time()
+    metrics.begin("search")
+    hit_cache = HitCache() if use_cache else None
+    try:
+        search_querydb = f"{mmseqs_querydir}/queryDB"
+        if stage_is_current(manifest, "search", stage_keys["search"], [f"{mmseqs_resultdir}/cached_hits.json"]):
+            print(Fore.GREEN + Style.BRIGHT + "Search already completed, skipping...")
+            if os.path.exists(f"{mmseqs_querydir}/searchDB.index"):
+                search_querydb = f"{mmseqs_querydir}/searchDB"
+        else:
+            # removing the files of an interrupted run
+            for name in os.listdir(mmseqs_querydir):
+                if name.startswith("searchDB"):
+                    os.remove(f"{mmseqs_querydir}/{name}")
+            for name in os.listdir(mmseqs_resultdir):
+                if name.startswith("resultDB") or name == "cached_hits.json":
+                    os.remove(f"{mmseqs_resultdir}/{name}")
+        
+            # taking from the cache the hits of the sequences already searched
+            query_index = get_query_index(mmseqs_workdir)
+            query_ids = list(dict.fromkeys(dedup_df["representative"])) if dedup_df is not None else list(query_index)
+            cached_hits = {}
+            searched = {query_id: None for query_id in query_ids}  # qseqid -> key in the cache
+            if hit_cache is not None:
+                searched = {query_id: hit_cache_key(query_index[query_id].seq, db_name, evalue, min_seq_id) for query_id in query_ids}
+                found = hit_cache.get(searched.values())
+                cached_hits = {query_id: found[key] for query_id, key in searched.items() if key in found}
+                searched = {query_id: key for query_id, key in searched.items() if key not in found}
+                print(Fore.GREEN + Style.BRIGHT + f"{len(cached_hits)} of {len(query_ids)} sequences found in the hit cache, {len(searched)} to search.")
+                if cached_hits and searched:
+                    SeqIO.write((query_index[query_id] for query_id in searched), f"{mmseqs_tmp}/search_queries.fasta", "fasta")
+                    search_querydb = f"{mmseqs_querydir}/searchDB"
+            query_index.close()
+        
+            try:
+                if search_querydb != f"{mmseqs_querydir}/queryDB":
+                    _run_tool(["mmseqs", "createdb", f"{mmseqs_tmp}/search_queries.fasta", search_querydb], metrics=metrics, stage="search")
+            except RuntimeError as error:
+                print(Fore.RED + Style.BRIGHT + str(error))
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                return
+        
+            if searched and warm and not sharded:
+                # keeping the database pages in memory for the next searches
+                warm_database(db_name)
+                timings["warm"] = metrics.end("search", warm=True)
+                stage_start = time.time()
+                metrics.begin("search")
+            try:
+                if searched and sharded:
+                    run_on_shards([["mmseqs", "search", search_querydb, shard_database(db_name, shard), f"{mmseqs_resultdir}/resultDB_shard{shard}", f"{mmseqs_tmp}/shard{shard}"] + search_options(evalue, min_seq_id, False, shard_threads).split() for shard in range(shards["n_shards"])], launcher, metrics, "search")
+                elif searched:
+                    _run_tool(["mmseqs", "search", search_querydb, f"{mmseqs_targetdir}/{db_name}DB", f"{mmseqs_resultdir}/resultDB", mmseqs_tmp] + search_options(evalue, min_seq_id, warm, threads).split(), metrics=metrics, stage="search", show_output=True)
+            except RuntimeError as error:
+                print(Fore.RED + Style.BRIGHT + str(error))
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                return
+            with open(f"{mmseqs_resultdir}/cached_hits.json", "w") as cached_file:
+                json.dump({"hits": cached_hits, "searched": searched}, cached_file)
+            record_stage(mmseqs_workdir, manifest, "search", stage_keys["search"], inputs={"db_name": db_name}, params={"evalue": evalue, "min_seq_id": min_seq_id, "max_seqs": 100, "warm": warm, "shards": shards["n_shards"] if sharded else None}, seconds=time.time() - stage_start)
+        cached_hits_df, searched = read_cached_hits(f"{mmseqs_resultdir}/cached_hits.json")
+        timings["search"] = metrics.end("search", queries=len(searched), cache_hits=n_unique - len(searched))
     
-    print(Fore.GREEN + Style.BRIGHT + "Passing results to table and adding metadata...")
-    # transforming results to tabular format
-    subprocess.run(f"mmseqs convertalis {mmseqs_querydir}/queryDB {mmseqs_targetdir}/{db_name}DB {mmseqs_resultdir}/resultDB {mmseqs_tmp}/best_matches_tmp.m8", shell=True)
+        print(Fore.GREEN + Style.BRIGHT + "Passing results to table and adding metadata...")
+        # transforming results to tabular format
+        stage_start = time.time()
+        metrics.begin("convertalis")
+        if not stage_is_current(manifest, "convertalis", stage_keys["convertalis"], [f"{mmseqs_tmp}/best_matches_tmp.m8"]):
+            try:
+                if searched and sharded:
+                    run_on_shards([["mmseqs", "convertalis", search_querydb, shard_database(db_name, shard), f"{mmseqs_resultdir}/resultDB_shard{shard}", f"{mmseqs_tmp}/best_matches_shard{shard}.m8", "--threads", str(shard_threads)] for shard in range(shards["n_shards"])], launcher, metrics, "convertalis")
+                    # one table with the best hits of the whole database
+                    merge_shard_hits([f"{mmseqs_tmp}/best_matches_shard{shard}.m8" for shard in range(shards["n_shards"])], shards["residues"], f"{mmseqs_tmp}/best_matches_tmp.m8", list(searched), evalue)
+                elif searched:
+                    _run_tool(["mmseqs", "convertalis", search_querydb, f"{mmseqs_targetdir}/{db_name}DB", f"{mmseqs_resultdir}/resultDB", f"{mmseqs_tmp}/best_matches_tmp.m8", "--threads", str(threads)], metrics=metrics, stage="convertalis", show_output=True)
+                else:
+                    # all the hits were in the cache
+                    open(f"{mmseqs_tmp}/best_matches_tmp.m8", "w").close()
+            except RuntimeError as error:
+                print(Fore.RED + Style.BRIGHT + str(error))
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                return
+            record_stage(mmseqs_workdir, manifest, "convertalis", stage_keys["convertalis"], seconds=time.time() - stage_start)
+        timings["convertalis"] = metrics.end("convertalis", queries=len(searched))
+        stage_start = time.time()
+        metrics.begin("annotate")
 
-    if not os.path.exists(f"{mmseqs_tmp}/best_matches_tmp.m8"):
-        no_matches = "None of the sequences in the database match with the query sequence"
-        with open(f"{mmseqs_workdir}/no_matches.txt", 'w') as file:
-            file.write(no_matches)
-            print(Fore.RED + Style.BRIGHT + no_matches)
-            print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
-            return
-    elif os.path.getsize(f"{mmseqs_tmp}/best_matches_tmp.m8") == 0:
-        no_matches = "None of the sequences in the database match with the query sequence"
-        with open(f"{mmseqs_workdir}/no_matches.txt", 'w') as file:
-            file.write(no_matches)
-            print(Fore.RED + Style.BRIGHT + no_matches)
+        if not os.path.exists(f"{mmseqs_tmp}/best_matches_tmp.m8"):
+            no_matches = "None of the sequences in the database match with the query sequence"
+            with open(f"{mmseqs_workdir}/no_matches.txt", 'w') as file:
+                file.write(no_matches)
+                print(Fore.RED + Style.BRIGHT + no_matches)
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                metrics.finish(queries=n_queries, queries_with_hits=0, hits=0)
+                return
+        elif os.path.getsize(f"{mmseqs_tmp}/best_matches_tmp.m8") == 0 and cached_hits_df.empty:
+            if hit_cache is not None:
+                hit_cache.put({key: [] for key in searched.values()})
+            no_matches = "None of the sequences in the database match with the query sequence"
+            with open(f"{mmseqs_workdir}/no_matches.txt", 'w') as file:
+                file.write(no_matches)
+                print(Fore.RED + Style.BRIGHT + no_matches)
+                print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+                metrics.finish(queries=n_queries, queries_with_hits=0, hits=0)
+                return
+        else:
+            stored = set()  # keys saved in the cache
+            if streaming:
+                # collecting the hits of each chunk (the hits of a query may be in several chunks)
+                entries = {}
+                def collect_chunk(chunk):
+                    collect_hits(chunk, searched, entries)
+            
+                # reading, annotating and saving the results by chunks
+                n_hits, n_queries_with_hits = stream_best_matches(f"{mmseqs_tmp}/best_matches_tmp.m8", mmseqs_workdir, db_name, chunksize=chunksize, dedup_df=dedup_df, extra_hits_df=cached_hits_df, on_chunk=collect_chunk if hit_cache is not None else None)
+                # saving in the cache the whole hit list of each query at once
+                if hit_cache is not None:
+                    hit_cache.put(entries)
+                    stored = set(entries)
+            else:
+                if os.path.getsize(f"{mmseqs_tmp}/best_matches_tmp.m8") > 0:
+                    # reading the results
+                    best_matches_df_all = pd.read_csv(f"{mmseqs_tmp}/best_matches_tmp.m8", sep="\t", header=None, dtype={0: str, 1: str})
+                
+                    # adding the metadata of the hits to the result file
+                    annotate_hits(best_matches_df_all, db_name)
+                
+                    # adding header to result file
+                    best_matches_df_all.columns = BEST_MATCHES_HEADER
+                    if hit_cache is not None:
+                        stored = store_hits(hit_cache, best_matches_df_all, searched)
+                    best_matches_df_all = pd.concat([best_matches_df_all, cached_hits_df], ignore_index=True) if not cached_hits_df.empty else best_matches_df_all
+                else:
+                    best_matches_df_all = cached_hits_df
+            
+                # copying the hits to the queries with the same sequence (in the order of the queries)
+                best_matches_df_all = fan_out_hits(best_matches_df_all, dedup_df)
+            
+                # saving result file as best_matches_all.m8 and best_matches.m8 (and parquet)
+                save_best_matches(best_matches_df_all, mmseqs_workdir)
+                n_hits, n_queries_with_hits = len(best_matches_df_all), best_matches_df_all["qseqid"].nunique()
+        
+            if hit_cache is not None:
+                # the sequences with no hits are cached too
+                hit_cache.put({key: [] for key in searched.values() if key not in stored})
+                if hit_cache.stats["hits"] + hit_cache.stats["misses"]:
+                    print(Fore.GREEN + Style.BRIGHT + f"Hit cache: {hit_cache.stats['hits']} hits, {hit_cache.stats['misses']} misses ({hit_cache.hit_rate():.1%} hit rate), {hit_cache.stats['evicted']} entries evicted.")
+        
+            # saving database_name to a file (not longer necessary)
+            with open(f"{mmseqs_workdir}/db_name.txt", "w") as file:
+                file.write(db_name)
+            record_stage(mmseqs_workdir, manifest, "annotate", stage_keys["annotate"], params={"streaming": streaming}, seconds=time.time() - stage_start)
+            timings["annotate"] = metrics.end("annotate", queries=n_queries, queries_with_hits=n_queries_with_hits, hits=n_hits)
+        
+            # cleaning temporal files
+            if os.path.exists(mmseqs_tmp):
+                shutil.rmtree(mmseqs_tmp)
+                print(Fore.GREEN + Style.BRIGHT + f"Temporal folder {mmseqs_tmp} removed.")
+            else:
+                print(Fore.GREEN + Style.BRIGHT + f"Temporal folder {mmseqs_tmp} does not exist or has already been removed.")
+        
+            end_time = time.time()     
+            metrics.finish(queries=n_queries, queries_with_hits=n_queries_with_hits, hits=n_hits, cache_hits=n_unique - len(searched), cache_misses=len(searched))
+
+            # DONE
+            print(Back.GREEN + Fore.BLACK + f"Done! You can find all the matches in '{mmseqs_workdir}/best_matches_all.m8', and just the first 30 in '{mmseqs_workdir}/best_matches.m8'")
+            print(Fore.GREEN + Style.BRIGHT + f"Searching for {job_name} complete in {end_time - start_time:.2f} seconds")
+            print(Fore.GREEN + Style.BRIGHT + "Time per stage: " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in timings.items()))
+    finally:
+        if hit_cache is not None:
+            hit_cache.close()
+
+# keys of the stages: each one depends on its inputs, its parameters and the previous stage
+def find_matches_keys(query_path, db_name, evalue, min_seq_id, use_cache, shards=None):
+    stage_keys = {}
+    stage_keys["createdb"] = manifest_key(file_hash(query_path))
+    # the hits taken from the cache are already annotated, so with the cache the search depends on the metadata too
+    stage_keys["search"] = manifest_key(stage_keys["createdb"], database_stamp(db_name), evalue, min_seq_id, 100, *([database_stamp(db_name, metadata=True)] if use_cache else []), *([shards["residues"]] if shards is not None else []))
+    stage_keys["convertalis"] = manifest_key(stage_keys["search"])
+    stage_keys["annotate"] = manifest_key(stage_keys["convertalis"], database_stamp(db_name, metadata=True))
+    return stage_keys
+
+
+'''
+# find_new_matches
+##################
+
+This function adds to an existing job the query sequences of 'query_path' that
+are not in the job yet, or whose sequence changed. Only these sequences are 
+searched in the database, with the same options as find_matches (hit cache, 
+shards, warm database and streaming), and their hits replace/extend the ones 
+in best_matches_all and best_matches. With streaming=True the previous hits 
+are read back by chunks too (_previous_hit_chunks). The alignments and trees 
+of the queries whose sequence changed are removed (they are outdated), while 
+the rest of alignments and trees are not touched. Finally, the queryDB and the
+query index of the job are updated to include all the sequences, and the 
+manifest records the job as made from query_path, so running find_matches 
+again with the same file finds the results up to date. The search results of
+the previous queries (resultDB) are removed, as they do not hold the new ones.
+'''
+
+def find_new_matches(job_name, query_path, db_name, evalue, min_seq_id, warm=False, threads=None, streaming=False, chunksize=500000, use_cache=False, sharded=False, launcher=None):
+    import pandas as pd
+    from Bio import SeqIO
+    
+    mmseqs_workdir = job_name
+    mmseqs_targetdir = database_path(db_name)
+    mmseqs_tmp = mmseqs_workdir + "/tmp"
+    threads = resolve_threads(threads)
+    shards = load_shards(db_name) if sharded else None
+    if sharded and shards is None:
+        print(Fore.RED + Style.BRIGHT + f"The database {db_name} has not been split in shards, or it has changed since it was split. Run 'split_database' to split it.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    if sharded:
+        shard_threads = threads if launcher or os.environ.get("INPROTFIND_LAUNCHER") else max(1, threads // shards["n_shards"])
+    
+    # comparing the query file with the sequences already in the job
+    query_index = get_query_index(mmseqs_workdir)
+    known_records = {query_id: query_index[query_id] for query_id in query_index}
+    query_index.close()
+    
+    new_records = []
+    changed_ids = set()
+    for record in SeqIO.parse(str(query_path), "fasta"):
+        if record.id not in known_records:
+            new_records.append(record)
+        elif str(known_records[record.id].seq) != str(record.seq):
+            new_records.append(record)
+            changed_ids.add(record.id)
+    
+    if not new_records:
+        print(Fore.GREEN + Style.BRIGHT + f"All the sequences in {query_path} are already in {job_name}. Nothing to search.")
+        return
+    print(Fore.GREEN + Style.BRIGHT + f"Searching {len(new_records)} new sequences ({len(changed_ids)} of them changed) out of {len(known_records)} already in {job_name}...")
+    
+    # searching only the new sequences
+    metrics = JobMetrics(mmseqs_workdir, "find_new_matches")
+    metrics.begin("search")
+    os.makedirs(mmseqs_tmp, exist_ok=True)
+    unique_records, new_dedup_df = deduplicate_queries(new_records)
+    hit_cache = HitCache() if use_cache else None
+    try:
+        # taking from the cache the hits of the sequences already searched
+        cached_hits = {}
+        searched = {record.id: None for record in unique_records}  # qseqid -> key in the cache
+        if hit_cache is not None:
+            searched = {record.id: hit_cache_key(record.seq, db_name, evalue, min_seq_id) for record in unique_records}
+            found = hit_cache.get(searched.values())
+            cached_hits = {query_id: found[key] for query_id, key in searched.items() if key in found}
+            searched = {query_id: key for query_id, key in searched.items() if key not in found}
+            print(Fore.GREEN + Style.BRIGHT + f"{len(cached_hits)} of {len(unique_records)} sequences found in the hit cache, {len(searched)} to search.")
+        with open(f"{mmseqs_tmp}/cached_hits.json", "w") as cached_file:
+            json.dump({"hits": cached_hits, "searched": searched}, cached_file)
+        cached_hits_df, _ = read_cached_hits(f"{mmseqs_tmp}/cached_hits.json")
+        
+        try:
+            if searched:
+                SeqIO.write((record for record in unique_records if record.id in searched), f"{mmseqs_tmp}/new_queries.fasta", "fasta")
+                _run_tool(["mmseqs", "createdb", f"{mmseqs_tmp}/new_queries.fasta", f"{mmseqs_tmp}/newQueryDB"], metrics=metrics, stage="search")
+            if searched and sharded:
+                run_on_shards([["mmseqs", "search", f"{mmseqs_tmp}/newQueryDB", shard_database(db_name, shard), f"{mmseqs_tmp}/newResultDB_shard{shard}", f"{mmseqs_tmp}/shard{shard}"] + search_options(evalue, min_seq_id, False, shard_threads).split() for shard in range(shards["n_shards"])], launcher, metrics, "search")
+                run_on_shards([["mmseqs", "convertalis", f"{mmseqs_tmp}/newQueryDB", shard_database(db_name, shard), f"{mmseqs_tmp}/newResultDB_shard{shard}", f"{mmseqs_tmp}/best_matches_new_shard{shard}.m8", "--threads", str(shard_threads)] for shard in range(shards["n_shards"])], launcher, metrics, "search")
+                merge_shard_hits([f"{mmseqs_tmp}/best_matches_new_shard{shard}.m8" for shard in range(shards["n_shards"])], shards["residues"], f"{mmseqs_tmp}/best_matches_new.m8", list(searched), evalue)
+            elif searched:
+                if warm:
+                    warm_database(db_name)
+                _run_tool(["mmseqs", "search", f"{mmseqs_tmp}/newQueryDB", f"{mmseqs_targetdir}/{db_name}DB", f"{mmseqs_tmp}/newResultDB", f"{mmseqs_tmp}/search"] + search_options(evalue, min_seq_id, warm, threads).split(), metrics=metrics, stage="search")
+                _run_tool(["mmseqs", "convertalis", f"{mmseqs_tmp}/newQueryDB", f"{mmseqs_targetdir}/{db_name}DB", f"{mmseqs_tmp}/newResultDB", f"{mmseqs_tmp}/best_matches_new.m8", "--threads", str(threads)], metrics=metrics, stage="search")
+            else:
+                # all the hits were in the cache
+                open(f"{mmseqs_tmp}/best_matches_new.m8", "w").close()
+        except RuntimeError as e:
+            print(Fore.RED + Style.BRIGHT + str(e))
             print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
             return
-    else:
-        # reading the metadata of the database and the results
-        meta_df = pd.read_parquet(str(metadata_targetdir))
-        best_matches_df_all = pd.read_csv(f"{mmseqs_tmp}/best_matches_tmp.m8", sep="\t", header=None)
-        
-        # adding the metadata to the result file
-        code_to_organism = meta_df.set_index('ID')['Organism'].to_dict()
-        code_to_genomeid = meta_df.set_index('ID')['GenomeID'].to_dict()
-        code_to_pubprotid = meta_df.set_index('ID')['PubProtID'].to_dict()
-        code_to_pubgeneid = meta_df.set_index('ID')['PubGeneID'].to_dict()
-        code_to_description = meta_df.set_index('ID')['Description'].to_dict()
-
-        best_matches_df_all['Organism'] = best_matches_df_all[1].map(code_to_organism)
-        best_matches_df_all['GenomeID'] = best_matches_df_all[1].map(code_to_genomeid)
-        best_matches_df_all['PubProtID'] = best_matches_df_all[1].map(code_to_pubprotid)
-        best_matches_df_all['PubGeneID'] = best_matches_df_all[1].map(code_to_pubgeneid)
-        best_matches_df_all['Description'] = best_matches_df_all[1].map(code_to_description)
-        
-        # adding header to result file
-        header = ["qseqid", "tseqid","pident", "length", "mismatch", "gapopen", "qstart", "qend", "tstart", "tend", "evalue", "bitscore", "organism", "genomeid", "proteinid", "geneid", "description"]
-        best_matches_df_all.columns = header
-        
-        # saving result file as best_matches_all.m8 and best_matches.m8
-        best_matches_df_all.to_csv(f"{mmseqs_workdir}/best_matches_all.m8", sep="\t", index=False, header=True)
-        best_matches_df = best_matches_df_all.groupby('qseqid').head(30).reset_index(drop=True)
-        best_matches_df.to_csv(f"{mmseqs_workdir}/best_matches.m8", sep="\t", index=False, header=True)
-        
-        # saving database_name to a file (not longer necessary)
-        with open(f"{mmseqs_workdir}/db_name.txt", "w") as file:
-            file.write(db_name)
-        
-        # cleaning temporal files
-        if os.path.exists(mmseqs_tmp):
-            shutil.rmtree(mmseqs_tmp)
-            print(Fore.GREEN + Style.BRIGHT + f"Temporal folder {mmseqs_tmp} removed.")
-        else:
-            print(Fore.GREEN + Style.BRIGHT + f"Temporal folder {mmseqs_tmp} does not exist or has already been removed.")
+        metrics.end("search", queries=len(new_records), unique_queries=len(unique_records), cache_hits=len(cached_hits))
+        metrics.begin("annotate")
         
-        end_time = time.time()     
+        # merging the new hits with the previous ones
+        stored = set()  # keys saved in the cache
+        if streaming:
+            # collecting the hits of each chunk (the hits of a query may be in several chunks)
+            entries = {}
+            def collect_chunk(chunk):
+                collect_hits(chunk, searched, entries)
+            
+            # the previous results are moved away, as they are read while the new ones are written
+            moved = []
+            for name in ["best_matches_all.parquet", "best_matches_all.m8"]:
+                if os.path.exists(f"{mmseqs_workdir}/{name}"):
+                    os.replace(f"{mmseqs_workdir}/{name}", f"{mmseqs_tmp}/previous_{name}")
+                    moved.append(name)
+            previous_counts = {"hits": 0, "queries": set()}
+            try:
+                n_hits, n_queries_with_hits = stream_best_matches(f"{mmseqs_tmp}/best_matches_new.m8", mmseqs_workdir, db_name, chunksize=chunksize, dedup_df=new_dedup_df, extra_hits_df=cached_hits_df,
+                                                                  on_chunk=collect_chunk if hit_cache is not None else None, previous_chunks=_previous_hit_chunks(mmseqs_tmp, changed_ids, chunksize, previous_counts))
+            except Exception:
+                for name in moved:
+                    os.replace(f"{mmseqs_tmp}/previous_{name}", f"{mmseqs_workdir}/{name}")
+                raise
+            # saving in the cache the whole hit list of each query at once
+            if hit_cache is not None:
+                hit_cache.put(entries)
+                stored = set(entries)
+            n_new_hits, n_new_with_hits = n_hits - previous_counts["hits"], n_queries_with_hits - len(previous_counts["queries"])
+            n_total_hits = n_hits
+        else:
+            if os.path.getsize(f"{mmseqs_tmp}/best_matches_new.m8") > 0:
+                new_matches_df = pd.read_csv(f"{mmseqs_tmp}/best_matches_new.m8", sep="\t", header=None, dtype={0: str, 1: str})
+                annotate_hits(new_matches_df, db_name)
+                new_matches_df.columns = BEST_MATCHES_HEADER
+                if hit_cache is not None:
+                    stored = store_hits(hit_cache, new_matches_df, searched)
+                new_matches_df = pd.concat([new_matches_df, cached_hits_df], ignore_index=True) if not cached_hits_df.empty else new_matches_df
+            else:
+                new_matches_df = cached_hits_df
+            new_matches_df = fan_out_hits(new_matches_df, new_dedup_df)
+            
+            if os.path.exists(f"{mmseqs_workdir}/best_matches_all.m8"):
+                previous_df = read_best_matches(mmseqs_workdir, all_hits=True)
+                previous_df = previous_df[~previous_df["qseqid"].isin(changed_ids)]
+                best_matches_df_all = pd.concat([previous_df, new_matches_df], ignore_index=True)
+            else:
+                best_matches_df_all = new_matches_df
+            save_best_matches(best_matches_df_all, mmseqs_workdir)
+            n_new_hits, n_new_with_hits = len(new_matches_df), new_matches_df["qseqid"].nunique()
+            n_total_hits = len(best_matches_df_all)
+        if hit_cache is not None:
+            # the sequences with no hits are cached too
+            hit_cache.put({key: [] for key in searched.values() if key not in stored})
+    finally:
+        if hit_cache is not None:
+            hit_cache.close()
+    print(Fore.GREEN + Style.BRIGHT + f"{n_new_with_hits} of the new sequences have matches in the database")
+    metrics.end("annotate", queries=len(new_records), queries_with_hits=n_new_with_hits, hits=n_new_hits)
+    
+    # removing the outdated alignments and trees
+    for query_id in changed_ids:
+        for outdated in [f"{mmseqs_workdir}/alignments/{query_id}_aligned.fasta", f"{mmseqs_workdir}/alignments/{query_id}_sequences.fasta", f"{mmseqs_workdir}/trees/{query_id}_tree.nwk"]:
+            if os.path.exists(outdated):
+                os.remove(outdated)
+    
+    # updating the queryDB and the query index with all the sequences
+    for record in new_records:
+        known_records[record.id] = record
+    SeqIO.write(known_records.values(), f"{mmseqs_workdir}/query.fasta", "fasta")
+    unique_records, dedup_df = deduplicate_queries(known_records.values())
+    SeqIO.write(unique_records, f"{mmseqs_tmp}/unique_queries.fasta", "fasta")
+    dedup_df.to_csv(f"{mmseqs_workdir}/query_dedup.tsv", sep="\t", index=False)
+    if os.path.exists(f"{mmseqs_workdir}/query.idx"):
+        os.remove(f"{mmseqs_workdir}/query.idx")
+    shutil.rmtree(f"{mmseqs_workdir}/queryDB")
+    os.mkdir(f"{mmseqs_workdir}/queryDB")
+    _run_tool(["mmseqs", "createdb", f"{mmseqs_tmp}/unique_queries.fasta", f"{mmseqs_workdir}/queryDB/queryDB"], metrics=metrics, stage="createdb")
+    get_query_index(mmseqs_workdir).close()
+    
+    if os.path.exists(f"{mmseqs_workdir}/no_matches.txt") and n_total_hits > 0:
+        os.remove(f"{mmseqs_workdir}/no_matches.txt")
+    with open(f"{mmseqs_workdir}/db_name.txt", "w") as file:
+        file.write(db_name)
+    
+    # the job is now the one of query_path: the search results of the previous queries are outdated
+    if os.path.isdir(f"{mmseqs_workdir}/resultDB"):
+        for name in os.listdir(f"{mmseqs_workdir}/resultDB"):
+            os.remove(f"{mmseqs_workdir}/resultDB/{name}")
+    stage_keys = find_matches_keys(query_path, db_name, evalue, min_seq_id, use_cache, shards)
+    manifest = update_manifest(mmseqs_workdir, "stages", {"search": None, "convertalis": None})
+    record_stage(mmseqs_workdir, manifest, "createdb", stage_keys["createdb"], inputs={"query_path": str(query_path)})
+    record_stage(mmseqs_workdir, manifest, "annotate", stage_keys["annotate"], params={"streaming": streaming, "incremental": True})
+    
+    shutil.rmtree(mmseqs_tmp, ignore_errors=True)
+    metrics.finish(queries=len(new_records), queries_with_hits=n_new_with_hits, hits=n_new_hits)
+    print(Back.GREEN + Fore.BLACK + f"Done! {len(new_records)} sequences added to '{mmseqs_workdir}/best_matches_all.m8' and '{mmseqs_workdir}/best_matches.m8'")
+
+# hits of the previous results of a job (moved to mmseqs_tmp), but the ones of exclude_ids, by chunks
+def _previous_hit_chunks(mmseqs_tmp, exclude_ids, chunksize, counts):
+    import pandas as pd
+    import pyarrow.parquet as pq
+    if os.path.exists(f"{mmseqs_tmp}/previous_best_matches_all.parquet"):
+        chunks = (batch.to_pandas() for batch in pq.ParquetFile(f"{mmseqs_tmp}/previous_best_matches_all.parquet").iter_batches(batch_size=chunksize))
+    elif os.path.exists(f"{mmseqs_tmp}/previous_best_matches_all.m8"):
+        chunks = pd.read_csv(f"{mmseqs_tmp}/previous_best_matches_all.m8", sep="\t", header=0, names=BEST_MATCHES_HEADER, dtype={"qseqid": str, "tseqid": str}, chunksize=chunksize)
+    else:
+        return
+    for chunk in chunks:
+        chunk = chunk[~chunk["qseqid"].isin(exclude_ids)].reset_index(drop=True)
+        counts["hits"] += len(chunk)
+        counts["queries"].update(chunk["qseqid"])
+        yield chunk
+
+
+'''
+# query deduplication functions
+###############################
+
+Query files often hold the same protein under several headers. 
+deduplicate_queries keeps the first record of every distinct sequence (the 
+representative, found by the hash of the sequence) and returns the table of 
+all the queries with their representative, which find_matches saves as 
+query_dedup.tsv. Only the representatives are searched, and fan_out_hits 
+copies their hits to every query with the same sequence. Identical queries 
+with the same homologs also get the same alignment and tree: share_alignment
+copies the alignment of the representative with the header of the other 
+query, and share_tree copies its tree renaming the query leaf. 
+alignment_share_key tells if two alignments are equal but for the query name
+(the query is always the first sequence of the alignment).
+'''
+
+def sequence_hash(sequence):
+    return hashlib.sha1(str(sequence).upper().encode()).hexdigest()
+
+def deduplicate_queries(records):
+    import pandas as pd
+    representatives = {}  # hash -> qseqid of the first query with that sequence
+    unique_records = []
+    rows = []
+    for record in records:
+        seq_hash = sequence_hash(record.seq)
+        if seq_hash not in representatives:
+            representatives[seq_hash] = record.id
+            unique_records.append(record)
+        rows.append((record.id, representatives[seq_hash], seq_hash))
+    return unique_records, pd.DataFrame(rows, columns=["qseqid", "representative", "sequence_hash"])
+
+def load_query_dedup(job_name):
+    import pandas as pd
+    if not os.path.exists(f"{job_name}/query_dedup.tsv"):
+        return None
+    return pd.read_csv(f"{job_name}/query_dedup.tsv", sep="\t", dtype=str)
+
+# hits_df has the BEST_MATCHES_HEADER columns; the copies are placed in the order of the queries
+def fan_out_hits(hits_df, dedup_df):
+    if dedup_df is None:
+        return hits_df
+    copies = dedup_df.groupby("representative", sort=False)["qseqid"].agg(list).to_dict()
+    position = {qseqid: i for i, qseqid in enumerate(dedup_df["qseqid"])}
+    hits_df = hits_df.assign(qseqid=hits_df["qseqid"].map(lambda qseqid: copies.get(qseqid, [qseqid]))).explode("qseqid")
+    hits_df["query_position"] = hits_df["qseqid"].map(position)
+    return hits_df.sort_values("query_position", kind="stable").drop(columns="query_position").reset_index(drop=True)
+
+def share_alignment(aligned_file, query_record, copy_file):
+    with open(aligned_file) as alignment:
+        alignment.readline()
+        aligned_text = alignment.read()
+    header = query_record.format("fasta").split("\n", 1)[0]
+    with open(copy_file + ".tmp", "w") as copy:
+        copy.write(header + "\n" + aligned_text)
+    os.replace(copy_file + ".tmp", copy_file)
+
+def share_tree(output_tree, query_id, copy_id, copy_tree):
+    with open(output_tree) as tree_file:
+        newick = tree_file.read()
+    leaf = re.compile(r"(?<=[(,])" + re.escape(query_id) + r"(?=[:,);])")
+    if len(leaf.findall(newick)) != 1:
+        raise ValueError(f"the leaf of {query_id} can not be found in {output_tree}")
+    with open(copy_tree + ".tmp", "w") as copy:
+        copy.write(leaf.sub(lambda match: copy_id, newick))
+    os.replace(copy_tree + ".tmp", copy_tree)
+
+def alignment_share_key(alignment_path):
+    with open(alignment_path, "rb") as alignment:
+        alignment.readline()
+        return hashlib.sha256(alignment.read()).hexdigest()
+
+
+'''
+# stream_best_matches
+#####################
+
+This function is the streaming alternative to the table processing done in 
+find_matches. It reads the mmseqs2 results (m8_path) by chunks of 'chunksize' 
+rows, adds the metadata to each chunk and appends it to best_matches_all.m8. 
+Meanwhile, it keeps in a small heap per query the 'top_n' best hits (lowest 
+e-value, then highest bitscore, then first found), which are written to 
+best_matches.m8 at the end. The memory used depends on the chunk size and the 
+number of queries, but not on the number of hits. For the parquet version of
+best_matches_all, each chunk is sorted by qseqid and saved as a run in a 
+temporal folder, and the runs are merged at the end (merge_sorted_hits), so 
+the file is sorted and indexed as the one written by find_matches. The 
+hits of each chunk are copied to the queries with the same sequence (dedup_df,
+see deduplicate_queries). The hits taken from the hit cache (extra_hits_df) 
+are processed as a last chunk, and the hits already in the job 
+(previous_chunks, see find_new_matches) before the first one, and on_chunk, if given, is called with every 
+chunk of new hits once annotated (find_matches uses it to fill the cache). It 
+returns the number of hits and the number of queries with hits.
+'''
+
+BEST_MATCHES_HEADER = ["qseqid", "tseqid","pident", "length", "mismatch", "gapopen", "qstart", "qend", "tstart", "tend", "evalue", "bitscore", "organism", "genomeid", "proteinid", "geneid", "description"]
+
+def stream_best_matches(m8_path, mmseqs_workdir, db_name, top_n=30, chunksize=500000, dedup_df=None, extra_hits_df=None, on_chunk=None, previous_chunks=None):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    heaps = {}  # qseqid -> heap with the best hits, the worst one at the top
+    first_found = {}  # qseqid -> position of its first hit
+    order = 0  # position of the hit in the mmseqs2 output, to break the ties
+    runs_dir = tempfile.mkdtemp(prefix="tmp_runs_", dir=mmseqs_workdir)
+    runs = []
+    
+    try:
+        with open(f"{mmseqs_workdir}/best_matches_all.m8", "w") as all_file:
+            all_file.write("\t".join(BEST_MATCHES_HEADER) + "\n")
+            
+            for chunk in _annotated_chunks(m8_path, db_name, chunksize, extra_hits_df, on_chunk, previous_chunks):
+                chunk = fan_out_hits(chunk, dedup_df)
+                chunk.to_csv(all_file, sep="\t", index=False, header=False)
+                
+                # each chunk is a sorted run of the parquet file
+                runs.append(f"{runs_dir}/{len(runs)}.parquet")
+                pq.write_table(pa.Table.from_pandas(chunk.sort_values("qseqid", kind="stable"), schema=best_matches_schema(), preserve_index=False), runs[-1])
+                
+                chunk["order"] = range(order, order + len(chunk))
+                order += len(chunk)
+                for qseqid, first in chunk.groupby("qseqid", sort=False)["order"].min().items():
+                    first_found.setdefault(qseqid, first)
+            
+                # only the top_n of each query in the chunk can reach the heaps
+                chunk = chunk.sort_values(["qseqid", "evalue", "bitscore", "order"], ascending=[True, True, False, True], kind="stable")
+                chunk = chunk.groupby("qseqid", sort=False).head(top_n)
+            
+                for row in chunk.itertuples(index=False, name=None):
+                    key = (-row[10], row[11], -row[-1])
+                    heap = heaps.setdefault(row[0], [])
+                    if len(heap) < top_n:
+                        heapq.heappush(heap, (key, row[:-1]))
+                    elif key > heap[0][0]:
+                        heapq.heapreplace(heap, (key, row[:-1]))
         
-        # saving processing time in a file, just if want to have a log of it
-        with open("processing_time.txt", 'a') as archivo:
-            archivo.writelines(f"Searching for {job_name} complete in {end_time - start_time:.2f} seconds.\n")
+        merge_sorted_hits(runs, f"{mmseqs_workdir}/best_matches_all.parquet")
+    finally:
+        shutil.rmtree(runs_dir, ignore_errors=True)
+    
+    # queries are written in the order they were first found
+    rows = []
+    for qseqid in sorted(heaps, key=first_found.get):
+        rows.extend(row for key, row in sorted(heaps[qseqid], key=lambda item: item[0], reverse=True))
+    best_matches_df = pd.DataFrame(rows, columns=BEST_MATCHES_HEADER)
+    best_matches_df.to_csv(f"{mmseqs_workdir}/best_matches.m8", sep="\t", index=False, header=True)
+    write_best_matches_parquet(best_matches_df, f"{mmseqs_workdir}/best_matches.parquet")
+    return order, len(heaps)
 
-        # DONE
-        print(Back.GREEN + Fore.BLACK + f"Done! You can find all the matches in '{mmseqs_workdir}/best_matches_all.m8', and just the first 30 in '{mmseqs_workdir}/best_matches.m8'")
-        print(Fore.GREEN + Style.BRIGHT + f"Searching for {job_name} complete in {end_time - start_time:.2f} seconds")
+# chunks of the mmseqs2 results with the metadata added, after the previous chunks and followed by the extra hits (both already annotated)
+def _annotated_chunks(m8_path, db_name, chunksize, extra_hits_df=None, on_chunk=None, previous_chunks=None):
+    import pandas as pd
+    if previous_chunks is not None:
+        yield from previous_chunks
+    if os.path.getsize(m8_path) > 0:
+        for chunk in pd.read_csv(m8_path, sep="\t", header=None, dtype={0: str, 1: str}, chunksize=chunksize):
+            annotate_hits(chunk, db_name)
+            chunk.columns = BEST_MATCHES_HEADER
+            if on_chunk is not None:
+                on_chunk(chunk)
+            yield chunk
+    if extra_hits_df is not None:
+        for first in range(0, len(extra_hits_df), chunksize):
+            yield extra_hits_df.iloc[first:first + chunksize].reset_index(drop=True)
+
+
+'''
+# parquet results functions
+###########################
+
+Besides the .m8 tables, find_matches saves the results as typed parquet files
+(best_matches.parquet and best_matches_all.parquet) sorted by qseqid, so each
+row group holds a narrow range of queries. read_best_matches reads them 
+loading only the requested columns and the row groups that may contain the 
+requested queries (query_id may be one id or a list of them). Jobs created 
+before the parquet files existed are read from the .m8 tables. 
+save_best_matches saves a table with all the hits as best_matches_all and its
+'top_n' first hits per query as best_matches, in both formats. 
+best_matches_schema returns the types of the columns of the parquet files.
+
+Every parquet file written sorted by qseqid gets an index (<file>_index.parquet)
+with one row per query: its first row and number of hits in the parquet file,
+plus a summary of its hits (best e-value and bitscore, highest identity, and 
+organism and description of its first hit). With the index, the rows of a few
+queries are read from the row groups that hold them, with no scan of the rest
+of the file. merge_sorted_hits writes such a file and its index from parquet
+files already sorted by qseqid (the runs of stream_best_matches), reading 
+the hits of one query of each run at a time. read_best_matches_summary returns the index (computed from the 
+results for jobs without it).
+'''
+
+@functools.lru_cache(maxsize=None)
+def best_matches_schema():
+    import pyarrow as pa
+    return pa.schema([
+        ("qseqid", pa.string()), ("tseqid", pa.string()), ("pident", pa.float64()),
+        ("length", pa.int64()), ("mismatch", pa.int64()), ("gapopen", pa.int64()),
+        ("qstart", pa.int64()), ("qend", pa.int64()), ("tstart", pa.int64()), ("tend", pa.int64()),
+        ("evalue", pa.float64()), ("bitscore", pa.float64()), ("organism", pa.string()),
+        ("genomeid", pa.string()), ("proteinid", pa.string()), ("geneid", pa.string()),
+        ("description", pa.string())])
+
+def save_best_matches(best_matches_df_all, mmseqs_workdir, top_n=30):
+    best_matches_df_all.to_csv(f"{mmseqs_workdir}/best_matches_all.m8", sep="\t", index=False, header=True)
+    best_matches_df = best_matches_df_all.groupby('qseqid', sort=False).head(top_n).reset_index(drop=True)
+    best_matches_df.to_csv(f"{mmseqs_workdir}/best_matches.m8", sep="\t", index=False, header=True)
+    
+    # saving both tables also in parquet format, sorted by qseqid
+    write_best_matches_parquet(best_matches_df_all, f"{mmseqs_workdir}/best_matches_all.parquet")
+    write_best_matches_parquet(best_matches_df, f"{mmseqs_workdir}/best_matches.parquet")
+    return best_matches_df
+
+def write_best_matches_parquet(best_matches_df, path, row_group_size=100000):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    best_matches_df = best_matches_df.sort_values("qseqid", kind="stable")
+    table = pa.Table.from_pandas(best_matches_df, schema=best_matches_schema(), preserve_index=False)
+    pq.write_table(table, path, row_group_size=row_group_size)
+    summarize_best_matches(best_matches_df).to_parquet(best_matches_index_path(path), index=False)
+
+def merge_sorted_hits(runs, path, row_group_size=100000):
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    
+    # hits of each query in a run, in order (a query may be split between batches)
+    def groups(run):
+        for batch in pq.ParquetFile(run).iter_batches(batch_size=row_group_size):
+            yield from batch.to_pandas().groupby("qseqid", sort=False)
+    
+    index_rows = []
+    pending = []
+    pending_rows = 0
+    n_rows = 0
+    with pq.ParquetWriter(path, best_matches_schema()) as writer:
+        # stable: the hits of a query keep the order of the runs
+        for qseqid, hits in heapq.merge(*[groups(run) for run in runs], key=lambda group: group[0]):
+            summary = {"qseqid": qseqid, "first_row": n_rows, "hits": len(hits), "best_evalue": hits["evalue"].min(), "best_bitscore": hits["bitscore"].max(),
+                       "max_pident": hits["pident"].max(), "top_organism": hits["organism"].dropna().iloc[0] if hits["organism"].notna().any() else None,
+                       "top_description": hits["description"].dropna().iloc[0] if hits["description"].notna().any() else None}
+            if index_rows and index_rows[-1]["qseqid"] == qseqid:
+                previous = index_rows[-1]
+                previous.update(hits=previous["hits"] + summary["hits"], best_evalue=min(previous["best_evalue"], summary["best_evalue"]),
+                                best_bitscore=max(previous["best_bitscore"], summary["best_bitscore"]), max_pident=max(previous["max_pident"], summary["max_pident"]),
+                                top_organism=previous["top_organism"] if previous["top_organism"] is not None else summary["top_organism"],
+                                top_description=previous["top_description"] if previous["top_description"] is not None else summary["top_description"])
+            else:
+                index_rows.append(summary)
+            pending.append(hits)
+            pending_rows += len(hits)
+            n_rows += len(hits)
+            if pending_rows >= row_group_size:
+                writer.write_table(pa.Table.from_pandas(pd.concat(pending), schema=best_matches_schema(), preserve_index=False), row_group_size=row_group_size)
+                pending = []
+                pending_rows = 0
+        if pending or not n_rows:
+            writer.write_table(pa.Table.from_pandas(pd.concat(pending) if pending else pd.DataFrame(columns=BEST_MATCHES_HEADER), schema=best_matches_schema(), preserve_index=False))
+    
+    index_columns = ["qseqid", "first_row", "hits", "best_evalue", "best_bitscore", "max_pident", "top_organism", "top_description"]
+    pd.DataFrame(index_rows, columns=index_columns).to_parquet(best_matches_index_path(path), index=False)
+    return n_rows
+
+def best_matches_index_path(path):
+    return path[:-len(".parquet")] + "_index.parquet"
+
+# one row per query (best_matches_df must be sorted by qseqid)
+def summarize_best_matches(best_matches_df):
+    best_matches_df = best_matches_df.reset_index(drop=True)
+    best_matches_df["row"] = best_matches_df.index
+    return best_matches_df.groupby("qseqid", sort=False).agg(
+        first_row=("row", "min"), hits=("row", "size"), best_evalue=("evalue", "min"), best_bitscore=("bitscore", "max"),
+        max_pident=("pident", "max"), top_organism=("organism", "first"), top_description=("description", "first")).reset_index()
+
+# the index is valid if it was written after its parquet file
+def _current_index(parquet_path):
+    index_path = best_matches_index_path(parquet_path)
+    if os.path.exists(index_path) and os.path.getmtime(index_path) >= os.path.getmtime(parquet_path):
+        return index_path
+    return None
+
+def read_best_matches(job_name, query_id=None, columns=None, all_hits=False):
+    import pandas as pd
+    file_name = "best_matches_all" if all_hits else "best_matches"
+    query_ids = None
+    if query_id is not None:
+        query_ids = [query_id] if isinstance(query_id, str) else list(query_id)
+    
+    if os.path.exists(f"{job_name}/{file_name}.parquet"):
+        index_path = _current_index(f"{job_name}/{file_name}.parquet")
+        if query_ids is not None and index_path is not None:
+            return _read_indexed_rows(f"{job_name}/{file_name}.parquet", index_path, query_ids, columns)
+        filters = [("qseqid", "in", query_ids)] if query_ids is not None else None
+        return pd.read_parquet(f"{job_name}/{file_name}.parquet", columns=columns, filters=filters)
+    
+    # jobs created before the parquet results existed
+    df = pd.read_csv(f"{job_name}/{file_name}.m8", sep="\t", header=0, names=BEST_MATCHES_HEADER, dtype={"qseqid": str, "tseqid": str})
+    if query_ids is not None:
+        df = df[df["qseqid"].isin(query_ids)]
+    if columns is not None:
+        df = df[columns]
+    return df.reset_index(drop=True)
+
+# it reads just the row groups that hold the rows of query_ids
+def _read_indexed_rows(parquet_path, index_path, query_ids, columns=None):
+    import pandas as pd
+    import pyarrow.parquet as pq
+    index_df = pd.read_parquet(index_path, columns=["qseqid", "first_row", "hits"])
+    index_df = index_df[index_df["qseqid"].isin(query_ids)]
+    read_columns = columns if columns is None or "qseqid" in columns else list(columns) + ["qseqid"]
+    
+    parquet_file = pq.ParquetFile(parquet_path)
+    group_starts = [0]
+    for group in range(parquet_file.num_row_groups):
+        group_starts.append(group_starts[-1] + parquet_file.metadata.row_group(group).num_rows)
+    row_groups = set()
+    for first_row, hits in zip(index_df["first_row"], index_df["hits"]):
+        row_groups.update(range(bisect.bisect_right(group_starts, first_row) - 1, bisect.bisect_right(group_starts, first_row + hits - 1)))
+    
+    if row_groups:
+        table = parquet_file.read_row_groups(sorted(row_groups), columns=read_columns)
+    else:
+        table = parquet_file.schema_arrow.empty_table()
+        table = table.select(read_columns) if read_columns is not None else table
+    df = table.to_pandas()
+    df = df[df["qseqid"].isin(query_ids)]
+    if columns is not None:
+        df = df[columns]
+    return df.reset_index(drop=True)
+
+def read_best_matches_summary(job_name, all_hits=False):
+    import pandas as pd
+    file_name = "best_matches_all" if all_hits else "best_matches"
+    if os.path.exists(f"{job_name}/{file_name}.parquet"):
+        index_path = _current_index(f"{job_name}/{file_name}.parquet")
+        if index_path is not None:
+            return pd.read_parquet(index_path)
+    # jobs without index: it is computed from the results
+    return summarize_best_matches(read_best_matches(job_name, all_hits=all_hits).sort_values("qseqid", kind="stable"))
 
 
 '''
@@ -311,17 +1646,30 @@ def find_matches(job_name, query_path, evalue = 0.0000000001, min_seq_id = 0.7):
 
 This function uses the best_matches.m8 file obtained with the previous function
 to retrieve the amino acid sequences of the proteins included in this table 
-and adds the amino acid sequence of the query sequence. It saves it in a file 
-called filtered_sequences.fasta. Then, it aligns the sequences using Mafft and
-saves the result in a file called aligned_sequences.fasta. The function works
-with the data found in the folder of the selected job (job_name). It requires 
-that the database used to create the job still exists.
+(all of them at once, for all the queries to align) and adds the amino acid 
+sequence of the query sequence. Then, it aligns the sequences of each query 
+using Mafft, passing them through its standard input, and saves the result in 
+alignments/<query_id>_aligned.fasta. The function works with the data found in
+the folder of the selected job (job_name). It requires that the database used 
+to create the job still exists. The queries are processed in parallel by a 
+pool of 'jobs' workers (1 by default). The 'threads' budget (see 
+resolve_threads) is divided between the workers, so every MAFFT run uses 
+threads // jobs threads. Alignments are skipped if they are recorded in the 
+manifest of the job with the same query sequence and homologs. With 
+align_mode="add", the queries whose homologs were already aligned (by this or
+other jobs) are added to that alignment, which is much faster than aligning 
+them from scratch (see ProfileCache).
 '''
 
-def align_sequences(job_name, ids_to_align=None):
+def align_sequences(job_name, ids_to_align=None, jobs=1, threads=None, align_mode="auto"):
+    import pandas as pd
+    from Bio import SeqIO
         
     verifying_mmseqs2()
     verifying_mafft()
+    threads = resolve_threads(threads)
+    if align_mode not in ALIGN_MODES:
+        raise ValueError(f"align_mode must be one of {', '.join(ALIGN_MODES)}")
                 
     # managing directories
     mmseqs_workdir = job_name
@@ -331,8 +1679,8 @@ def align_sequences(job_name, ids_to_align=None):
     
     if db_name == None or db_name == "arthropods_OrthoDB":
         db_name = "arthropods_OrthoDB"
-        mmseqs_targetdir = pkg_resources.files("inprotfind").joinpath(f"databases/{db_name}")
-        metadata_targetdir = pkg_resources.files("inprotfind").joinpath("databases/arthropods_OrthoDB_metadata.parquet")
+        mmseqs_targetdir = database_path(db_name)
+        metadata_targetdir = database_path("arthropods_OrthoDB_metadata.parquet")
     
         if not os.path.exists(mmseqs_targetdir):
             raise FileNotFoundError(f"The default database (arthropods_OrthoDB) is missing from {mmseqs_targetdir}")
@@ -340,10 +1688,8 @@ def align_sequences(job_name, ids_to_align=None):
         if not os.path.exists(metadata_targetdir):
             raise FileNotFoundError(f"The default metadata file (arthropods_OrthoDB_metadata.parquet) is missing from {metadata_targetdir}")
     else:
-        mmseqs_targetdir = "databases/" + db_name
+        mmseqs_targetdir = database_path(db_name)
         
-    mmseqs_querydir = mmseqs_workdir + "/queryDB"
-    mmseqs_filtereddir = mmseqs_workdir + "/filteredDB"
     mmseqs_tmp = mmseqs_workdir + "/tmp"
     
     # Verifying if the database exists
@@ -359,89 +1705,335 @@ def align_sequences(job_name, ids_to_align=None):
         return
     
     # creating directories
-    if not os.path.isdir(mmseqs_filtereddir):
-        os.mkdir(mmseqs_filtereddir)
     if not os.path.isdir(mmseqs_tmp):
         os.mkdir(mmseqs_tmp)
      
     # starting the aligning
     print(Fore.GREEN + Style.BRIGHT + "Collecting sequences of the best matches...")
     
-    # reading best_matches.m8
-    result_file = f"{mmseqs_workdir}/best_matches.m8"
-    df = pd.read_csv(result_file, sep='\t', skiprows=1, header=None)
+    # reading the best matches (just the columns needed, and the queries requested)
+    df = read_best_matches(mmseqs_workdir, query_id=ids_to_align, columns=["qseqid", "tseqid", "proteinid"])
+    homologs_by_query = dict(tuple(df.groupby("qseqid", sort=False)))
     
     # Crear una carpeta para almacenar los alineamientos
     os.makedirs(f"{mmseqs_workdir}/alignments", exist_ok=True)
     
     # Obtener el listado único de secuencias de consulta en queryDB
-    query_sequences = df[0].unique()
-    if ids_to_align is not None:
-            query_sequences = [seq for seq in query_sequences if seq in ids_to_align]
+    query_sequences = list(homologs_by_query)
     
-    start_time = time.time()
-    # Procesar cada secuencia de consulta de forma individual
+    # Separar las secuencias ya alineadas (y actualizadas) de las pendientes
+    manifest = load_manifest(mmseqs_workdir)
+    legacy_job = not os.path.exists(f"{mmseqs_workdir}/manifest.json")
+    query_index = get_query_index(mmseqs_workdir)
+    query_records = {}
+    alignment_keys = {}
+    adopted = {}
+    pending = []
+    skipped = 0
     for query_id in query_sequences:
-        # Comprobar si el archivo de alineamiento ya existe
+        # the query records are read here, as the index can not be shared between threads
+        query_records[query_id] = query_index[query_id]
+        homologs_df = homologs_by_query[query_id]
+        alignment_keys[query_id] = manifest_key(str(query_records[query_id].seq).upper(), sorted(zip(homologs_df["tseqid"], homologs_df["proteinid"].astype(str))), ALIGN_MODES[align_mode])
+        
+        # Comprobar si el archivo de alineamiento ya existe y está actualizado
         aligned_file = f"{mmseqs_workdir}/alignments/{query_id}_aligned.fasta"
-        if os.path.exists(aligned_file):
+        if os.path.exists(aligned_file) and legacy_job:
+            # jobs without manifest: the existing alignments are taken as valid
+            adopted[query_id] = alignment_keys[query_id]
+        if os.path.exists(aligned_file) and (legacy_job or manifest["alignments"].get(query_id) == alignment_keys[query_id]):
             print(f"Alineamiento para {query_id} ya existe, saltando...")
+            skipped += 1
             continue  # Saltar esta secuencia si ya está alineada
-        
-        print(f"Procesando secuencia de consulta: {query_id}")
-        
-        # Filtrar las secuencias homólogas para la secuencia de consulta actual
-        homologs_df = df[df[0] == query_id]
-        sequence_ids = set(homologs_df[1].str.strip())
-        
-        # Guardar los IDs de las secuencias homólogas en un archivo temporal
-        sequence_ids_df = pd.DataFrame(sequence_ids)
-        sequence_ids_df.to_csv(f"{mmseqs_tmp}/sequence_ids.txt", sep="\t", index=False, header=False)
-        
-        # Filtrar la base de datos targetDB usando los IDs de las secuencias homólogas
-        subprocess.run(f"mmseqs createsubdb {mmseqs_tmp}/sequence_ids.txt {mmseqs_targetdir}/{db_name}DB {mmseqs_filtereddir}/filteredDB_{query_id} --id-mode 1", shell=True)
-        
-        # Convertir la base de datos filtrada a formato FASTA
-        subprocess.run(f"mmseqs convert2fasta {mmseqs_filtereddir}/filteredDB_{query_id} {mmseqs_tmp}/filtered_sequences_tmp.fasta", shell=True)
-        
-        # Obtener los metadatos de las secuencias del archivo .m8 (pubprotid)
-        metadatos = pd.Series(homologs_df[14].values, index=homologs_df[1]).to_dict()
-        
-        # Sustituir NaN por el identificador original
-        for key, value in metadatos.items():
-            if pd.isna(value):  # Si el valor es NaN
-                metadatos[key] = key  # Reemplazar con el key (ID original)
-            
-        # Leer el archivo FASTA filtrado y reemplazar los IDs por los pubprotid
-        with open(f'{mmseqs_tmp}/filtered_sequences_tmp.fasta', 'r') as input_fasta, open(f'{mmseqs_tmp}/filtered_sequences_pubprotid.fasta', 'w') as output_fasta:
-            for record in SeqIO.parse(input_fasta, "fasta"):
-                original_id = record.id
-                if original_id in metadatos:
-                    # Reemplazar el ID en la cabecera con el PubProtID
-                    record.id = metadatos[original_id]
-                    record.description = metadatos[original_id]  # Actualizar también la descripción
-                SeqIO.write(record, output_fasta, "fasta")
-        
-        # Convertir la base de datos queryDB a FASTA
-        subprocess.run(f"mmseqs convert2fasta {mmseqs_querydir}/queryDB {mmseqs_tmp}/query.fasta", shell=True)
-        
-        # Leer la secuencia de la consulta actual en queryDB
-        query_seq = [seq for seq in SeqIO.parse(f"{mmseqs_tmp}/query.fasta", "fasta") if seq.id == query_id][0]
-        
-        # Agregar la secuencia de consulta a las secuencias homólogas filtradas
-        with open(f"{mmseqs_tmp}/filtered_sequences_pubprotid.fasta", "r") as infile, open(f"{mmseqs_workdir}/alignments/{query_id}_sequences.fasta", "w") as outfile:
-            SeqIO.write(query_seq, outfile, "fasta")  # Escribir primero la secuencia de consulta
-            outfile.write(infile.read())  # Luego, escribir las secuencias homólogas
-        
-        # Alinear las secuencias con MAFFT
-        print(f"Alineando secuencias para {query_id}...")
-        subprocess.run(f"mafft --auto {mmseqs_workdir}/alignments/{query_id}_sequences.fasta > {mmseqs_workdir}/alignments/{query_id}_aligned.fasta", shell=True)
+        pending.append(query_id)
+    query_index.close()
+    if adopted:
+        update_manifest(mmseqs_workdir, "alignments", adopted)
+
+    # las consultas idénticas con los mismos homólogos (misma clave) se alinean una sola vez
+    copies = {}
+    for query_id in pending:
+        copies.setdefault(alignment_keys[query_id], []).append(query_id)
+    to_align = [query_ids[0] for query_ids in copies.values()]
     
-        print(f"Resultados guardados en {mmseqs_workdir}/alignments/{query_id}_aligned.fasta")
-        
+    # reference alignments of the homologs already aligned (align_mode="add")
+    profile_cache = ProfileCache() if align_mode == "add" else None
+    profile_keys = {}
+    profiles = {}
+    if profile_cache is not None:
+        for query_id in to_align:
+            profile_keys[query_id] = profile_key(homologs_by_query[query_id], db_name)
+            profiles[query_id] = profile_cache.get(profile_keys[query_id])
+    to_retrieve = [query_id for query_id in to_align if profiles.get(query_id) is None]
+
+    # retrieving the sequences of the homologs of all the pending queries at once
+    start_time = time.time()
+    metrics = JobMetrics(mmseqs_workdir, "align_sequences")
+    metrics.begin("retrieve")
+    homolog_index = None
+    n_homologs = 0
+    if to_retrieve:
+        homolog_ids = pd.unique(pd.concat([homologs_by_query[query_id]["tseqid"] for query_id in to_retrieve]).str.strip())
+        with open(f"{mmseqs_tmp}/sequence_ids.txt", "w") as ids_file:
+            ids_file.write("\n".join(homolog_ids) + "\n")
+        try:
+            _run_tool(["mmseqs", "createsubdb", f"{mmseqs_tmp}/sequence_ids.txt", f"{mmseqs_targetdir}/{db_name}DB", f"{mmseqs_tmp}/homologsDB", "--id-mode", "1"], metrics=metrics, stage="retrieve")
+            _run_tool(["mmseqs", "convert2fasta", f"{mmseqs_tmp}/homologsDB", f"{mmseqs_tmp}/homologs.fasta"], metrics=metrics, stage="retrieve")
+        except RuntimeError as e:
+            print(Fore.RED + Style.BRIGHT + str(e))
+            print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+            return
+        homolog_index = SeqIO.index(f"{mmseqs_tmp}/homologs.fasta", "fasta")
+        n_homologs = len(homolog_ids)
+    index_lock = threading.Lock()
+    metrics.end("retrieve", queries=len(to_retrieve), hits=n_homologs)
+    metrics.begin("align")
+
+    # Procesar las secuencias de consulta en paralelo (jobs workers)
+    jobs = max(1, min(int(jobs), threads))
+    mafft_threads = max(1, threads // jobs)
+    completed = 0
+    shared = 0
+    failed = []
+    finished_keys = {}
+    last_saved = time.time()
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {executor.submit(_align_query, query_id, query_records[query_id], homologs_by_query[query_id], mmseqs_workdir, homolog_index, index_lock, mafft_threads, metrics, profiles.get(query_id), profile_cache, profile_keys.get(query_id)): query_id for query_id in to_align}
+        for future in as_completed(futures):
+            query_id = futures[future]
+            try:
+                aligned_file = future.result()
+                completed += 1
+                finished_keys[query_id] = alignment_keys[query_id]
+                print(f"[{completed + len(failed)}/{len(pending)}] Resultados guardados en {aligned_file}")
+                # copias de la consulta: mismo alineamiento con su propio nombre
+                for copy_id in copies[alignment_keys[query_id]][1:]:
+                    share_alignment(aligned_file, query_records[copy_id], f"{mmseqs_workdir}/alignments/{copy_id}_aligned.fasta")
+                    completed += 1
+                    shared += 1
+                    finished_keys[copy_id] = alignment_keys[copy_id]
+                    print(f"[{completed + len(failed)}/{len(pending)}] Alineamiento de {query_id} compartido con {copy_id}")
+            except Exception as e:
+                failed.extend(copies[alignment_keys[query_id]])
+                print(Fore.RED + Style.BRIGHT + f"[{completed + len(failed)}/{len(pending)}] Error alineando {query_id}: {e}")
+            
+            # recording the finished alignments in the manifest every few seconds
+            if finished_keys and time.time() - last_saved > 5:
+                update_manifest(mmseqs_workdir, "alignments", finished_keys)
+                finished_keys = {}
+                last_saved = time.time()
+    if finished_keys:
+        update_manifest(mmseqs_workdir, "alignments", finished_keys)
+    if homolog_index is not None:
+        homolog_index.close()
+    shutil.rmtree(mmseqs_tmp, ignore_errors=True)
+    profile_counts = {"profile_hits": profile_cache.stats["hits"], "profile_misses": profile_cache.stats["misses"]} if profile_cache is not None else {}
+    metrics.end("align", queries=len(pending), aligned=completed, shared=shared, failed=len(failed), **profile_counts)
+    metrics.finish(queries=len(query_sequences), aligned=completed, shared=shared, skipped=skipped, failed=len(failed), **profile_counts)
+
     end_time = time.time()
     print(f"Alineamientos completados para todas la secuencias de consulta en {end_time - start_time:.2f} segundos.")
+    print(Fore.GREEN + Style.BRIGHT + f"Aligned: {completed} ({shared} shared by identical queries), skipped (already aligned): {skipped}, failed: {len(failed)} (jobs: {jobs}, threads per job: {mafft_threads})")
+    if profile_cache is not None:
+        print(Fore.GREEN + Style.BRIGHT + f"Reference alignments: {profile_cache.stats['hits']} queries added to a cached alignment, {profile_cache.stats['misses']} aligned from scratch.")
+    if failed:
+        print(Fore.RED + Style.BRIGHT + f"Failed queries: {', '.join(failed)}")
+
+'''
+# _align_query
+##############
+
+Worker used by align_sequences to align a single query. It takes the sequences
+of the homologs found for the query from the index of the homolog sequences 
+(shared by all the workers, so it is read under index_lock), adds the query 
+sequence (a record taken from the query index of the job) and passes them to 
+MAFFT through its standard input. MAFFT writes the alignment to a temporal 
+file in the alignments folder, which is renamed when it finishes well, so a 
+failed run never leaves a partial alignment. If the reference alignment of 
+its homologs is given (profile), the query is added to it instead (see 
+add_to_profile), and if a profile_cache is given, the new alignment is saved 
+as the profile of its homologs. homologs_fasta builds the input of MAFFT, 
+naming the homologs by their PubProtID.
+'''
+
+def _align_query(query_id, query_seq, homologs_df, mmseqs_workdir, homolog_index, index_lock, threads=1, metrics=None, profile=None, profile_cache=None, profile_key=None):
+    aligned_file = f"{mmseqs_workdir}/alignments/{query_id}_aligned.fasta"
+    if profile is not None:
+        # the query is added to the reference alignment of its homologs
+        print(f"Añadiendo {query_id} al alineamiento de referencia de sus homólogos...")
+        add_to_profile(query_seq, profile, aligned_file, threads, metrics)
+        return aligned_file
+    
+    with index_lock:
+        sequences = homologs_fasta(query_seq, homologs_df, homolog_index)
+
+    # Alinear las secuencias con MAFFT
+    print(f"Alineando secuencias para {query_id}...")
+    _run_tool(["mafft", "--auto", "--thread", str(threads), "-"], aligned_file, input_text=sequences, metrics=metrics, stage="align")
+    if profile_cache is not None:
+        store_profile(profile_cache, profile_key, aligned_file)
+    return aligned_file
+
+def homologs_fasta(query_record, homologs_df, homolog_records):
+    import pandas as pd
+    lines = [query_record.format("fasta")]  # primero la secuencia de consulta
+    written = set()
+    names = {query_record.id}
+    for tseqid, proteinid in zip(homologs_df["tseqid"].str.strip(), homologs_df["proteinid"]):
+        if tseqid in written or tseqid not in homolog_records:
+            continue
+        written.add(tseqid)
+        # los IDs se reemplazan por los pubprotid (o se mantienen si no hay)
+        name = tseqid if pd.isna(proteinid) else proteinid
+        # los nombres repetidos se numeran, para que cada hoja del árbol tenga su propio nombre
+        repeat = 2
+        while name in names:
+            name = f"{tseqid if pd.isna(proteinid) else proteinid}_{repeat}"
+            repeat += 1
+        names.add(name)
+        lines.append(f">{name}\n{homolog_records[tseqid].seq}\n")
+    return "".join(lines)
+
+
+'''
+# alignment profile functions
+#############################
+
+The same sets of homologs are found again and again by queries of the same 
+protein family. With align_mode="add", every alignment done is saved, without 
+the query, as the reference alignment (profile) of its set of homologs in a 
+cache shared by all the jobs (ProfileCache, folder 'profiles' of the hit cache
+folder, see HitCache), and the next queries with the same homologs are added 
+to it with MAFFT --add (or --addfragments, if the query is much shorter than 
+the alignment) instead of aligning all the sequences again. The profiles are 
+found by the set of their homologs (profile_key: sorted target IDs, their 
+names and the version of the database). When the cache grows over 
+max_size_mb (INPROTFIND_PROFILE_CACHE_SIZE_MB, 1024 MB by default), the 
+profiles used least recently are removed (the size is read once and then 
+updated by every profile saved, so the folder is listed only to evict). With align_mode="auto" (the 
+default), every query is aligned from scratch with MAFFT --auto.
+'''
+
+ALIGN_MODES = {"auto": "mafft --auto", "add": "mafft --add"}
+
+class ProfileCache:
+
+    def __init__(self, cache_dir=None, max_size_mb=None):
+        cache_dir = cache_dir or os.environ.get("INPROTFIND_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "inprotfind")
+        self.profiles_dir = os.path.join(cache_dir, "profiles")
+        self.max_size = int(float(max_size_mb or os.environ.get("INPROTFIND_PROFILE_CACHE_SIZE_MB") or 1024) * 1048576)
+        self.stats = {"hits": 0, "misses": 0, "stored": 0, "evicted": 0}
+        self.lock = threading.Lock()
+        os.makedirs(self.profiles_dir, exist_ok=True)
+        # size of the cache, read once and then updated by put (and by evict, which reads it again)
+        self.size = sum(size for _, size, _ in self._profiles())
+
+    # it returns the text of the profile, or None if it is not in the cache
+    def get(self, key):
+        path = os.path.join(self.profiles_dir, f"{key}.fasta")
+        try:
+            with open(path) as profile_file:
+                profile = profile_file.read()
+            os.utime(path)
+        except FileNotFoundError:
+            profile = None
+        with self.lock:
+            self.stats["hits" if profile is not None else "misses"] += 1
+        return profile
+
+    def put(self, key, profile):
+        path = os.path.join(self.profiles_dir, f"{key}.fasta")
+        # a temporal file of its own, as the cache is shared by threads, processes and jobs
+        with tempfile.NamedTemporaryFile("w", dir=self.profiles_dir, prefix=f"{key}.", suffix=".tmp", delete=False) as profile_file:
+            profile_file.write(profile)
+        try:
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(profile_file.name, path)
+        except OSError:
+            os.remove(profile_file.name)
+            raise
+        with self.lock:
+            self.stats["stored"] += 1
+            self.size += os.path.getsize(path) - replaced
+            if self.size > self.max_size:
+                self.evict()
+
+    # (last used, size, path) of every profile in the cache
+    def _profiles(self):
+        profiles = []
+        for entry in os.scandir(self.profiles_dir):
+            if entry.name.endswith(".fasta"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                profiles.append((stat.st_mtime, stat.st_size, entry.path))
+        return profiles
+
+    # the profiles used least recently are removed until the cache is at 90% of its maximum size
+    def evict(self):
+        profiles = self._profiles()
+        total = sum(size for _, size, _ in profiles)
+        self.size = total
+        if total <= self.max_size:
+            return
+        for _, size, path in sorted(profiles):
+            if total <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.stats["evicted"] += 1
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size = total
+
+def profile_key(homologs_df, db_name):
+    return manifest_key(sorted(set(zip(homologs_df["tseqid"].str.strip(), homologs_df["proteinid"].astype(str)))), db_name, database_stamp(db_name))
+
+def _fasta_records(text):
+    records = []
+    for block in text.split(">")[1:]:
+        header, _, sequence = block.partition("\n")
+        records.append((header, sequence.replace("\n", "")))
+    return records
+
+# the alignment without its first sequence (the query) and without the columns left with only gaps
+def profile_from_alignment(aligned_text):
+    records = _fasta_records(aligned_text)[1:]
+    if not records:
+        return None
+    columns = [i for i in range(len(records[0][1])) if any(sequence[i] != "-" for _, sequence in records)]
+    return "".join(f">{header}\n{''.join(sequence[i] for i in columns)}\n" for header, sequence in records)
+
+def store_profile(profile_cache, key, aligned_file):
+    with open(aligned_file) as alignment:
+        profile = profile_from_alignment(alignment.read())
+    if profile is not None:
+        profile_cache.put(key, profile)
+
+# it adds the query to the profile with MAFFT and writes the alignment with the query first
+def add_to_profile(query_record, profile, aligned_file, threads=1, metrics=None):
+    profile_records = _fasta_records(profile)
+    fragment = len(query_record.seq) < 0.5 * len(profile_records[0][1])
+    try:
+        with open(aligned_file + ".profile", "w") as profile_file:
+            profile_file.write(profile)
+        with open(aligned_file + ".query", "w") as query_file:
+            query_file.write(query_record.format("fasta"))
+        _run_tool(["mafft", "--addfragments" if fragment else "--add", aligned_file + ".query", "--thread", str(threads), aligned_file + ".profile"], aligned_file + ".added", metrics=metrics, stage="align")
+        with open(aligned_file + ".added") as added:
+            records = _fasta_records(added.read())
+    finally:
+        for path in [aligned_file + ".profile", aligned_file + ".query", aligned_file + ".added"]:
+            if os.path.exists(path):
+                os.remove(path)
     
+    # MAFFT writes the added sequence last
+    with open(aligned_file + ".tmp", "w") as alignment:
+        alignment.writelines(f">{header}\n{sequence}\n" for header, sequence in records[-1:] + records[:-1])
+    os.replace(aligned_file + ".tmp", aligned_file)
+
 '''
 # build_tree
 ############
@@ -449,13 +2041,28 @@ def align_sequences(job_name, ids_to_align=None):
 This function uses the align_sequences.fasta file to create a phylogenetic 
 tree, placing the query sequence alongside the 30 most similar sequences. It 
 creates a file called tree.nwk and draws a tree. You can choose to draw the 
-tree in a simple way (default) or interactively using the "ete3" library.
+tree in a simple way (default) or interactively using the "ete3" library. The 
+trees are recorded in the manifest of the job with the hash of their 
+alignment, and they are not built again while the alignment does not change 
+(trees not recorded in the manifest are kept if they are newer than their 
+alignment). Without query_id, the trees of all the alignments are built in 
+parallel by a pool of 'jobs' workers, and the failed ones are listed at the 
+end. If FastTreeMP (the multithreaded build of FastTree) is installed, it is 
+used with 'threads' threads shared by the workers (see resolve_threads). With
+bootstrap=N, the supports of the branches of each tree are computed from N 
+bootstrap replicates, inferred by a pool of 'threads' processes, and the tree
+with these supports is saved as <query_id>_tree_bootstrap.nwk (see 
+bootstrap_supports). This tree is the one drawn.
 '''
 
-def build_tree(job_name, query_id=None, tree_type='simple'):
+def build_tree(job_name, query_id=None, tree_type='simple', jobs=1, threads=None, bootstrap=0):
 
     start_time = time.time()
     verifying_fasttree()
+    fasttree = fasttree_executable()
+    threads = resolve_threads(threads)
+    jobs = max(1, min(int(jobs), threads))
+    fasttree_env = dict(os.environ, OMP_NUM_THREADS=str(max(1, threads // jobs)))
 
     # Managing directories
     mmseqs_workdir = job_name
@@ -471,21 +2078,55 @@ def build_tree(job_name, query_id=None, tree_type='simple'):
         print(Fore.RED + Style.BRIGHT + f"The job folder named {mmseqs_workdir} does not exist. Please, choose an existing job folder or run first the 'find_matches' function.")
         print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
         return
+    metrics = JobMetrics(mmseqs_workdir, "build_tree")
+    metrics.begin("tree")
 
     # Si se proporciona un query_id, construir solo el árbol para ese alineamiento
     if query_id:
         mmseqs_qseqid = f"{query_id}_aligned.fasta"
         alignment_path = f"{alignments_dir}/{mmseqs_qseqid}"
         if os.path.isfile(alignment_path):
-            subprocess.run(f"FastTree {alignment_path} > {trees_dir}/{query_id}_tree.nwk", shell=True)
-            print(Fore.GREEN + Style.BRIGHT + f"Tree saved in {trees_dir}/{query_id}_tree.nwk")
+            # the tree is rebuilt only if its alignment changed
+            tree_key = manifest_key(file_hash(alignment_path), "FastTree")
+            output_tree = f"{trees_dir}/{query_id}_tree.nwk"
+            recorded_key = load_manifest(mmseqs_workdir)["trees"].get(query_id)
+            if tree_is_current(output_tree, alignment_path, recorded_key, tree_key):
+                print(Fore.GREEN + Style.BRIGHT + f"Tree for {query_id} is up to date, skipping...")
+                if recorded_key is None:
+                    update_manifest(mmseqs_workdir, "trees", {query_id: tree_key})
+            else:
+                try:
+                    _build_query_tree(fasttree, alignment_path, output_tree, fasttree_env, metrics)
+                except RuntimeError as e:
+                    print(Fore.RED + Style.BRIGHT + f"{e} for {query_id}")
+                    return
+                update_manifest(mmseqs_workdir, "trees", {query_id: tree_key})
+                print(Fore.GREEN + Style.BRIGHT + f"Tree saved in {output_tree}")
+            metrics.end("tree", queries=1)
+            if bootstrap:
+                _, _, failed = _bootstrap_trees(mmseqs_workdir, [query_id], fasttree, bootstrap, threads, metrics)
+                if failed:
+                    return
         else:
             print(Fore.RED + Style.BRIGHT + f"The alignment file {mmseqs_qseqid} does not exist in {alignments_dir}.")
+            if os.path.isdir(f"{mmseqs_workdir}/queryDB"):
+                query_index = get_query_index(mmseqs_workdir)
+                if query_id not in query_index:
+                    print(Fore.RED + Style.BRIGHT + f"'{query_id}' is not one of the query sequences of {job_name}.")
+                else:
+                    print(Fore.RED + Style.BRIGHT + f"Run first the 'align_sequences' function for '{query_id}'.")
+                query_index.close()
+            return
+        metrics.begin("draw")
 
+        tree_file = f"{mmseqs_workdir}/trees/{qseqid}_tree_bootstrap.nwk" if bootstrap else f"{mmseqs_workdir}/trees/{qseqid}_tree.nwk"
+        
         # Drawing simple tree
         if(tree_type == 'simple'):
+            import matplotlib.pyplot as plt
+            from Bio import Phylo
             print(Fore.GREEN + Style.BRIGHT + "Default style tree drawn.")
-            tree = Phylo.read(f"{mmseqs_workdir}/trees/{qseqid}_tree.nwk", "newick")
+            tree = Phylo.read(tree_file, "newick")
             fig = plt.figure(figsize=(12,12))
             print(Back.GREEN + Fore.BLACK + "Done! You can find the tree drawn in the Plots tab or in a pop-up window")
             Phylo.draw(tree, do_show=True, show_confidence=True, axes=plt.gca())
@@ -495,9 +2136,10 @@ def build_tree(job_name, query_id=None, tree_type='simple'):
         
         # Drawing interactive tree
         if(tree_type == "interactive"):
+            from ete3 import Tree, TreeStyle
             print(Fore.GREEN + Style.BRIGHT + "Interactive tree drawn.")     
             # reading the tree
-            t = Tree(f"{mmseqs_workdir}/trees/{qseqid}_tree.nwk")
+            t = Tree(tree_file)
             
             # defining tree style
             ts = TreeStyle()
@@ -508,21 +2150,588 @@ def build_tree(job_name, query_id=None, tree_type='simple'):
             print(Back.GREEN + Fore.BLACK + "Done! You can find the interactive tree drawn in a pop-up window")
             # plot tree
             t.show(tree_style=ts)
+        metrics.end("draw", queries=1)
+        metrics.finish(queries=1)
         end_time = time.time()
         print(Back.GREEN + Fore.BLACK + f"Tree from {query_id} generated in {end_time - start_time:.2f} seconds.")
 
     else:
         # Si no se proporciona query_id, construir árboles para todos los alineamientos
-        for filename in os.listdir(alignments_dir):
+        tree_records = load_manifest(mmseqs_workdir)["trees"]
+        tree_keys = {}
+        adopted = {}
+        pending = []
+        skipped = 0
+        for filename in sorted(os.listdir(alignments_dir)):
             if filename.endswith('_aligned.fasta'):
                 query_id = filename.replace('_aligned.fasta', '')
                 alignment_path = f"{alignments_dir}/{filename}"
                 output_tree = f"{trees_dir}/{query_id}_tree.nwk"
-                subprocess.run(f"FastTree {alignment_path} > {output_tree}", shell=True)
-                print(Fore.GREEN + Style.BRIGHT + f"Tree saved in {output_tree}")
+                tree_keys[query_id] = manifest_key(file_hash(alignment_path), "FastTree")
+                if tree_is_current(output_tree, alignment_path, tree_records.get(query_id), tree_keys[query_id]):
+                    print(Fore.GREEN + Style.BRIGHT + f"Tree for {query_id} is up to date, skipping...")
+                    if query_id not in tree_records:
+                        adopted[query_id] = tree_keys[query_id]
+                    skipped += 1
+                    continue
+                pending.append(query_id)
+        if adopted:
+            update_manifest(mmseqs_workdir, "trees", adopted)
+
+        # alignments equal but for the query name (identical queries) share their tree
+        copies = {}
+        for query_id in pending:
+            copies.setdefault(alignment_share_key(f"{alignments_dir}/{query_id}_aligned.fasta"), []).append(query_id)
+        copies = {query_ids[0]: query_ids[1:] for query_ids in copies.values()}
+
+        # Construir los árboles pendientes en paralelo (jobs workers)
+        completed = 0
+        shared = 0
+        failed = []
+        finished_keys = {}
+        last_saved = time.time()
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            futures = {executor.submit(_build_query_tree, fasttree, f"{alignments_dir}/{query_id}_aligned.fasta", f"{trees_dir}/{query_id}_tree.nwk", fasttree_env, metrics): query_id for query_id in copies}
+            for future in as_completed(futures):
+                query_id = futures[future]
+                try:
+                    output_tree = future.result()
+                    completed += 1
+                    finished_keys[query_id] = tree_keys[query_id]
+                    print(Fore.GREEN + Style.BRIGHT + f"[{completed + len(failed)}/{len(pending)}] Tree saved in {output_tree}")
+                except Exception as e:
+                    failed.extend([query_id] + copies[query_id])
+                    print(Fore.RED + Style.BRIGHT + f"[{completed + len(failed)}/{len(pending)}] {e} for {query_id}")
+                    continue
+                for copy_id in copies[query_id]:
+                    copy_tree = f"{trees_dir}/{copy_id}_tree.nwk"
+                    try:
+                        share_tree(output_tree, query_id, copy_id, copy_tree)
+                        shared += 1
+                    except ValueError:
+                        # the query leaf can not be renamed: the tree is built
+                        try:
+                            _build_query_tree(fasttree, f"{alignments_dir}/{copy_id}_aligned.fasta", copy_tree, fasttree_env, metrics)
+                        except RuntimeError as e:
+                            failed.append(copy_id)
+                            print(Fore.RED + Style.BRIGHT + f"[{completed + len(failed)}/{len(pending)}] {e} for {copy_id}")
+                            continue
+                    completed += 1
+                    finished_keys[copy_id] = tree_keys[copy_id]
+                    print(Fore.GREEN + Style.BRIGHT + f"[{completed + len(failed)}/{len(pending)}] Tree saved in {copy_tree}")
+                
+                # recording the finished trees in the manifest every few seconds
+                if finished_keys and time.time() - last_saved > 5:
+                    update_manifest(mmseqs_workdir, "trees", finished_keys)
+                    finished_keys = {}
+                    last_saved = time.time()
+        if finished_keys:
+            update_manifest(mmseqs_workdir, "trees", finished_keys)
+        metrics.end("tree", queries=len(pending), built=completed, shared=shared, failed=len(failed))
+        
+        # supports of the trees built or up to date
+        bootstrap_counts = {}
+        if bootstrap:
+            with_tree = [query_id for query_id in tree_keys if query_id not in failed]
+            bootstrapped, bootstrap_skipped, bootstrap_failed = _bootstrap_trees(mmseqs_workdir, with_tree, fasttree, bootstrap, threads, metrics)
+            failed.extend(bootstrap_failed)
+            bootstrap_counts = {"bootstrapped": bootstrapped, "bootstrap_skipped": bootstrap_skipped}
+        metrics.finish(queries=len(pending) + skipped, built=completed, shared=shared, skipped=skipped, failed=len(failed), **bootstrap_counts)
         end_time = time.time()
         print(Back.GREEN + Fore.BLACK + f"Trees from {job_name} generated in {end_time - start_time:.2f} seconds.")
+        print(Fore.GREEN + Style.BRIGHT + f"Built: {completed} ({shared} shared by identical queries), skipped (up to date): {skipped}, failed: {len(failed)} (jobs: {jobs})")
+        if bootstrap:
+            print(Fore.GREEN + Style.BRIGHT + f"Bootstrap ({bootstrap} replicates): {bootstrap_counts['bootstrapped']} trees, skipped (up to date): {bootstrap_counts['bootstrap_skipped']}")
+        if failed:
+            print(Fore.RED + Style.BRIGHT + f"Failed queries: {', '.join(sorted(failed))}")
+
+
+'''
+# _build_query_tree
+###################
+
+Worker used by build_tree to infer the tree of a single alignment with 
+FastTree. The tree is written to a temporal file and renamed when FastTree 
+finishes well, so a failed or interrupted run never leaves a partial tree. 
+tree_is_current tells if a tree is up to date: recorded in the manifest with 
+the same key or, for trees not recorded, newer than its alignment.
+'''
+
+def _build_query_tree(fasttree, alignment_path, output_tree, fasttree_env, metrics=None):
+    _run_tool([fasttree, alignment_path], output_tree, env=fasttree_env, metrics=metrics, stage="tree")
+    return output_tree
+
+def tree_is_current(output_tree, alignment_path, recorded_key, tree_key):
+    if not os.path.isfile(output_tree):
+        return False
+    if recorded_key is not None:
+        return recorded_key == tree_key
+    return os.path.getmtime(output_tree) >= os.path.getmtime(alignment_path)
+
+
+'''
+# bootstrap functions
+#####################
+
+bootstrap_supports computes the bootstrap supports of the tree of an 
+alignment. The replicate alignments are made by resampling the columns of the
+alignment with replacement, each one from its own seed (derived from the 
+alignment, so the supports are reproducible). The workers of a process pool 
+(_bootstrap_replicate) make each replicate in memory, pass it to FastTree 
+through its standard input and return just the splits of the replicate tree,
+so no replicate file is ever written. The support of each branch of the tree 
+is the fraction of replicates with the same split, and the tree with these 
+supports is written to bootstrap_tree. The splits are made of the positions 
+of the sequences in the alignment (the replicates name them by position), so
+an alignment with repeated sequence names, whose leaves can not be told apart,
+is rejected. tree_splits returns the split of each inner branch of a tree (the
+positions of the leaves on the side without the first sequence).
+_bootstrap_trees runs it for the trees of a job, recording them in the 
+manifest (section "bootstrap"), and skips the ones up to date.
+'''
+
+def _bootstrap_trees(mmseqs_workdir, query_ids, fasttree, bootstrap, threads, metrics=None):
+    records = load_manifest(mmseqs_workdir)["bootstrap"]
+    built = 0
+    skipped = 0
+    failed = []
+    finished_keys = {}
+    if metrics is not None:
+        metrics.begin("bootstrap")
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        for query_id in query_ids:
+            alignment_path = f"{mmseqs_workdir}/alignments/{query_id}_aligned.fasta"
+            output_tree = f"{mmseqs_workdir}/trees/{query_id}_tree.nwk"
+            bootstrap_tree = f"{mmseqs_workdir}/trees/{query_id}_tree_bootstrap.nwk"
+            bootstrap_key = manifest_key(file_hash(alignment_path), file_hash(output_tree), "FastTree", bootstrap)
+            if os.path.isfile(bootstrap_tree) and records.get(query_id) == bootstrap_key:
+                skipped += 1
+                continue
+            query_start = time.time()
+            try:
+                bootstrap_supports(fasttree, alignment_path, output_tree, bootstrap_tree, bootstrap, executor, chunksize=max(1, bootstrap // (threads * 4)))
+            except Exception as e:
+                failed.append(query_id)
+                print(Fore.RED + Style.BRIGHT + f"Bootstrap failed for {query_id}: {e}")
+                continue
+            built += 1
+            finished_keys[query_id] = bootstrap_key
+            print(Fore.GREEN + Style.BRIGHT + f"[{built + skipped + len(failed)}/{len(query_ids)}] Bootstrap tree ({bootstrap} replicates) saved in {bootstrap_tree} in {time.time() - query_start:.2f} seconds")
+            if len(finished_keys) >= 10:
+                update_manifest(mmseqs_workdir, "bootstrap", finished_keys)
+                finished_keys = {}
+    if finished_keys:
+        update_manifest(mmseqs_workdir, "bootstrap", finished_keys)
+    if metrics is not None:
+        metrics.end("bootstrap", queries=len(query_ids), built=built, skipped=skipped, failed=len(failed), replicates=bootstrap * built)
+    return built, skipped, failed
+
+def bootstrap_supports(fasttree, alignment_path, output_tree, bootstrap_tree, n_replicates, executor, chunksize=1):
+    from Bio import Phylo
+    with open(alignment_path) as alignment:
+        records = _fasta_records(alignment.read())
+    seed = file_hash(alignment_path)
+    
+    # position of each sequence in the alignment, by its name in the tree
+    names = Counter(header.split()[0] for header, _ in records)
+    repeated = sorted(name for name, count in names.items() if count > 1)
+    if repeated:
+        raise ValueError(f"repeated sequence names in {alignment_path} ({', '.join(repeated[:5])}), the leaves of the tree can not be told apart")
+    leaf_index = {}
+    for position, (header, _) in enumerate(records):
+        leaf_index[header] = leaf_index[header.split()[0]] = position
+    
+    tree = Phylo.read(output_tree, "newick")
+    splits = tree_splits(tree, leaf_index)
+    counts = Counter()
+    # the replicates are made by the workers, 'chunksize' at a time
+    for replicate_splits in executor.map(_bootstrap_replicate, [fasttree] * n_replicates, [records] * n_replicates, [f"{seed}-{i}" for i in range(n_replicates)], chunksize=chunksize):
+        counts.update(split for split in splits.values() if split in replicate_splits)
+    
+    for clade in tree.get_nonterminals():
+        clade.confidence = round(counts[splits[clade]] / n_replicates, 3) if clade in splits else None
+    with open(bootstrap_tree + ".tmp", "w") as tree_file:
+        Phylo.write(tree, tree_file, "newick")
+    os.replace(bootstrap_tree + ".tmp", bootstrap_tree)
+    return bootstrap_tree
+
+# leaf_index is {leaf name: position of its sequence in the alignment}
+def tree_splits(tree, leaf_index):
+    leaves = {clade: frozenset(leaf_index[leaf.name] for leaf in clade.get_terminals()) for clade in tree.get_nonterminals()}
+    all_leaves = leaves[tree.root]
+    first = min(all_leaves)
+    splits = {}
+    for clade, side in leaves.items():
+        if first in side:
+            side = all_leaves - side
+        if 1 < len(side) < len(all_leaves) - 1:
+            splits[clade] = side
+    return splits
+
+# worker of the process pool: it returns the splits of the tree of a replicate
+def _bootstrap_replicate(fasttree, records, seed):
+    from Bio import Phylo
+    generator = random.Random(seed)
+    length = len(records[0][1])
+    columns = [generator.randrange(length) for _ in range(length)]
+    # the sequences are named by their position in the alignment
+    replicate = "".join(f">{position}\n{''.join([sequence[i] for i in columns])}\n" for position, (_, sequence) in enumerate(records))
+    
+    args = [fasttree, "-nosupport", "-quiet"]
+    result = subprocess.run(args, input=replicate, capture_output=True, text=True, env=dict(os.environ, OMP_NUM_THREADS="1"))
+    if result.returncode != 0:
+        raise RuntimeError(_tool_error(args, result.returncode, result.stderr))
+    return set(tree_splits(Phylo.read(io.StringIO(result.stdout), "newick"), {str(position): position for position in range(len(records))}).values())
+
+
+'''
+# run_pipeline
+##############
+
+This function runs the whole analysis of a query file (search, alignments and
+trees) overlapping the stages instead of waiting for each one to finish with 
+all the queries. The queries are searched in batches of 'batch_size' 
+sequences, and every query goes to MAFFT as soon as the hits of its batch are 
+annotated, and to FastTree as soon as its alignment is written, while the next
+batches are still being searched. At most 'align_jobs' alignments and 
+'tree_jobs' trees run at the same time. The 'threads' budget (see 
+resolve_threads) is split in align_jobs + tree_jobs + 1 equal parts, one for
+each alignment and tree slot and one (with the rest of the division) for the
+searches, as they all run at the same time. The database searched is db_name
+(arthropods_OrthoDB by default, or a database made with create_targetDB). The job folder ends with the 
+same files as running find_matches, align_sequences and build_tree, so these 
+functions (and show_results) can be used with it afterwards. The job is 
+recorded in its manifest when it starts, so running it again with the same 
+query file and parameters resumes it, even if it was interrupted: the batches
+already searched are read back from the job folder, and the alignments and 
+trees that are up to date are skipped. align_mode is passed to the alignments as in 
+align_sequences.
+'''
+
+def run_pipeline(job_name, query_path, evalue = 0.0000000001, min_seq_id = 0.7, batch_size = 100, align_jobs = 2, tree_jobs = 2, threads = None, warm = False, align_mode = "auto", db_name = "arthropods_OrthoDB"):
+
+    start_time = time.time()
+    verifying_mmseqs2()
+    verifying_mafft()
+    verifying_fasttree()
+    threads = resolve_threads(threads)
+    if align_mode not in ALIGN_MODES:
+        raise ValueError(f"align_mode must be one of {', '.join(ALIGN_MODES)}")
+
+    # managing the database
+    if db_name != "arthropods_OrthoDB" and (not os.path.exists(f"{database_path(db_name)}/{db_name}DB") or not os.path.exists(database_path(f"{db_name}_metadata.parquet"))):
+        print(Fore.RED + Style.BRIGHT + f"The database '{db_name}' does not exist or it is corrupted. You may use the 'create_targetDB' function to create it.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    elif not os.path.exists(database_path(db_name)) or not os.path.exists(database_path(f"{db_name}_metadata.parquet")):
+        print("The default database (arthropods_OrthoDB) is not yet installed or is corrupted. The database will be downloaded and installed now.")
+        get_database(True)
+    elif not os.path.exists(database_path(f"{db_name}_metadata.arrow")):
+        print(Fore.GREEN + Style.BRIGHT + "Building the metadata index...")
+        build_metadata_index(db_name)
+
+    # the job is resumed only if it was created by run_pipeline with the same inputs
+    mmseqs_workdir = job_name
+    pipeline_key = manifest_key(file_hash(query_path), database_stamp(db_name), evalue, min_seq_id, 100, *([db_name] if db_name != "arthropods_OrthoDB" else []))
+    manifest = load_manifest(mmseqs_workdir)
+    if os.path.isdir(mmseqs_workdir) and not stage_is_current(manifest, "pipeline", pipeline_key):
+        print(Fore.RED + Style.BRIGHT + f"There is already a job folder named '{mmseqs_workdir}' in this directory, created with other query file or parameters. Please, choose another job_name or remove the folder.")
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    for folder in ["queryDB", "tmp", "alignments", "trees"]:
+        os.makedirs(f"{mmseqs_workdir}/{folder}", exist_ok=True)
+    pipeline_inputs = {"query_path": str(query_path), "db_name": db_name}
+    pipeline_params = {"evalue": evalue, "min_seq_id": min_seq_id, "max_seqs": 100, "batch_size": batch_size}
+    record_stage(mmseqs_workdir, manifest, "pipeline", pipeline_key, inputs=pipeline_inputs, params=pipeline_params)
+    if warm:
+        warm_database(db_name)
+
+    # query database and index of the job, as created by find_matches
+    metrics = JobMetrics(mmseqs_workdir, "run_pipeline")
+    metrics.begin("createdb")
+    try:
+        _run_tool(["mmseqs", "createdb", str(query_path), f"{mmseqs_workdir}/queryDB/queryDB"], metrics=metrics, stage="createdb")
+    except RuntimeError as e:
+        print(Fore.RED + Style.BRIGHT + str(e))
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    if os.path.exists(f"{mmseqs_workdir}/query.fasta"):
+        os.remove(f"{mmseqs_workdir}/query.fasta")
+    if os.path.exists(f"{mmseqs_workdir}/query.idx"):
+        os.remove(f"{mmseqs_workdir}/query.idx")
+    get_query_index(mmseqs_workdir).close()
+    record_stage(mmseqs_workdir, manifest, "createdb", manifest_key(file_hash(query_path)), inputs={"query_path": str(query_path)})
+    metrics.end("createdb", queries=count_queries(f"{mmseqs_workdir}/queryDB"))
+
+    pipeline = _Pipeline(mmseqs_workdir, db_name, evalue, min_seq_id, align_jobs, tree_jobs, threads, warm, metrics, align_mode, pipeline_key)
+    try:
+        best_matches_df_all = asyncio.run(pipeline.run(str(query_path), batch_size))
+    except RuntimeError as e:
+        pipeline.save_manifest(force=True)
+        print(Fore.RED + Style.BRIGHT + str(e))
+        print(Fore.GREEN + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    finally:
+        pipeline.executor.shutdown()
+    pipeline.save_manifest(force=True)
+
+    if best_matches_df_all is None:
+        no_matches = "None of the sequences in the database match with the query sequence"
+        with open(f"{mmseqs_workdir}/no_matches.txt", 'w') as file:
+            file.write(no_matches)
+        print(Fore.RED + Style.BRIGHT + no_matches)
+    else:
+        save_best_matches(best_matches_df_all, mmseqs_workdir)
+    with open(f"{mmseqs_workdir}/db_name.txt", "w") as file:
+        file.write(db_name)
+    record_stage(mmseqs_workdir, manifest, "pipeline", pipeline_key, inputs=pipeline_inputs, params=pipeline_params, seconds=time.time() - start_time)
+    shutil.rmtree(f"{mmseqs_workdir}/tmp", ignore_errors=True)
+
+    counts = pipeline.counts
+    metrics.finish(queries=count_queries(f"{mmseqs_workdir}/queryDB"), hits=0 if best_matches_df_all is None else len(best_matches_df_all),
+                   aligned=counts["aligned"], aligned_skipped=counts["aligned_skipped"], align_failed=len(counts["align_failed"]),
+                   trees=counts["trees"], trees_skipped=counts["trees_skipped"], tree_failed=len(counts["tree_failed"]))
+    print(Back.GREEN + Fore.BLACK + f"Done! Pipeline for {job_name} complete in {time.time() - start_time:.2f} seconds.")
+    if counts["batches_skipped"]:
+        print(Fore.GREEN + Style.BRIGHT + f"Batches read from a previous run: {counts['batches_skipped']}")
+    print(Fore.GREEN + Style.BRIGHT + f"Aligned: {counts['aligned']}, skipped: {counts['aligned_skipped']}, failed: {len(counts['align_failed'])}. Trees built: {counts['trees']}, skipped: {counts['trees_skipped']}, failed: {len(counts['tree_failed'])}")
+    failed = counts["align_failed"] + counts["tree_failed"]
+    if failed:
+        print(Fore.RED + Style.BRIGHT + f"Failed queries: {', '.join(failed)}")
+
+
+'''
+# _Pipeline
+###########
+
+Scheduler used by run_pipeline. run() searches the batches one after another 
+and starts a task for every query with hits, which waits for a free 
+alignment slot, aligns the query, waits for a free tree slot and builds its 
+tree. The external tools run in the threads of its own executor (one per 
+alignment and tree slot, plus one for the searches) writing their output to a
+temporal file, renamed when they finish well. The sequences of the homologs 
+are retrieved once per batch (mmseqs createsubdb and convert2fasta). The 
+annotated hits and the homolog sequences of every batch searched are kept in
+the job folder (batches/batch_<n>) with a key of its queries, the pipeline 
+and the metadata of the database (batch.json), so a resumed or repeated run 
+reads them instead of searching the batch again. As the stages overlap, a "search" metrics record is written per batch, while the 
+alignments and trees are measured per tool call.
+'''
+
+class _Pipeline:
 
+    def __init__(self, mmseqs_workdir, db_name, evalue, min_seq_id, align_jobs, tree_jobs, threads, warm, metrics=None, align_mode="auto", pipeline_key=None):
+        self.mmseqs_workdir = mmseqs_workdir
+        self.pipeline_key = pipeline_key
+        self.db_name = db_name
+        self.mmseqs_targetdir = database_path(db_name)
+        self.evalue = evalue
+        self.min_seq_id = min_seq_id
+        self.align_jobs = max(1, int(align_jobs))
+        self.tree_jobs = max(1, int(tree_jobs))
+        # a share of the budget for every slot: alignments, trees and the search
+        self.tool_threads = max(1, threads // (self.align_jobs + self.tree_jobs + 1))
+        self.search_threads = max(1, threads - self.tool_threads * (self.align_jobs + self.tree_jobs))
+        self.warm = warm
+        self.fasttree = fasttree_executable()
+        self.fasttree_env = dict(os.environ, OMP_NUM_THREADS=str(self.tool_threads))
+        self.manifest = load_manifest(mmseqs_workdir)
+        self.finished = {"alignments": {}, "trees": {}}
+        self.last_saved = time.time()
+        self.counts = {"aligned": 0, "aligned_skipped": 0, "align_failed": [], "trees": 0, "trees_skipped": 0, "tree_failed": [], "batches_skipped": 0}
+        self.metrics = metrics
+        self.align_mode = align_mode
+        self.profile_cache = ProfileCache() if align_mode == "add" else None
+        self.executor = ThreadPoolExecutor(max_workers=self.align_jobs + self.tree_jobs + 1)
+
+    async def run(self, query_path, batch_size):
+        import pandas as pd
+        self.align_slots = asyncio.Semaphore(self.align_jobs)
+        self.tree_slots = asyncio.Semaphore(self.tree_jobs)
+        query_index = get_query_index(self.mmseqs_workdir)
+        query_records = [query_index[query_id] for query_id in query_index]
+        query_index.close()
+        
+        # the queries with the same sequence are searched, aligned and drawn just once
+        unique_records, dedup_df = deduplicate_queries(query_records)
+        dedup_df.to_csv(f"{self.mmseqs_workdir}/query_dedup.tsv", sep="\t", index=False)
+        records_by_id = {record.id: record for record in query_records}
+        copies = dedup_df.groupby("representative", sort=False)["qseqid"].agg(list).to_dict()
+
+        tasks = []
+        hits_tables = []
+        for first in range(0, len(unique_records), batch_size):
+            batch = unique_records[first:first + batch_size]
+            batch_dir = f"{self.mmseqs_workdir}/tmp/batch_{first // batch_size}"
+            saved_dir = f"{self.mmseqs_workdir}/batches/batch_{first // batch_size}"
+            batch_key = manifest_key(self.pipeline_key, [record.id for record in batch], database_stamp(self.db_name, metadata=True))
+            found = self.read_batch(saved_dir, batch_key)
+            if found is not None:
+                print(Fore.GREEN + Style.BRIGHT + f"Queries {first + 1}-{first + len(batch)} of {len(unique_records)} distinct sequences already searched, skipping...")
+                self.counts["batches_skipped"] += 1
+                hits_df, target_records = found
+            else:
+                print(Fore.GREEN + Style.BRIGHT + f"Searching queries {first + 1}-{first + len(batch)} of {len(unique_records)} distinct sequences...")
+                if self.metrics is not None:
+                    self.metrics.begin("search")
+                # removing the files of an interrupted search
+                shutil.rmtree(batch_dir, ignore_errors=True)
+                hits_df, target_records = await self.search_batch(batch, batch_dir)
+                self.save_batch(batch_dir, saved_dir, batch_key, hits_df)
+                if self.metrics is not None:
+                    self.metrics.end("search", batch=first // batch_size, queries=len(batch), queries_with_hits=0 if hits_df is None else hits_df["qseqid"].nunique(), hits=0 if hits_df is None else len(hits_df))
+            if hits_df is None:
+                continue
+            hits_tables.append(hits_df)
+            for query_id, homologs_df in hits_df.groupby("qseqid", sort=False):
+                copy_records = [records_by_id[copy_id] for copy_id in copies[query_id][1:]]
+                tasks.append(asyncio.create_task(self.process_query_copies(records_by_id[query_id], copy_records, homologs_df.head(30), target_records)))
+
+        await asyncio.gather(*tasks)
+        if not hits_tables:
+            return None
+        return fan_out_hits(pd.concat(hits_tables, ignore_index=True), dedup_df)
+
+    async def search_batch(self, batch, batch_dir):
+        import pandas as pd
+        from Bio import SeqIO
+        os.makedirs(batch_dir, exist_ok=True)
+        SeqIO.write(batch, f"{batch_dir}/queries.fasta", "fasta")
+        target_db = f"{self.mmseqs_targetdir}/{self.db_name}DB"
+        await _run_tool_async(["mmseqs", "createdb", f"{batch_dir}/queries.fasta", f"{batch_dir}/queryDB"], metrics=self.metrics, stage="search", executor=self.executor)
+        await _run_tool_async(["mmseqs", "search", f"{batch_dir}/queryDB", target_db, f"{batch_dir}/resultDB", f"{batch_dir}/search"] + search_options(self.evalue, self.min_seq_id, self.warm, self.search_threads).split(), metrics=self.metrics, stage="search", executor=self.executor)
+        await _run_tool_async(["mmseqs", "convertalis", f"{batch_dir}/queryDB", target_db, f"{batch_dir}/resultDB", f"{batch_dir}/hits.m8", "--threads", str(self.search_threads)], metrics=self.metrics, stage="search", executor=self.executor)
+        if not os.path.exists(f"{batch_dir}/hits.m8") or os.path.getsize(f"{batch_dir}/hits.m8") == 0:
+            return None, None
+
+        hits_df = pd.read_csv(f"{batch_dir}/hits.m8", sep="\t", header=None, dtype={0: str, 1: str})
+        annotate_hits(hits_df, self.db_name)
+        hits_df.columns = BEST_MATCHES_HEADER
+
+        # sequences of all the homologs of the batch
+        pd.DataFrame(hits_df["tseqid"].str.strip().unique()).to_csv(f"{batch_dir}/sequence_ids.txt", sep="\t", index=False, header=False)
+        await _run_tool_async(["mmseqs", "createsubdb", f"{batch_dir}/sequence_ids.txt", target_db, f"{batch_dir}/targetsDB", "--id-mode", "1"], metrics=self.metrics, stage="search", executor=self.executor)
+        await _run_tool_async(["mmseqs", "convert2fasta", f"{batch_dir}/targetsDB", f"{batch_dir}/targets.fasta"], metrics=self.metrics, stage="search", executor=self.executor)
+        target_records = SeqIO.to_dict(SeqIO.parse(f"{batch_dir}/targets.fasta", "fasta"))
+        return hits_df, target_records
+
+    # the hits of a batch are written before its key, so a batch with a key is complete
+    def save_batch(self, batch_dir, saved_dir, batch_key, hits_df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        shutil.rmtree(saved_dir, ignore_errors=True)
+        os.makedirs(saved_dir)
+        if hits_df is not None:
+            pq.write_table(pa.Table.from_pandas(hits_df, schema=best_matches_schema(), preserve_index=False), f"{saved_dir}/hits.parquet")
+            os.replace(f"{batch_dir}/targets.fasta", f"{saved_dir}/targets.fasta")
+        with open(f"{saved_dir}/batch.json.tmp", "w") as batch_file:
+            json.dump({"key": batch_key, "hits": hits_df is not None}, batch_file)
+        os.replace(f"{saved_dir}/batch.json.tmp", f"{saved_dir}/batch.json")
+        # the search files are not needed any more
+        shutil.rmtree(batch_dir, ignore_errors=True)
+
+    # hits and homolog sequences of a batch searched before (None if it has to be searched)
+    def read_batch(self, saved_dir, batch_key):
+        import pandas as pd
+        from Bio import SeqIO
+        if not os.path.exists(f"{saved_dir}/batch.json"):
+            return None
+        with open(f"{saved_dir}/batch.json") as batch_file:
+            saved = json.load(batch_file)
+        if saved["key"] != batch_key:
+            return None
+        if not saved["hits"]:
+            return None, None
+        return pd.read_parquet(f"{saved_dir}/hits.parquet"), SeqIO.to_dict(SeqIO.parse(f"{saved_dir}/targets.fasta", "fasta"))
+
+    # the copies (queries with the same sequence) reuse the alignment and tree of the first one
+    async def process_query_copies(self, query_record, copy_records, homologs_df, target_records):
+        await self.process_query(query_record, homologs_df, target_records)
+        for copy_record in copy_records:
+            await self.process_query(copy_record, homologs_df, target_records, shared_from=query_record.id)
+
+    async def process_query(self, query_record, homologs_df, target_records, shared_from=None):
+        query_id = query_record.id
+        aligned_file = f"{self.mmseqs_workdir}/alignments/{query_id}_aligned.fasta"
+        output_tree = f"{self.mmseqs_workdir}/trees/{query_id}_tree.nwk"
+
+        # aligning the query with its homologs (same key as align_sequences)
+        alignment_key = manifest_key(str(query_record.seq).upper(), sorted(zip(homologs_df["tseqid"], homologs_df["proteinid"].astype(str))), ALIGN_MODES[self.align_mode])
+        if os.path.exists(aligned_file) and self.manifest["alignments"].get(query_id) == alignment_key:
+            self.counts["aligned_skipped"] += 1
+        else:
+            shared_alignment = f"{self.mmseqs_workdir}/alignments/{shared_from}_aligned.fasta"
+            try:
+                if shared_from is not None and os.path.exists(shared_alignment) and self.manifest_or_finished("alignments", shared_from) == alignment_key:
+                    share_alignment(shared_alignment, query_record, aligned_file)
+                else:
+                    async with self.align_slots:
+                        await self.align(query_record, homologs_df, target_records, aligned_file)
+            except RuntimeError as e:
+                self.counts["align_failed"].append(query_id)
+                print(Fore.RED + Style.BRIGHT + f"Error alineando {query_id}: {e}")
+                return
+            self.counts["aligned"] += 1
+            self.finished["alignments"][query_id] = alignment_key
+
+        # building its tree
+        tree_key = manifest_key(file_hash(aligned_file), "FastTree")
+        if tree_is_current(output_tree, aligned_file, self.manifest["trees"].get(query_id), tree_key):
+            self.counts["trees_skipped"] += 1
+        else:
+            try:
+                if not self.share_tree(shared_from, aligned_file, query_id, output_tree):
+                    async with self.tree_slots:
+                        await _run_tool_async([self.fasttree, aligned_file], output_tree, env=self.fasttree_env, metrics=self.metrics, stage="tree", executor=self.executor)
+            except RuntimeError as e:
+                self.counts["tree_failed"].append(query_id)
+                print(Fore.RED + Style.BRIGHT + f"{e} for {query_id}")
+                return
+            self.counts["trees"] += 1
+            self.finished["trees"][query_id] = tree_key
+            print(Fore.GREEN + Style.BRIGHT + f"Tree saved in {output_tree}")
+        self.save_manifest()
+
+    # the query is added to the reference alignment of its homologs if there is one (align_mode="add")
+    async def align(self, query_record, homologs_df, target_records, aligned_file):
+        loop = asyncio.get_running_loop()
+        key = profile_key(homologs_df, self.db_name) if self.profile_cache is not None else None
+        profile = await loop.run_in_executor(self.executor, self.profile_cache.get, key) if self.profile_cache is not None else None
+        if profile is not None:
+            await loop.run_in_executor(self.executor, add_to_profile, query_record, profile, aligned_file, self.tool_threads, self.metrics)
+            return
+        await _run_tool_async(["mafft", "--auto", "--thread", str(self.tool_threads), "-"], aligned_file, input_text=homologs_fasta(query_record, homologs_df, target_records), metrics=self.metrics, stage="align", executor=self.executor)
+        if self.profile_cache is not None:
+            await loop.run_in_executor(self.executor, store_profile, self.profile_cache, key, aligned_file)
+
+    # key of an alignment or tree done in this run or recorded before
+    def manifest_or_finished(self, section, query_id):
+        return self.finished[section].get(query_id, self.manifest[section].get(query_id))
+
+    # it copies the tree of shared_from if its alignment is the same but for the query name
+    def share_tree(self, shared_from, aligned_file, query_id, output_tree):
+        if shared_from is None or shared_from in self.counts["tree_failed"]:
+            return False
+        shared_alignment = f"{self.mmseqs_workdir}/alignments/{shared_from}_aligned.fasta"
+        shared_tree = f"{self.mmseqs_workdir}/trees/{shared_from}_tree.nwk"
+        if not os.path.exists(shared_tree) or not os.path.exists(shared_alignment) or alignment_share_key(aligned_file) != alignment_share_key(shared_alignment):
+            return False
+        try:
+            share_tree(shared_tree, shared_from, query_id, output_tree)
+        except ValueError:
+            return False
+        return True
+
+    # recording the finished alignments and trees in the manifest every few seconds
+    def save_manifest(self, force=False):
+        if not force and time.time() - self.last_saved < 5:
+            return
+        for section, entries in self.finished.items():
+            if entries:
+                update_manifest(self.mmseqs_workdir, section, entries)
+                self.manifest[section].update(entries)
+        self.finished = {"alignments": {}, "trees": {}}
+        self.last_saved = time.time()
 
 '''
 # Plot results
@@ -543,6 +2752,30 @@ def show_results(job_name, query_id="all"):
     subprocess.run(["streamlit", "run", app_script, "--", 
                     "--job_name", job_name, "--query_id", query_id])
 
+'''
+# Search server
+########################
+
+This function starts a server (ipf_serve.py) that keeps the database and its
+metadata loaded and answers searches over HTTP (POST /search with the sequences
+in fasta format). The requests received within batch_window seconds are searched
+together with a single mmseqs2 call, which is much faster than running
+find_matches for each one when many small searches are submitted.
+'''
+
+def serve(host="127.0.0.1", port=8750, db_name="arthropods_OrthoDB", batch_window=0.2, max_batch=500, threads=None):
+    from inprotfind.ipf_serve import run_server
+
+    verifying_mmseqs2()
+    if not os.path.exists(f"{database_path(db_name)}/{db_name}DB"):
+        print(Fore.RED + Style.BRIGHT + f"The database {db_name} is not installed.")
+        print(Fore.RED + Style.BRIGHT + "Execution stopped. Returning to the prompt line.")
+        return
+    if not os.path.exists(database_path(f"{db_name}_metadata.arrow")):
+        build_metadata_index(db_name)
+
+    run_server(host, port, db_name, batch_window, max_batch, resolve_threads(threads))
+
 ############################
 #  COMPLEMENTARY FUNCTIONS #
 ############################
@@ -577,13 +2810,533 @@ def verifying_mafft():
 # It checks if fasttree is installed
 def verifying_fasttree():
     try:
-        subprocess.run(["FastTree", "-help"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        subprocess.run([fasttree_executable(), "-help"], stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
     except subprocess.CalledProcessError as e:
         print("Error verifying FastTree:", e)
     except FileNotFoundError:
         raise EnvironmentError("FastTree is not installed or is not in the PATH. Please, install it before using 'inprotfind.build_tree' function")
 
 
+'''
+# metadata index functions
+##########################
+
+build_metadata_index converts the metadata of a database (a parquet file) into
+an uncompressed Arrow file (<db_name>_metadata.arrow) with just the columns 
+needed to annotate the results, sorted by ID. It is sorted by batches, saved 
+as sorted runs in a temporal folder and merged (_merge_sorted_runs), so the 
+memory used does not depend on the size of the database. The Arrow file is 
+memory mapped by lookup_metadata, which finds each ID requested by binary 
+search and only copies to memory their rows, and annotate_hits uses it to add
+the metadata to a table of hits (the target ID is in its second column). 
+Files built by older versions (not sorted) are rebuilt on first use.
+'''
+
+METADATA_COLUMNS = ['ID', 'Organism', 'GenomeID', 'PubProtID', 'PubGeneID', 'Description']
+
+def build_metadata_index(db_name="arthropods_OrthoDB"):
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    metadata_path = database_path(f"{db_name}_metadata.parquet")
+    index_path = database_path(f"{db_name}_metadata.arrow")
+    
+    parquet_file = pq.ParquetFile(metadata_path)
+    schema = parquet_file.schema_arrow
+    schema = pa.schema([schema.field(column) for column in METADATA_COLUMNS])
+    
+    schema = schema.with_metadata({"sorted_by": "ID"})
+    
+    # sorted runs of one batch each
+    runs_dir = tempfile.mkdtemp(prefix="metadata_runs_", dir=database_path())
+    try:
+        runs = []
+        for batch in parquet_file.iter_batches(batch_size=262144, columns=METADATA_COLUMNS):
+            run = pa.Table.from_batches([batch]).sort_by("ID")
+            runs.append(f"{runs_dir}/{len(runs)}.arrow")
+            with pa.OSFile(runs[-1], "wb") as sink:
+                with pa.ipc.new_file(sink, schema) as writer:
+                    writer.write_table(run)
+        
+        # writing to a temporal file, so an interrupted build never looks complete
+        with pa.OSFile(index_path + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, schema) as writer:
+                for batch in _merge_sorted_runs(runs, schema):
+                    writer.write_batch(batch)
+        os.replace(index_path + ".tmp", index_path)
+    finally:
+        shutil.rmtree(runs_dir, ignore_errors=True)
+    
+    # the mapped file may have changed
+    _open_metadata_index.cache_clear()
+    return index_path
+
+# it merges the sorted runs (arrow files) in batches of batch_size rows, reading one batch of each run at a time
+def _merge_sorted_runs(runs, schema, batch_size=262144):
+    import pyarrow as pa
+    
+    def rows(path):
+        with pa.memory_map(path, "r") as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                batch = reader.get_batch(i)
+                yield from zip(*[batch.column(column).to_pylist() for column in METADATA_COLUMNS])
+    
+    # stable: the rows with the same ID keep the order of the parquet
+    merged = heapq.merge(*[rows(path) for path in runs], key=lambda row: row[0])
+    while True:
+        chunk = [row for _, row in zip(range(batch_size), merged)]
+        if not chunk:
+            break
+        yield pa.RecordBatch.from_arrays([pa.array(column, type=schema.field(i).type) for i, column in enumerate(zip(*chunk))], schema=schema)
+
+# the mapped table stays open for the life of the process
+@functools.lru_cache(maxsize=None)
+def _open_metadata_index(index_path):
+    import pyarrow as pa
+    source = pa.memory_map(index_path, "r")
+    return pa.ipc.open_file(source).read_all()
+
+# sorted sequence of the IDs of the mapped table, read one at a time by bisect
+class _SortedIDs:
+
+    def __init__(self, column):
+        self.column = column
+
+    def __len__(self):
+        return len(self.column)
+
+    def __getitem__(self, i):
+        return self.column[i].as_py()
+
+def lookup_metadata(ids, db_name="arthropods_OrthoDB"):
+    import pandas as pd
+    import pyarrow as pa
+    index_path = database_path(f"{db_name}_metadata.arrow")
+    table = _open_metadata_index(index_path)
+    if (table.schema.metadata or {}).get(b"sorted_by") != b"ID":
+        build_metadata_index(db_name)
+        table = _open_metadata_index(index_path)
+    
+    # the IDs are looked up in order, each one after the previous
+    sorted_ids = _SortedIDs(table.column("ID"))
+    rows = []
+    low = 0
+    for wanted in sorted(pd.unique(pd.Series(ids, dtype=str))):
+        low = bisect.bisect_left(sorted_ids, wanted, low)
+        if low < len(sorted_ids) and sorted_ids[low] == wanted:
+            rows.append(low)
+    metadata = table.take(pa.array(rows, type=pa.int64())).to_pandas()
+    
+    return metadata.set_index("ID")
+
+def annotate_hits(hits_df, db_name="arthropods_OrthoDB"):
+    metadata = lookup_metadata(hits_df[1], db_name)
+    for column in METADATA_COLUMNS[1:]:
+        hits_df[column] = hits_df[1].map(metadata[column])
+    return hits_df
+
+
+'''
+# manifest functions
+####################
+
+Each job folder has a manifest (manifest.json) recording the stages completed
+by find_matches ("stages") and the alignments and trees built ("alignments" 
+and "trees"), each of them with a key computed from its inputs and 
+parameters (manifest_key). A stage or file is up to date when its recorded key
+matches the current one and its output files exist, so a job can be resumed 
+after a crash without redoing the valid work. The manifest is always written 
+merged with the last version on disk and replaced atomically.
+'''
+
+def load_manifest(job_name):
+    manifest = {"stages": {}, "alignments": {}, "trees": {}, "bootstrap": {}}
+    if os.path.exists(f"{job_name}/manifest.json"):
+        with open(f"{job_name}/manifest.json", "r") as file:
+            manifest.update(json.load(file))
+    return manifest
+
+def update_manifest(job_name, section, entries):
+    manifest = load_manifest(job_name)
+    manifest[section].update(entries)
+    with open(f"{job_name}/manifest.json.tmp", "w") as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(f"{job_name}/manifest.json.tmp", f"{job_name}/manifest.json")
+    return manifest
+
+def manifest_key(*parts):
+    return hashlib.sha256(json.dumps(parts, default=str).encode()).hexdigest()
+
+def stage_is_current(manifest, stage, key, outputs=()):
+    record = manifest["stages"].get(stage)
+    return record is not None and record["key"] == key and all(os.path.exists(output) for output in outputs)
+
+def record_stage(job_name, manifest, stage, key, inputs=None, params=None, seconds=None):
+    record = {"key": key, "inputs": inputs or {}, "params": params or {}, "finished": time.strftime("%Y-%m-%d %H:%M:%S"), "seconds": seconds}
+    manifest["stages"][stage] = record
+    update_manifest(job_name, "stages", {stage: record})
+
+def file_hash(path, block_size=1048576):
+    content_hash = hashlib.sha256()
+    with open(str(path), "rb") as file:
+        for data in iter(lambda: file.read(block_size), b""):
+            content_hash.update(data)
+    return content_hash.hexdigest()
+
+# It identifies the installed version of a database (or of its metadata index)
+def database_stamp(db_name, metadata=False):
+    path = database_path(f"{db_name}_metadata.arrow") if metadata else database_path(f"{db_name}/{db_name}DB.index")
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return f"{stat.st_size}-{int(stat.st_mtime)}"
+
+
+'''
+# metrics functions
+###################
+
+Every entry point (find_matches, align_sequences, build_tree, run_pipeline) 
+appends its performance metrics to <job_name>/metrics.jsonl, one JSON record 
+per line: a "tool" record for every call to mmseqs2, MAFFT or FastTree (wall
+time, user/system CPU time and peak memory of the tool, sizes of its input and
+output), a "stage" record for every stage (wall time, CPU time of inprotfind
+and of the tools run meanwhile, peak memory, and the number of queries and 
+hits processed) and a "run" record with the totals. The peak memory of the 
+tools (children_max_rss_mb) is the largest one of the tools run in the stage 
+(or in the run), as returned by wait4, while max_rss_mb is the peak memory of
+the Python process since it started. All the records of a 
+call share the same "run" id, so the metrics of concurrent or repeated runs 
+can be told apart. The CPU times and peak memory are taken from the resource
+module and wait4, which only exist in Unix: in other systems only the wall 
+times and sizes are recorded.
+'''
+
+class JobMetrics:
+
+    def __init__(self, job_name, entry_point):
+        self.path = f"{job_name}/metrics.jsonl"
+        self.entry_point = entry_point
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.lock = threading.Lock()
+        self.start = self._usage()
+        self.stages = {}
+        self.tool_peaks = {}  # stage -> largest peak memory (MB) of its tools
+        self.run_peak = None
+
+    def write(self, record):
+        line = json.dumps({"run": self.run_id, "entry_point": self.entry_point, "time": time.strftime("%Y-%m-%d %H:%M:%S"), **record}) + "\n"
+        with self.lock:
+            if os.path.isdir(os.path.dirname(self.path)):
+                with open(self.path, "a") as metrics_file:
+                    metrics_file.write(line)
+
+    def tool(self, stage, args, returncode, seconds, usage, input_bytes, output_bytes):
+        record = {"type": "tool", "stage": stage, "tool": _tool_name(args), "returncode": returncode, "wall_seconds": round(seconds, 4)}
+        if usage is not None:
+            record.update(user_seconds=round(usage.ru_utime, 4), system_seconds=round(usage.ru_stime, 4), max_rss_mb=round(usage.ru_maxrss / 1024, 2))
+            with self.lock:
+                self.tool_peaks[stage] = max(self.tool_peaks.get(stage) or 0, record["max_rss_mb"])
+                self.run_peak = max(self.run_peak or 0, record["max_rss_mb"])
+        self.write({**record, "input_bytes": input_bytes, "output_bytes": output_bytes})
+
+    def begin(self, stage):
+        self.stages[stage] = self._usage()
+        with self.lock:
+            self.tool_peaks.pop(stage, None)
+
+    # it records the stage and returns its wall time
+    def end(self, stage, **counts):
+        with self.lock:
+            tool_peak = self.tool_peaks.pop(stage, None)
+        record = self._since(self.stages.pop(stage), tool_peak)
+        self.write({"type": "stage", "stage": stage, **record, **counts})
+        return record["wall_seconds"]
+
+    def finish(self, **counts):
+        self.write({"type": "run", **self._since(self.start, self.run_peak), **counts})
+
+    @staticmethod
+    def _usage():
+        try:
+            import resource
+        except ImportError:
+            # not in Unix
+            return time.time(), None, None
+        return time.time(), resource.getrusage(resource.RUSAGE_SELF), resource.getrusage(resource.RUSAGE_CHILDREN)
+
+    # tool_peak is the largest peak memory (MB) of the tools run since start (None if there were none)
+    def _since(self, start, tool_peak=None):
+        end = self._usage()
+        if end[1] is None:
+            return {"wall_seconds": round(end[0] - start[0], 4)}
+        return {"wall_seconds": round(end[0] - start[0], 4),
+                "user_seconds": round(end[1].ru_utime - start[1].ru_utime, 4), "system_seconds": round(end[1].ru_stime - start[1].ru_stime, 4),
+                "children_user_seconds": round(end[2].ru_utime - start[2].ru_utime, 4), "children_system_seconds": round(end[2].ru_stime - start[2].ru_stime, 4),
+                "max_rss_mb": round(end[1].ru_maxrss / 1024, 2), "children_max_rss_mb": tool_peak}
+
+
+'''
+# hit cache functions
+#####################
+
+HitCache keeps the search results of the jobs run with use_cache=True in a 
+cache shared by all of them: a sqlite database (hits.sqlite) in the folder set 
+in the environment variable INPROTFIND_CACHE_DIR (~/.cache/inprotfind by 
+default). Each entry 
+holds the annotated hits of one query sequence (an empty list if it has no 
+hits), and its key (hit_cache_key) is made of the hash of the sequence, the 
+installed version of the database and of its metadata, and the search 
+parameters (evalue, min_seq_id and max_seqs). find_matches searches only the 
+sequences not found in the cache, and saves the hit list of each new one at 
+once when the search is finished, so an interrupted job leaves no partial 
+entries. When the cache grows over max_size_mb 
+(INPROTFIND_CACHE_SIZE_MB, 1024 MB by default), the entries used least 
+recently are removed. The hits and misses of the lookups are counted in 
+'stats'. read_cached_hits reads the hits taken from the cache by a job.
+'''
+
+def hit_cache_key(sequence, db_name, evalue, min_seq_id, max_seqs=100):
+    return manifest_key(sequence_hash(sequence), db_name, database_stamp(db_name), database_stamp(db_name, metadata=True), evalue, min_seq_id, max_seqs)
+
+class HitCache:
+
+    def __init__(self, cache_dir=None, max_size_mb=None):
+        self.cache_dir = cache_dir or os.environ.get("INPROTFIND_CACHE_DIR") or os.path.join(os.path.expanduser("~"), ".cache", "inprotfind")
+        self.max_size = int(float(max_size_mb or os.environ.get("INPROTFIND_CACHE_SIZE_MB") or 1024) * 1048576)
+        self.stats = {"hits": 0, "misses": 0, "evicted": 0}
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # several jobs may use the cache at the same time (each one waits for the others to write)
+        self.connection = sqlite3.connect(os.path.join(self.cache_dir, "hits.sqlite"), timeout=60)
+        with self.connection:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS hits (key TEXT PRIMARY KEY, hits TEXT NOT NULL, size INTEGER NOT NULL, last_used REAL NOT NULL)")
+            self.connection.execute("CREATE INDEX IF NOT EXISTS hits_last_used ON hits (last_used)")
+
+    # it returns {key: rows} for the keys found in the cache
+    def get(self, keys):
+        keys = list(keys)
+        found = {}
+        for first in range(0, len(keys), 500):
+            part = keys[first:first + 500]
+            rows = self.connection.execute(f"SELECT key, hits FROM hits WHERE key IN ({', '.join('?' * len(part))})", part).fetchall()
+            found.update((key, json.loads(hits)) for key, hits in rows)
+        with self.connection:
+            self.connection.executemany("UPDATE hits SET last_used = ? WHERE key = ?", [(time.time(), key) for key in found])
+        self.stats["hits"] += len(found)
+        self.stats["misses"] += len(keys) - len(found)
+        return found
+
+    # entries is {key: rows}, each one the whole hit list of a sequence
+    def put(self, entries):
+        with self.connection:
+            for key, rows in entries.items():
+                hits = json.dumps(rows)
+                self.connection.execute("INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)", (key, hits, len(hits), time.time()))
+        self.evict()
+
+    # the entries used least recently are removed until the cache is at 90% of its maximum size
+    def evict(self):
+        total = self.connection.execute("SELECT COALESCE(SUM(size), 0) FROM hits").fetchone()[0]
+        if total <= self.max_size:
+            return
+        removed = []
+        for key, size in self.connection.execute("SELECT key, size FROM hits ORDER BY last_used").fetchall():
+            if total <= self.max_size * 0.9:
+                break
+            removed.append((key,))
+            total -= size
+        with self.connection:
+            self.connection.executemany("DELETE FROM hits WHERE key = ?", removed)
+        self.stats["evicted"] += len(removed)
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def close(self):
+        self.connection.close()
+
+# it returns the hits taken from the cache (a table) and the keys of the sequences searched
+def read_cached_hits(path):
+    import pandas as pd
+    if not os.path.exists(path):
+        return None, None
+    with open(path) as cached_file:
+        cached = json.load(cached_file)
+    rows = [[query_id] + row for query_id, hits in cached["hits"].items() for row in hits]
+    return pd.DataFrame(rows, columns=BEST_MATCHES_HEADER), cached["searched"]
+
+# it adds to entries ({key: rows}) the hits of the sequences searched (keys is {qseqid: key})
+def collect_hits(hits_df, keys, entries):
+    for query_id, query_hits in hits_df.groupby("qseqid", sort=False):
+        if query_id in keys:
+            entries.setdefault(keys[query_id], []).extend(query_hits[BEST_MATCHES_HEADER[1:]].astype(object).where(query_hits[BEST_MATCHES_HEADER[1:]].notna(), None).values.tolist())
+    return entries
+
+# it saves in the cache the hits of the sequences searched (keys is {qseqid: key})
+def store_hits(hit_cache, hits_df, keys):
+    entries = collect_hits(hits_df, keys, {})
+    hit_cache.put(entries)
+    return set(entries)
+
+
+'''
+# database_path function
+########################
+
+It returns the path of a file or folder (name) in the folder where the 
+databases are installed: the 'databases' folder of the inprotfind library, or
+the one set in the environment variable INPROTFIND_DB_DIR.
+'''
+
+def database_path(name=""):
+    databases_dir = os.environ.get("INPROTFIND_DB_DIR") or str(pkg_resources.files("inprotfind").joinpath("databases"))
+    return os.path.join(databases_dir, name) if name else databases_dir
+
+
+'''
+# thread functions
+##################
+
+resolve_threads returns the number of CPU threads that the external tools may 
+use: the one passed by the user, the one set in the environment variable 
+INPROTFIND_THREADS, or all the CPUs available to the process. fasttree_executable
+returns FastTreeMP (the multithreaded build of FastTree) if it is installed, 
+and FastTree otherwise.
+'''
+
+def resolve_threads(threads=None):
+    threads = threads or os.environ.get("INPROTFIND_THREADS")
+    if threads:
+        return max(1, int(threads))
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+def fasttree_executable():
+    return "FastTreeMP" if shutil.which("FastTreeMP") else "FastTree"
+
+
+'''
+# tool functions
+################
+
+_run_tool runs an external tool (args is the list of its arguments, with no 
+shell in between). input_text is passed to its standard input, and its 
+standard output is written to output_path, through a temporal file renamed 
+when the tool finishes well, so a failed run never leaves a partial output. 
+If the tool fails, a RuntimeError is raised with its exit code and the last 
+line of its error output. If metrics (a JobMetrics) is given, the call is 
+recorded with the CPU time and peak memory of the tool (returned by wait4, 
+where it exists). 
+_run_tool_async runs it from an asyncio task, in a thread of 'executor' (used
+by run_pipeline).
+'''
+
+def _run_tool(args, output_path=None, input_text=None, env=None, metrics=None, stage=None, show_output=False, on_start=None):
+    input_bytes = sum(os.path.getsize(arg) for arg in args if os.path.isfile(arg)) + len(input_text or "")
+    new_files = [arg for arg in args[1:] if not os.path.exists(arg)]
+    start_time = time.time()
+    output_file = open(output_path + ".tmp", "w") if output_path is not None else None
+    try:
+        process = subprocess.Popen(args, stdin=subprocess.PIPE if input_text is not None else subprocess.DEVNULL,
+                                   stdout=output_file if output_file is not None else (None if show_output else subprocess.DEVNULL),
+                                   stderr=None if show_output else subprocess.PIPE, text=True, env=env)
+        if on_start is not None:
+            on_start(process)
+        returncode, stderr, usage = _wait_tool(process, input_text)
+    finally:
+        if output_file is not None:
+            output_file.close()
+    
+    if metrics is not None:
+        if output_path is not None:
+            output_bytes = os.path.getsize(output_path + ".tmp")
+        else:
+            output_bytes = sum(os.path.getsize(path) for path in new_files if os.path.isfile(path))
+        metrics.tool(stage, args, returncode, time.time() - start_time, usage, input_bytes, output_bytes)
+    if returncode != 0:
+        if output_path is not None:
+            os.remove(output_path + ".tmp")
+        raise RuntimeError(_tool_error(args, returncode, stderr))
+    if output_path is not None:
+        os.replace(output_path + ".tmp", output_path)
+
+# the process is reaped with wait4, which returns the resources it used (None where there is no wait4)
+def _wait_tool(process, input_text=None):
+    stderr = []
+    reader = None
+    if process.stderr is not None:
+        reader = threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)
+        reader.start()
+    if process.stdin is not None:
+        try:
+            process.stdin.write(input_text)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+    if reader is not None:
+        reader.join()
+    if not hasattr(os, "wait4"):
+        return process.wait(), "".join(stderr), None
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, "".join(stderr), usage
+
+async def _run_tool_async(args, output_path=None, input_text=None, env=None, metrics=None, stage=None, executor=None):
+    started = []
+    work = asyncio.get_running_loop().run_in_executor(executor, functools.partial(_run_tool, args, output_path, input_text, env, metrics, stage, on_start=started.append))
+    try:
+        await asyncio.shield(work)
+    except asyncio.CancelledError:
+        # the pipeline was stopped: the tool is not left running
+        for process in started:
+            process.kill()
+        await asyncio.gather(work, return_exceptions=True)
+        raise
+
+def _tool_error(args, returncode, stderr):
+    error = (stderr or "").strip().splitlines()
+    return f"{_tool_name(args)} finished with exit code {returncode}" + (f" ({error[-1]})" if error else "")
+
+def _tool_name(args):
+    # the command may be run through a launcher (see run_on_shards)
+    if "mmseqs" in args:
+        return " ".join(args[args.index("mmseqs"):args.index("mmseqs") + 2])
+    return os.path.basename(args[0])
+
+
+'''
+# query index function
+######################
+
+This function returns an index of the query sequences of a job, so any query
+sequence can be retrieved by its qseqid (index[qseqid]) without parsing the 
+whole file again. The queries are converted to fasta (query.fasta) and indexed
+(query.idx) just once per job, and both files are kept in the job folder to be
+reused by align_sequences, build_tree and the report. The index must be closed
+(index.close()) when it is no longer needed. count_queries returns the number
+of sequences of a mmseqs2 query database (one line per sequence in its index).
+'''
+
+def count_queries(mmseqs_querydir):
+    with open(f"{mmseqs_querydir}/queryDB.index") as index_file:
+        return sum(1 for line in index_file)
+
+def get_query_index(job_name):
+    from Bio import SeqIO
+    query_fasta = f"{job_name}/query.fasta"
+    query_index = f"{job_name}/query.idx"
+    
+    if not os.path.exists(query_fasta):
+        # converting the queryDB to fasta (jobs created before the index existed)
+        _run_tool(["mmseqs", "convert2fasta", f"{job_name}/queryDB/queryDB", query_fasta])
+        if os.path.exists(query_index):
+            os.remove(query_index)
+    
+    return SeqIO.index_db(query_index, query_fasta, "fasta")
+
+
 '''
 # example results function
 ##########################
@@ -593,6 +3346,7 @@ in the library. It just need the number of the example (1 to 10).
 '''
 
 def show_example_result(example):
+    import pandas as pd
     example = int(example)
     if example > 0 and example <= 10:
         result = pkg_resources.files("inprotfind").joinpath("query_examples/protein_names.txt")
@@ -626,6 +3380,7 @@ For example, to run the find_matches function:
 
 def main_function():
     parser = argparse.ArgumentParser(description='Procesamiento de secuencias proteicas')
+    parser.add_argument("--profile", action="store_true", help="Profile the command with cProfile and save the profile in the job folder")
     
     # Subparsers for commands
     subparsers = parser.add_subparsers(dest='command', help='Comandos disponibles')
@@ -633,6 +3388,11 @@ def main_function():
     # Subparser for get_database
     parser_get_database = subparsers.add_parser('get_database', help="To download and install the target database")
     parser_get_database.add_argument("--fm_calling", type=bool, default=False, help="Controls if the function is call it from find_matches or not")
+    parser_get_database.add_argument("--connections", type=int, default=1, help="Number of parallel connections used to download the database")
+    parser_get_database.add_argument("--block_size", type=int, default=1048576, help="Size (bytes) of the blocks read during the download")
+    parser_get_database.add_argument("--checksum", type=str, default=None, help="Checksum to verify the download ('md5:...' or 'sha256:...'). The published one is used by default")
+    parser_get_database.add_argument("--url", type=str, default=DATABASE_URL, help="URL of the database (to use a mirror)")
+    parser_get_database.add_argument("--streaming", action="store_true", help="Extract the database while downloading it, without saving the tarball")
     
     # Subparser for find_matches
     parser_find_matches = subparsers.add_parser('find_matches', help='To find coincidences in the database')
@@ -640,17 +3400,76 @@ def main_function():
     parser_find_matches.add_argument("--query_path", type=str, required=True, help="Path to query file for find_matches")
     parser_find_matches.add_argument("--evalue", type=float, default=0.0000000001, help="e value treshold")
     parser_find_matches.add_argument("--min_seq_id", type=float, default=0.7, help="minimum sequence identity")
+    parser_find_matches.add_argument("--streaming", action="store_true", help="Process the results by chunks to keep the memory used flat")
+    parser_find_matches.add_argument("--chunksize", type=int, default=500000, help="Rows per chunk in streaming mode")
+    parser_find_matches.add_argument("--incremental", action="store_true", help="Search only the sequences not yet in an existing job and add their matches")
+    parser_find_matches.add_argument("--warm", action="store_true", help="Keep the database in memory between searches")
+    parser_find_matches.add_argument("--threads", type=int, default=None, help="Number of CPU threads used (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_find_matches.add_argument("--use_cache", action="store_true", help="Take from the hit cache (INPROTFIND_CACHE_DIR) the matches of the sequences already searched")
+    parser_find_matches.add_argument("--sharded", action="store_true", help="Search the shards of the database (see split_database) at the same time, through INPROTFIND_LAUNCHER if it is set")
+    parser_find_matches.add_argument("--db_name", type=str, default="arthropods_OrthoDB", help="Name of the database (arthropods_OrthoDB or one made with create_targetDB)")
+    
+    # Subparsers for create_index and warm_database
+    parser_create_index = subparsers.add_parser('create_index', help="To precompute the search index of a database")
+    parser_create_index.add_argument("--db_name", type=str, default="arthropods_OrthoDB", help="Name of the database")
+    parser_create_index.add_argument("--threads", type=int, default=None, help="Number of CPU threads used (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_warm_database = subparsers.add_parser('warm_database', help="To load a database in memory for faster searches")
+    parser_warm_database.add_argument("--db_name", type=str, default="arthropods_OrthoDB", help="Name of the database")
+    
+    # Subparser for create_targetDB
+    parser_create_targetDB = subparsers.add_parser('create_targetDB', help="To create a custom database from a fasta file")
+    parser_create_targetDB.add_argument("--db_name", type=str, required=True, help="Name of the new database")
+    parser_create_targetDB.add_argument("--fasta_path", type=str, required=True, help="Fasta file with the sequences of the database (it may be gzipped)")
+    parser_create_targetDB.add_argument("--metadata_path", type=str, default=None, help="Annotation table (parquet, csv or tsv) with an ID column; by default the metadata is taken from the fasta headers")
+    parser_create_targetDB.add_argument("--threads", type=int, default=None, help="Number of CPU threads used (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_create_targetDB.add_argument("--no_index", action="store_true", help="Do not precompute the search index of the database")
+    
+    # Subparser for split_database
+    parser_split_database = subparsers.add_parser('split_database', help="To split a database in shards searched at the same time")
+    parser_split_database.add_argument("--db_name", type=str, default="arthropods_OrthoDB", help="Name of the database")
+    parser_split_database.add_argument("--shards", type=int, default=4, help="Number of shards")
+    parser_split_database.add_argument("--threads", type=int, default=None, help="Number of CPU threads used (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_split_database.add_argument("--no_index", action="store_true", help="Do not precompute the search index of the shards")
     
     # Subparser for align_sequences
     parser_align_sequences = subparsers.add_parser('align_sequences', help='To align sequences')
     parser_align_sequences.add_argument("--job_name", type=str, required=True, help="Name of the 'job' for align_sequences")
     parser_align_sequences.add_argument("--ids_to_align", nargs='+', default=None, help="List of query ids to align")
+    parser_align_sequences.add_argument("--jobs", type=int, default=1, help="Number of queries aligned in parallel")
+    parser_align_sequences.add_argument("--threads", type=int, default=None, help="Number of CPU threads shared by the parallel alignments (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_align_sequences.add_argument("--align_mode", type=str, default="auto", choices=list(ALIGN_MODES), help="'auto' aligns every query from scratch (mafft --auto), 'add' adds it to the cached alignment of its homologs if there is one (mafft --add)")
 
     # Subparser for build_tree
     parser_build_tree = subparsers.add_parser('build_tree', help='To build the phylogenetic tree')
     parser_build_tree.add_argument("--job_name", type=str, required=True, help="Name of the 'job' for build_tree")
     parser_build_tree.add_argument("--query_id", type=str, default=None, help="Name of the query to build its tree")
     parser_build_tree.add_argument("--tree_type", type=str, default="simple", help="Tree type for build_tree. It may be 'simple' (default) or 'interactive'")
+    parser_build_tree.add_argument("--jobs", type=int, default=1, help="Number of trees built in parallel")
+    parser_build_tree.add_argument("--threads", type=int, default=None, help="Number of CPU threads shared by FastTreeMP runs (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_build_tree.add_argument("--bootstrap", type=int, default=0, help="Number of bootstrap replicates used to compute the supports of the trees (0, no bootstrap, by default)")
+
+    # Subparser for serve
+    parser_serve = subparsers.add_parser('serve', help="To start a server that answers searches over HTTP")
+    parser_serve.add_argument("--host", type=str, default="127.0.0.1", help="Address where the server listens")
+    parser_serve.add_argument("--port", type=int, default=8750, help="Port where the server listens")
+    parser_serve.add_argument("--db_name", type=str, default="arthropods_OrthoDB", help="Name of the database")
+    parser_serve.add_argument("--batch_window", type=float, default=0.2, help="Seconds to wait for more requests to search them together")
+    parser_serve.add_argument("--max_batch", type=int, default=500, help="Maximum number of requests searched together")
+    parser_serve.add_argument("--threads", type=int, default=None, help="Number of CPU threads used by the searches (INPROTFIND_THREADS or all the CPUs by default)")
+
+    # Subparser for run_pipeline
+    parser_run_pipeline = subparsers.add_parser('run_pipeline', help="To search, align and build the trees overlapping the stages")
+    parser_run_pipeline.add_argument("--job_name", type=str, required=True, help="Name of the 'job'")
+    parser_run_pipeline.add_argument("--query_path", type=str, required=True, help="Path to query file")
+    parser_run_pipeline.add_argument("--evalue", type=float, default=0.0000000001, help="e value treshold")
+    parser_run_pipeline.add_argument("--min_seq_id", type=float, default=0.7, help="minimum sequence identity")
+    parser_run_pipeline.add_argument("--batch_size", type=int, default=100, help="Number of queries searched together")
+    parser_run_pipeline.add_argument("--align_jobs", type=int, default=2, help="Number of alignments run at the same time")
+    parser_run_pipeline.add_argument("--tree_jobs", type=int, default=2, help="Number of trees built at the same time")
+    parser_run_pipeline.add_argument("--threads", type=int, default=None, help="Number of CPU threads used (INPROTFIND_THREADS or all the CPUs by default)")
+    parser_run_pipeline.add_argument("--warm", action="store_true", help="Keep the database in memory between searches")
+    parser_run_pipeline.add_argument("--align_mode", type=str, default="auto", choices=list(ALIGN_MODES), help="'auto' aligns every query from scratch (mafft --auto), 'add' adds it to the cached alignment of its homologs if there is one (mafft --add)")
+    parser_run_pipeline.add_argument("--db_name", type=str, default="arthropods_OrthoDB", help="Name of the database (arthropods_OrthoDB or one made with create_targetDB)")
 
     # subparser for show_results
     parser_show_results = subparsers.add_parser('show_results', help='To show the results with Streamlit')
@@ -662,14 +3481,32 @@ def main_function():
     parser_show_example_result.add_argument("--example", type=str, required=True, help="Name of the 'job' for show_results")
     args = parser.parse_args()
 
+    if args.profile:
+        profile_command(args)
+    else:
+        run_command(args)
+
+def run_command(args):
     if args.command == "get_database":
-        get_database(args.fm_calling)
+        get_database(args.fm_calling, args.connections, args.block_size, args.checksum, args.url, args.streaming)
     elif args.command == "find_matches":
-        find_matches(args.job_name, args.query_path, args.evalue, args.min_seq_id)
+        find_matches(args.job_name, args.query_path, args.evalue, args.min_seq_id, args.streaming, args.chunksize, args.incremental, args.warm, args.threads, args.use_cache, args.sharded, db_name=args.db_name)
+    elif args.command == "create_index":
+        create_index(args.db_name, args.threads)
+    elif args.command == "warm_database":
+        warm_database(args.db_name)
+    elif args.command == "create_targetDB":
+        create_targetDB(args.db_name, args.fasta_path, args.metadata_path, args.threads, not args.no_index)
+    elif args.command == "split_database":
+        split_database(args.db_name, args.shards, args.threads, not args.no_index)
     elif args.command == "align_sequences":
-        align_sequences(args.job_name, args.ids_to_align)
+        align_sequences(args.job_name, args.ids_to_align, args.jobs, args.threads, args.align_mode)
     elif args.command == "build_tree":
-        build_tree(args.job_name, args.query_id, args.tree_type)
+        build_tree(args.job_name, args.query_id, args.tree_type, args.jobs, args.threads, args.bootstrap)
+    elif args.command == "run_pipeline":
+        run_pipeline(args.job_name, args.query_path, args.evalue, args.min_seq_id, args.batch_size, args.align_jobs, args.tree_jobs, args.threads, args.warm, args.align_mode, args.db_name)
+    elif args.command == "serve":
+        serve(args.host, args.port, args.db_name, args.batch_window, args.max_batch, args.threads)
     elif args.command == "show_results":
         show_results(args.job_name, args.query_id)
     elif args.command == "show_example_result":
@@ -677,6 +3514,33 @@ def main_function():
     else:
         print("The command was not recognised.")
 
+
+'''
+# profile_command
+#################
+
+It runs a command of the command line under cProfile (inprotfind --profile 
+<command> ...). The profile is saved as profile_<command>.prof in the job 
+folder (or in the current directory for the commands without job), where it 
+can be opened with pstats or snakeviz, and the 15 functions with the highest
+cumulative time are printed. Only the main thread is profiled: the time of 
+the parallel workers shows up as waiting, and the time of the external tools 
+is in metrics.jsonl.
+'''
+
+def profile_command(args):
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(run_command, args)
+    finally:
+        job_name = getattr(args, "job_name", None)
+        profile_path = f"profile_{args.command}.prof"
+        if job_name and os.path.isdir(job_name):
+            profile_path = f"{job_name}/{profile_path}"
+        profiler.dump_stats(profile_path)
+        print(Fore.GREEN + Style.BRIGHT + f"Profile saved in {profile_path}")
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
+
 if __name__ == "__main__":
     main_function()
 
@@ -2,18 +2,51 @@
 # -*- coding: utf-8 -*-
 
 import streamlit as st
-import pandas as pd
-import matplotlib.pyplot as plt
-from Bio import Phylo
 import argparse
 import os
 from io import BytesIO
 
-from ete3 import Tree, TreeStyle, NodeStyle, faces
+try:
+    from inprotfind.inprotfind import get_query_index, read_best_matches, read_best_matches_summary
+except ModuleNotFoundError:
+    # streamlit runs this file as a script, with its folder (where inprotfind.py is) first in sys.path
+    from inprotfind import get_query_index, read_best_matches, read_best_matches_summary
+
+PAGE_SIZES = [25, 50, 100, 500]
+
+# Fecha de modificación de los resultados: las funciones cacheadas las reciben
+# como argumento, así que los datos solo se leen de nuevo si el trabajo cambia
+def results_mtime(job_name):
+    paths = [f"{job_name}/best_matches.parquet", f"{job_name}/best_matches.m8"]
+    return max((os.path.getmtime(path) for path in paths if os.path.exists(path)), default=0)
+
+# Resumen por consulta (número de hits, mejor e-value, primer organismo...)
+@st.cache_data(max_entries=8)
+def load_summary(job_name, mtime):
+    return read_best_matches_summary(job_name)
+
+# Filas de unas consultas (se leen solo los row groups que las contienen)
+@st.cache_data(max_entries=256)
+def load_rows(job_name, query_ids, mtime):
+    return read_best_matches(job_name, query_id=list(query_ids))
+
+# Imagen del árbol: el PNG se dibuja de nuevo solo si es más antiguo que el .nwk
+@st.cache_data(max_entries=64)
+def load_tree_image(tree_file, output_file, tree_mtime, label_size, highlight_seq, vertical_margin):
+    if not os.path.exists(output_file) or os.path.getmtime(output_file) < tree_mtime:
+        if draw_with_ete(tree_file=tree_file, output_file=output_file, label_size=label_size, highlight_seq=highlight_seq, vertical_margin=vertical_margin) is None:
+            return None
+    if not os.path.exists(output_file):
+        return None
+    with open(output_file, 'rb') as image_file:
+        return image_file.read()
 
 # Función para dibujar y guardar el árbol de ete3
 def draw_with_ete(tree_file, output_file, label_size=10, highlight_seq=None, vertical_margin=10):
     try:
+        # ete3 (y Qt) solo se cargan si hay que dibujar un árbol
+        from ete3 import Tree, TreeStyle, NodeStyle, faces
+        
         # Cargar el árbol usando el formato adecuado
         tree = Tree(tree_file, format=1)  # Ajusta 'format' si es necesario
 
@@ -81,24 +114,43 @@ if __name__ == "__main__":
 
     # Managing directories
     mmseqs_workdir = args.job_name
-    
-
-    best_matches_file = f'{mmseqs_workdir}/best_matches.m8'
-    
-    # Cargar el archivo de resultados como un DataFrame
-    df = pd.read_csv(best_matches_file, sep='\t', header=None, skiprows=1)
-    df.columns = ['qseqid', 'tseqid', 'pident', 'length', 'mismatch', 'gapopen', 'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore', 'organism', 'genomeid', 'proteinid', 'geneid', 'description']
+    mtime = results_mtime(mmseqs_workdir)
 
+    # Cargar los resultados (solo las filas de la consulta pedida)
     if not args.query_id == "all":
-        output = df[df['qseqid'] == args.query_id]
+        output = load_rows(mmseqs_workdir, (args.query_id,), mtime)
         st.title(f"Report of {mmseqs_workdir}: {args.query_id}")
     else:
-        output = df
+        summary = load_summary(mmseqs_workdir, mtime)
         st.title(f"Report of {mmseqs_workdir}: All")
         
+    if not args.query_id == "all" and os.path.isdir(f"{mmseqs_workdir}/queryDB"):
+        # Mostrar la secuencia de consulta a partir del índice del trabajo
+        query_index = get_query_index(mmseqs_workdir)
+        if args.query_id in query_index:
+            query_record = query_index[args.query_id]
+            st.header("Query sequence")
+            st.text(f"{query_record.id} ({len(query_record.seq)} aa)")
+            st.code(str(query_record.seq), language=None)
+        query_index.close()
+
     st.header("Homology searching results")
-    # Mostrar la tabla
-    st.dataframe(output)
+    if not args.query_id == "all":
+        # Mostrar la tabla
+        st.dataframe(output)
+    else:
+        # Paginación en el servidor: solo se leen y se envían las filas de la página
+        st.text(f"{len(summary)} queries with matches, {int(summary['hits'].sum())} matches in total")
+        column_size, column_page = st.columns(2)
+        page_size = column_size.selectbox("Queries per page", PAGE_SIZES, index=1)
+        n_pages = max(1, -(-len(summary) // page_size))
+        page = int(column_page.number_input(f"Page (of {n_pages})", min_value=1, max_value=n_pages, value=1, step=1))
+        page_summary = summary.iloc[(page - 1) * page_size:page * page_size]
+        
+        st.subheader("Summary per query")
+        st.dataframe(page_summary.drop(columns=["first_row"]).reset_index(drop=True))
+        st.subheader("Matches of the queries in this page")
+        st.dataframe(load_rows(mmseqs_workdir, tuple(page_summary["qseqid"]), mtime))
 
     if not args.query_id == "all":
         tree_file = f'{mmseqs_workdir}/trees/{args.query_id}_tree.nwk'    
@@ -112,10 +164,10 @@ if __name__ == "__main__":
             branch_width = 2
             vertical_margin = 6
             output_file = f'{mmseqs_workdir}/trees/{args.query_id}_tree.png'    
-            output_image = draw_with_ete(tree_file=tree_file, output_file=output_file, label_size=label_size, highlight_seq=highlight_seq, vertical_margin=vertical_margin)
+            output_image = load_tree_image(tree_file, output_file, os.path.getmtime(tree_file), label_size, highlight_seq, vertical_margin)
     
             # Verificar si se generó la imagen correctamente
-            if output_image and os.path.exists(output_image):
+            if output_image:
                 # Mostrar la imagen en Streamlit
-                image_bytes = BytesIO(open(output_image, 'rb').read())
+                image_bytes = BytesIO(output_image)
                 st.image(image_bytes, use_column_width=True)
@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+'''
+Search server of inprotfind (run with "inprotfind serve"). It keeps the target
+database warm and its metadata index mapped, and it accepts queries over HTTP:
+
+  POST /search  {"fasta": ">id\\nSEQUENCE...", "evalue": 1e-10, "min_seq_id": 0.7, "top": 30}
+  GET  /status
+
+Requests arriving within a short window (batch_window seconds) with the same
+search parameters are grouped in a single mmseqs2 search, and the results are
+split back to each request. The answer to /search is a JSON object with the
+hits of each query sequence ({"results": {"id": [hit, ...]}}), each hit with
+the same fields as best_matches.m8.
+'''
+
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from inprotfind.inprotfind import (BEST_MATCHES_HEADER, _run_tool, annotate_hits, database_path,
+                                   lookup_metadata, search_options, warm_database)
+
+
+# It groups the requests received within batch_window seconds and searches them together
+class SearchBatcher:
+
+    def __init__(self, db_name, batch_window=0.2, max_batch=500, threads=None, workdir=None):
+        self.db_name = db_name
+        self.threads = threads
+        self.batch_window = batch_window
+        self.max_batch = max_batch
+        self.workdir = workdir or tempfile.mkdtemp(prefix="inprotfind_serve_")
+        self.requests = queue.Queue()
+        self.stats = {"requests": 0, "batches": 0, "sequences": 0, "search_seconds": 0.0}
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, records, evalue, min_seq_id, top):
+        future = Future()
+        self.requests.put((records, evalue, min_seq_id, top, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            deadline = time.monotonic() + self.batch_window
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # one search per group of requests with the same parameters
+            groups = {}
+            for request in batch:
+                groups.setdefault((request[1], request[2]), []).append(request)
+            for (evalue, min_seq_id), requests in groups.items():
+                try:
+                    self._search(requests, evalue, min_seq_id)
+                except Exception as e:
+                    for request in requests:
+                        if not request[4].done():
+                            request[4].set_exception(e)
+
+    def _search(self, requests, evalue, min_seq_id):
+        mmseqs_targetdir = database_path(self.db_name)
+        batch_dir = tempfile.mkdtemp(dir=self.workdir)
+        start_time = time.time()
+        try:
+            # renaming the queries, as different requests may use the same ids
+            owners = {}
+            with open(f"{batch_dir}/queries.fasta", "w") as fasta:
+                for n, (records, _, _, _, _) in enumerate(requests):
+                    for i, (query_id, sequence) in enumerate(records):
+                        batch_id = f"r{n}_{i}"
+                        owners[batch_id] = (n, query_id)
+                        fasta.write(f">{batch_id}\n{sequence}\n")
+
+            target_db = f"{mmseqs_targetdir}/{self.db_name}DB"
+            commands = [["mmseqs", "createdb", f"{batch_dir}/queries.fasta", f"{batch_dir}/queryDB"],
+                        ["mmseqs", "search", f"{batch_dir}/queryDB", target_db, f"{batch_dir}/resultDB", f"{batch_dir}/tmp"] + search_options(evalue, min_seq_id, warm=True, threads=self.threads).split(),
+                        ["mmseqs", "convertalis", f"{batch_dir}/queryDB", target_db, f"{batch_dir}/resultDB", f"{batch_dir}/results.m8"] + (["--threads", str(self.threads)] if self.threads else [])]
+            for command in commands:
+                _run_tool(command)
+
+            # splitting the hits back to each request
+            answers = [{query_id: [] for query_id, _ in request[0]} for request in requests]
+            if os.path.getsize(f"{batch_dir}/results.m8") > 0:
+                import pandas as pd
+                hits_df = pd.read_csv(f"{batch_dir}/results.m8", sep="\t", header=None, dtype={0: str, 1: str})
+                annotate_hits(hits_df, self.db_name)
+                hits_df.columns = BEST_MATCHES_HEADER
+                hits_df = hits_df.astype(object).where(hits_df.notna(), None)
+                for hit in hits_df.to_dict("records"):
+                    n, query_id = owners[hit["qseqid"]]
+                    hit["qseqid"] = query_id
+                    if len(answers[n][query_id]) < requests[n][3]:
+                        answers[n][query_id].append(hit)
+
+            for n, request in enumerate(requests):
+                request[4].set_result(answers[n])
+
+            self.stats["requests"] += len(requests)
+            self.stats["batches"] += 1
+            self.stats["sequences"] += len(owners)
+            self.stats["search_seconds"] += time.time() - start_time
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+
+
+# It parses the sequences of a fasta text into (id, sequence) tuples
+def parse_fasta(text):
+    records = []
+    for block in text.split(">")[1:]:
+        lines = block.strip().splitlines()
+        if lines and lines[0].strip():
+            records.append((lines[0].split()[0], "".join(line.strip() for line in lines[1:])))
+    return records
+
+
+def make_handler(batcher):
+
+    class SearchHandler(BaseHTTPRequestHandler):
+
+        def _answer(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path.rstrip("/") == "/status":
+                stats = dict(batcher.stats, db_name=batcher.db_name, pending=batcher.requests.qsize())
+                stats["mean_batch_size"] = stats["requests"] / stats["batches"] if stats["batches"] else 0
+                self._answer(200, stats)
+            else:
+                self._answer(404, {"error": "unknown path"})
+
+        def do_POST(self):
+            if self.path.rstrip("/") != "/search":
+                self._answer(404, {"error": "unknown path"})
+                return
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                records = parse_fasta(request.get("fasta", ""))
+                if not records:
+                    self._answer(400, {"error": "no sequences in 'fasta'"})
+                    return
+                future = batcher.submit(records, float(request.get("evalue", 0.0000000001)), float(request.get("min_seq_id", 0.7)), int(request.get("top", 30)))
+                self._answer(200, {"results": future.result()})
+            except Exception as e:
+                self._answer(500, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            pass
+
+    return SearchHandler
+
+
+def run_server(host="127.0.0.1", port=8750, db_name="arthropods_OrthoDB", batch_window=0.2, max_batch=500, threads=None):
+    # loading the database and the metadata index once for all the requests
+    warm_database(db_name)
+    lookup_metadata([], db_name)
+
+    batcher = SearchBatcher(db_name, batch_window=batch_window, max_batch=max_batch, threads=threads)
+    server = ThreadingHTTPServer((host, port), make_handler(batcher))
+    print(f"inprotfind search server listening on http://{host}:{port} (database: {db_name})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        shutil.rmtree(batcher.workdir, ignore_errors=True)
@@ -19,7 +19,7 @@ setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: OS Independent',
     ],
-    python_requires='>=3.6',  # Ajusta según la versión mínima de Python requerida
+    python_requires='>=3.9',  # Ajusta según la versión mínima de Python requerida
     install_requires=[
         'pandas',
         'matplotlib',